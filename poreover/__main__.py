@@ -52,9 +52,18 @@ def main():
     parser_decode.add_argument('--out', default='out',help='Prefix for FASTA sequence output')
     parser_decode.add_argument('--basecaller', choices=['poreover', 'flappie', 'guppy', 'bonito'], help='Basecaller used to generate probabilitiess')
     parser_decode.add_argument('--algorithm', default='viterbi', choices=['viterbi' ,'beam', 'prefix'], help='')
-    parser_decode.add_argument('--window', type=int, default=400, help='Use chunks of this size for prefix search')
+    parser_decode.add_argument('--window', type=int, default=400, help='Use chunks of this size for prefix search, 0 searches whole reads')
     parser_decode.add_argument('--beam_width', type=int, default=25, help='Width for beam search')
-    parser_decode.add_argument('--threads', type=int, default=1, help='Processes to use')
+    parser_decode.add_argument('--threads', type=int, default=1, help='Processes (or threads) to use')
+    parser_decode.add_argument('--chunk_size', type=int, default=0, help='Decode reads in overlapping chunks of this many frames and join them on their overlaps, 0 decodes whole reads')
+    parser_decode.add_argument('--chunk_overlap', type=int, default=200, help='Frames shared by consecutive chunks')
+    parser_decode.add_argument('--chunk_threads', type=int, default=1, help='Threads decoding the chunks of one read')
+    parser_decode.add_argument('--journal', default=False, action='store_true', help='Record finished reads in <out>.journal, synced to disk in batches, so that an interrupted run can be resumed')
+    parser_decode.add_argument('--resume', default=False, action='store_true', help='Skip the reads already in <out>.journal from an interrupted --journal run and append to its output (keeps journaling)')
+    parser_decode.add_argument('--engine', default='auto', choices=['auto', 'processes', 'threads', 'batch'], help='Decode reads in a process pool, in a thread pool sharing one process, or in batches of whole reads with one C++ call each (for many short reads, viterbi and beam without --chunk_size only). auto batches many short reads and uses processes otherwise')
+    parser_decode.add_argument('--batch_size', type=int, default=256, help='Reads per call with --engine batch')
+    parser_decode.add_argument('--logaddexp', default='exact', choices=['exact', 'fast'], help='Evaluate logaddexp with libm or with a lookup table (faster, absolute error < 2e-6)')
+    parser_decode.add_argument('--precision', default='float64', choices=['float64', 'float32'], help='Precision of the trace passed to the decoder (float32 halves its memory, probabilities are still accumulated in float64)')
 
     # Pair decode
     parser_pair= subparsers.add_parser('pair-decode', help='1D2 consensus decoding of two output probabilities', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -64,20 +73,39 @@ def main():
     parser_pair.add_argument('--dir', default='.', help='Directory for basecaller probabilities')
     parser_pair.add_argument('--basecaller', choices=['poreover', 'flappie', 'guppy', 'bonito'], help='Basecaller used to generate probabilitiess')
     parser_pair.add_argument('--reverse_complement', default=False, action='store_true', help='Whether to reverse complement the second sequence')
+    parser_pair.add_argument('--auto_orientation', default=False, action='store_true', help='Reverse complement the second read of each pair only if its 1D basecall shares more minimizers with the first read that way (overrides --reverse_complement)')
     parser_pair.add_argument('--out', default='out',help='Prefix for FASTA sequence output')
-    parser_pair.add_argument('--threads', type=int, default=1, help='Processes to use')
+    parser_pair.add_argument('--threads', type=int, default=1, help='Processes (or threads) to use')
+    parser_pair.add_argument('--max_pending', type=int, default=0, help='Pairs of a list queued, decoding or waiting to be written at any time (0 is twice --threads)')
+    parser_pair.add_argument('--journal', default=False, action='store_true', help='Record finished pairs of a list in <out>.journal, synced to disk in batches, so that an interrupted run can be resumed')
+    parser_pair.add_argument('--resume', default=False, action='store_true', help='Skip the pairs of a list already in <out>.journal from an interrupted --journal run and append to its outputs (keeps journaling)')
+    parser_pair.add_argument('--ordered', default=False, action='store_true', help='Write the pairs of a list in input order instead of as they finish')
+    parser_pair.add_argument('--schedule', default='input', choices=['input', 'longest'], help='Order to dispatch pairs in, longest estimates the cost of each pair from its trace lengths and decodes the most expensive first')
+    parser_pair.add_argument('--engine', default='processes', choices=['processes', 'threads'], help='Decode reads in a process pool or in a thread pool sharing one process')
+    parser_pair.add_argument('--logaddexp', default='exact', choices=['exact', 'fast'], help='Evaluate logaddexp with libm or with a lookup table (faster, absolute error < 2e-6)')
+    parser_pair.add_argument('--precision', default='float64', choices=['float64', 'float32'], help='Precision of the trace passed to the decoder (float32 halves its memory, probabilities are still accumulated in float64)')
     parser_pair.add_argument('--method', choices=['align', 'split', 'envelope'], default='envelope', help=argparse.SUPPRESS) # Method for dividing up search space (DEPRECATED)
     parser_pair.add_argument('--single', choices=['beam', 'viterbi'], default='viterbi', help='Algorithm for 1D basecalling (used to build alignment envelope)')
     parser_pair.add_argument('--logging', default="info", choices=['info', 'debug'], help='Level for logging')
     parser_pair.add_argument('--debug', default=False, action='store_true', help='Save intermediate objects to pickled file for debugging')
     parser_pair.add_argument('--algorithm', default='beam', choices=['prefix' ,'beam'], help=argparse.SUPPRESS) # Search algorithm for pair decoding
     parser_pair.add_argument('--beam_width', type=int, default=5, help='Width for beam search')
+    parser_pair.add_argument('--aligner', default='full', choices=['banded', 'full'], help='Align the 1D basecalls with the full Needleman-Wunsch matrix, or in a band around the diagonal in linear memory (same score, ties may align differently)')
     # --method envelope
     parser_pair.add_argument('--diagonal_envelope', action='store_true', help='Use a simple diagonal band for the signal alignment envelope')
     parser_pair.add_argument('--diagonal_width', type=int, default=50, help='Width of diagonal band envelope')
+    parser_pair.add_argument('--anchoring', default='alignment', choices=['alignment', 'minimizer'], help='Build the envelope from an alignment of the 1D basecalls or from a chain of their shared minimizers (--skip_matches always aligns)')
+    parser_pair.add_argument('--minimizer_k', type=int, default=11, help='K-mer length for --anchoring minimizer')
+    parser_pair.add_argument('--minimizer_w', type=int, default=5, help='Window of consecutive k-mers per minimizer for --anchoring minimizer')
+    parser_pair.add_argument('--coarse_envelope', action='store_true', help='Build the envelope from the pair posterior on frames pooled by --coarse_factor, without 1D basecalls (CTC models only)')
+    parser_pair.add_argument('--coarse_factor', type=int, default=16, help='Frames pooled into one frame on the coarsest grid of --coarse_envelope, halved at every refinement (raised for long reads to bound the grid)')
+    parser_pair.add_argument('--coarse_threshold', type=float, default=1e-3, help='Posterior probability of the coarse cells kept in the --coarse_envelope')
     parser_pair.add_argument('--padding', type=int, default=5, help='Padding for building alignment envelope')
     parser_pair.add_argument('--skip_matches', action='store_true', help='Skip regions of sequence alignment with match columns greater than --skip_threshold')
     parser_pair.add_argument('--skip_threshold', type=int, default=10, help='Number of consecutive matches to use for --skip_matches')
+    parser_pair.add_argument('--tile_size', type=int, default=0, help='Split the envelope into tiles of this many frames of the first read and decode them concurrently (0 decodes the envelope at once)')
+    parser_pair.add_argument('--tile_overlap', type=int, default=200, help='Frames of the first read shared by neighbouring tiles, used to join their sequences')
+    parser_pair.add_argument('--pair_threads', type=int, default=1, help='Threads decoding the tiles (or --skip_matches segments) of one read pair')
     # --method split
     parser_pair.add_argument('--window', type=int, default=200, help=argparse.SUPPRESS) # Segment size used for splitting reads (DEPRECATED)
 
@@ -1 +1,2 @@
-from .align import global_pair
+from .align import encode, global_pair, banded_pair, cigar, alignment_from_ops, ALIGN_MATCH, ALIGN_DELETION, ALIGN_INSERTION, GAP_CODE
+from .align import minimizers, chain_minimizers, shared_minimizers, reverse_complement
@@ -2,6 +2,7 @@
 cimport cython
 cimport numpy as np
 from numpy cimport ndarray
+from libc.math cimport log2
 import numpy as np
 
 DTYPE = np.intc
@@ -87,3 +88,496 @@ def global_pair(str seq1, str seq2, int match=MATCH_DEFAULT, int mismatch=MISMAT
     align2.reverse()
 
     return(align1,align2,dpMatrix)
+
+# Alignment columns returned by banded_pair: both sequences advance (match or
+# mismatch), only seq1 advances (deletion) or only seq2 advances (insertion)
+ALIGN_MATCH = 0
+ALIGN_DELETION = 1
+ALIGN_INSERTION = 2
+CIGAR_OPS = 'MDI'
+# byte code of a gap in the rows of alignment_from_ops
+GAP_CODE = ord('-')
+
+cdef int NEG = -(1 << 29)
+# boxes with at most this many cells are solved with a full traceback matrix
+cdef long BASE_CELLS = 1 << 16
+
+def encode(str seq):
+    '''
+    Sequence as an array of byte codes.
+    '''
+    return(np.frombuffer(seq.encode('ascii'), dtype=np.uint8))
+
+cdef class Aligner:
+    '''
+    Banded linear-space global alignment of two byte sequences. Cell (i,j) of
+    the DP matrix is in the band if lo[i] <= j <= hi[i], i.e. within w columns
+    of the diagonal from (0,0) to (l1,l2). The optimal path in the band is
+    found by Hirschberg's divide and conquer, storing two rows at a time, and
+    written to ops one column at a time.
+    '''
+    cdef const np.uint8_t [:] s1
+    cdef const np.uint8_t [:] s2
+    cdef int l1, l2, match, mismatch, gap_cost
+    cdef int [:] lo
+    cdef int [:] hi
+    cdef np.uint8_t [:] ops
+    cdef ssize_t n_ops
+
+    def __init__(self, s1, s2, int w, int match, int mismatch, int gap_cost):
+        self.s1 = s1
+        self.s2 = s2
+        self.l1 = len(s1)
+        self.l2 = len(s2)
+        self.match = match
+        self.mismatch = mismatch
+        self.gap_cost = gap_cost
+        # neighbouring rows have to overlap for the band to be connected
+        l1 = max(self.l1, 1)
+        w = max(w, self.l2 // l1 + 1)
+        i = np.arange(self.l1+1, dtype=np.int64)
+        self.lo = np.clip(i*self.l2 // l1 - w, 0, self.l2).astype(np.intc)
+        self.hi = np.clip(-(-i*self.l2 // l1) + w, 0, self.l2).astype(np.intc)
+        self.ops = np.zeros(self.l1+self.l2, dtype=np.uint8)
+        self.n_ops = 0
+
+    def full(self):
+        # band covers the whole matrix
+        return(np.all(np.asarray(self.lo) == 0) and np.all(np.asarray(self.hi) == self.l2))
+
+    def align(self):
+        self.n_ops = 0
+        self.solve(0, self.l1, 0, self.l2)
+        return(np.asarray(self.ops[:self.n_ops]))
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef int substitution(self, int i, int j) noexcept nogil:
+        # score of aligning s1[i] with s2[j]
+        return(self.match if self.s1[i] == self.s2[j] else self.mismatch)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void forward_row(self, int i0, int i1, int j0, int j1, int [:] prev, int [:] cur) nogil:
+        '''
+        Best scores from (i0,j0) to (i1,j) for j0 <= j <= j1, left in prev
+        (indexed by j-j0). Cells outside the band score NEG.
+        '''
+        cdef int i, j, lo, hi, plo, phi, left, best, v
+        for j in range(j1-j0+1):
+            prev[j] = NEG
+            cur[j] = NEG
+        plo = max(self.lo[i0], j0)
+        phi = min(self.hi[i0], j1)
+        prev[0] = 0
+        for j in range(j0+1, phi+1):
+            prev[j-j0] = prev[j-j0-1] + self.gap_cost
+        for i in range(i0+1, i1+1):
+            lo = max(self.lo[i], j0)
+            hi = min(self.hi[i], j1)
+            left = NEG
+            for j in range(lo, hi+1):
+                best = prev[j-j0] + self.gap_cost
+                if j > j0:
+                    v = prev[j-j0-1] + self.substitution(i-1, j-1)
+                    if v > best:
+                        best = v
+                    if left + self.gap_cost > best:
+                        best = left + self.gap_cost
+                cur[j-j0] = best
+                left = best
+            # prev becomes this row; clear what is left of the previous one
+            for j in range(plo, phi+1):
+                prev[j-j0] = NEG
+            for j in range(lo, hi+1):
+                prev[j-j0] = cur[j-j0]
+            plo = lo
+            phi = hi
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void reverse_row(self, int i0, int i1, int j0, int j1, int [:] prev, int [:] cur) nogil:
+        '''
+        Best scores from (i0,j) to (i1,j1) for j0 <= j <= j1, left in prev
+        (indexed by j-j0). Cells outside the band score NEG.
+        '''
+        cdef int i, j, lo, hi, plo, phi, right, best, v
+        for j in range(j1-j0+1):
+            prev[j] = NEG
+            cur[j] = NEG
+        plo = max(self.lo[i1], j0)
+        phi = min(self.hi[i1], j1)
+        prev[j1-j0] = 0
+        for j in range(j1-1, plo-1, -1):
+            prev[j-j0] = prev[j-j0+1] + self.gap_cost
+        for i in range(i1-1, i0-1, -1):
+            lo = max(self.lo[i], j0)
+            hi = min(self.hi[i], j1)
+            right = NEG
+            for j in range(hi, lo-1, -1):
+                best = prev[j-j0] + self.gap_cost
+                if j < j1:
+                    v = prev[j-j0+1] + self.substitution(i, j)
+                    if v > best:
+                        best = v
+                    if right + self.gap_cost > best:
+                        best = right + self.gap_cost
+                cur[j-j0] = best
+                right = best
+            for j in range(plo, phi+1):
+                prev[j-j0] = NEG
+            for j in range(lo, hi+1):
+                prev[j-j0] = cur[j-j0]
+            plo = lo
+            phi = hi
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void traceback(self, int i0, int i1, int j0, int j1):
+        '''
+        Full DP matrix of a small box and traceback, preferring a match, then a
+        deletion, then an insertion (as global_pair does).
+        '''
+        cdef int la = i1-i0
+        cdef int lb = j1-j0
+        cdef int i, j, best, v
+        cdef ssize_t k, start
+        dp_np = np.full((la+1, lb+1), NEG, dtype=DTYPE)
+        cdef int [:,:] dp = dp_np
+        for i in range(la+1):
+            for j in range(max(self.lo[i0+i], j0)-j0, min(self.hi[i0+i], j1)-j0+1):
+                if i == 0 and j == 0:
+                    dp[i,j] = 0
+                    continue
+                best = NEG
+                if i > 0:
+                    best = dp[i-1,j] + self.gap_cost
+                if j > 0 and dp[i,j-1] + self.gap_cost > best:
+                    best = dp[i,j-1] + self.gap_cost
+                if i > 0 and j > 0:
+                    v = dp[i-1,j-1] + self.substitution(i0+i-1, j0+j-1)
+                    if v > best:
+                        best = v
+                dp[i,j] = best
+        # path is traced back from the end of the box, then reversed in place
+        start = self.n_ops
+        i = la
+        j = lb
+        while i > 0 or j > 0:
+            if i > 0 and j > 0 and dp[i,j] == dp[i-1,j-1] + self.substitution(i0+i-1, j0+j-1):
+                self.ops[self.n_ops] = ALIGN_MATCH
+                i -= 1
+                j -= 1
+            elif i > 0 and dp[i,j] == dp[i-1,j] + self.gap_cost:
+                self.ops[self.n_ops] = ALIGN_DELETION
+                i -= 1
+            else:
+                self.ops[self.n_ops] = ALIGN_INSERTION
+                j -= 1
+            self.n_ops += 1
+        k = self.n_ops-1
+        while start < k:
+            self.ops[start], self.ops[k] = self.ops[k], self.ops[start]
+            start += 1
+            k -= 1
+
+    cdef void solve(self, int i0, int i1, int j0, int j1):
+        cdef int mid, j, best_j, best, v
+        cdef ssize_t k
+        if i1 == i0:
+            for k in range(j1-j0):
+                self.ops[self.n_ops] = ALIGN_INSERTION
+                self.n_ops += 1
+            return
+        if i1-i0 <= 1 or <long>(i1-i0+1)*(j1-j0+1) <= BASE_CELLS:
+            self.traceback(i0, i1, j0, j1)
+            return
+
+        # split at the cell of the middle row on the optimal path
+        mid = (i0+i1) // 2
+        f_np = np.empty(j1-j0+1, dtype=DTYPE)
+        r_np = np.empty(j1-j0+1, dtype=DTYPE)
+        cdef int [:] f = f_np
+        cdef int [:] r = r_np
+        cdef int [:] tmp = np.empty(j1-j0+1, dtype=DTYPE)
+        self.forward_row(i0, mid, j0, j1, f, tmp)
+        self.reverse_row(mid, i1, j0, j1, r, tmp)
+        best = NEG
+        best_j = max(self.lo[mid], j0)
+        for j in range(max(self.lo[mid], j0), min(self.hi[mid], j1)+1):
+            v = f[j-j0] + r[j-j0]
+            if v > best:
+                best = v
+                best_j = j
+        del f_np, r_np
+
+        self.solve(i0, mid, j0, best_j)
+        self.solve(mid, i1, best_j, j1)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef int remaining_bound(self, int i, int j) noexcept nogil:
+        # most that any path from (i,j) to (l1,l2) can score
+        cdef int a = self.l1-i
+        cdef int b = self.l2-j
+        cdef int best_sub = max(self.match, self.mismatch)
+        cdef int diagonal = min(a, b)*best_sub + (max(a, b)-min(a, b))*self.gap_cost
+        return(max(diagonal, (a+b)*self.gap_cost))
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def escape_bound(self):
+        '''
+        Upper bound on the score of a path that leaves the band. Such a path
+        leaves it from a cell in the band, so it scores at most the best score
+        of that cell in the band, plus the step out of the band, plus the most
+        the rest of the path can score. If the bound is no higher than the
+        score of the path in the band, that path is optimal.
+        '''
+        cdef int i, j, lo, hi, plo, phi, left, best, v, f
+        cdef int bound = NEG
+        prev_np = np.full(self.l2+2, NEG, dtype=DTYPE)
+        cur_np = np.full(self.l2+2, NEG, dtype=DTYPE)
+        cdef int [:] prev = prev_np
+        cdef int [:] cur = cur_np
+        with nogil:
+            plo = 0
+            phi = -1
+            for i in range(self.l1+1):
+                lo = self.lo[i]
+                hi = self.hi[i]
+                # best scores of row i in the band
+                left = NEG
+                for j in range(lo, hi+1):
+                    if i == 0 and j == 0:
+                        best = 0
+                    else:
+                        best = NEG
+                        if i > 0 and prev[j] > NEG:
+                            best = prev[j] + self.gap_cost
+                        if j > 0 and left > NEG and left + self.gap_cost > best:
+                            best = left + self.gap_cost
+                        if i > 0 and j > 0 and prev[j-1] > NEG:
+                            v = prev[j-1] + self.substitution(i-1, j-1)
+                            if v > best:
+                                best = v
+                    cur[j] = best
+                    left = best
+
+                # steps from row i to cells out of the band
+                for j in range(lo, hi+1):
+                    f = cur[j]
+                    if f <= NEG:
+                        continue
+                    if j < self.l2 and j+1 > hi:
+                        bound = max(bound, f + self.gap_cost + self.remaining_bound(i, j+1))
+                    if i < self.l1:
+                        if j < self.lo[i+1] or j > self.hi[i+1]:
+                            bound = max(bound, f + self.gap_cost + self.remaining_bound(i+1, j))
+                        if j < self.l2 and (j+1 < self.lo[i+1] or j+1 > self.hi[i+1]):
+                            bound = max(bound, f + self.substitution(i, j) + self.remaining_bound(i+1, j+1))
+
+                for j in range(plo, phi+1):
+                    prev[j] = NEG
+                for j in range(lo, hi+1):
+                    prev[j] = cur[j]
+                plo = lo
+                phi = hi
+        return(bound)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def score(self):
+        cdef int i = 0
+        cdef int j = 0
+        cdef int s = 0
+        cdef ssize_t k
+        for k in range(self.n_ops):
+            if self.ops[k] == ALIGN_MATCH:
+                s += self.substitution(i, j)
+                i += 1
+                j += 1
+            elif self.ops[k] == ALIGN_DELETION:
+                s += self.gap_cost
+                i += 1
+            else:
+                s += self.gap_cost
+                j += 1
+        return(s)
+
+def banded_pair(str seq1, str seq2, int match=MATCH_DEFAULT, int mismatch=MISMATCH_DEFAULT, int gap_cost=GAP_DEFAULT, int band=128):
+    '''
+    Needleman-Wunsch restricted to a band around the diagonal, in linear
+    memory. The band starts |len(seq1)-len(seq2)| + band cells to either side
+    and is doubled until no path that leaves it can score higher than the
+    optimal path inside it (see Aligner.escape_bound), so the alignment is
+    always optimal. Returns the alignment as an array of
+    ALIGN_MATCH/ALIGN_DELETION/ALIGN_INSERTION columns and its score.
+    '''
+    s1 = encode(seq1)
+    s2 = encode(seq2)
+    band = abs(len(s1)-len(s2)) + max(band, 1)
+    while True:
+        aligner = Aligner(s1, s2, band, match, mismatch, gap_cost)
+        ops = aligner.align()
+        score = aligner.score()
+        if aligner.full() or aligner.escape_bound() <= score:
+            return(ops.copy(), score)
+        band *= 2
+
+def cigar(ops):
+    '''
+    Run-length encoding of alignment columns, e.g. 10M2I.
+    '''
+    ops = np.asarray(ops)
+    if len(ops) == 0:
+        return('')
+    starts = np.flatnonzero(np.r_[True, ops[1:] != ops[:-1]])
+    lengths = np.diff(np.r_[starts, len(ops)])
+    return(''.join('{}{}'.format(n, CIGAR_OPS[op]) for n, op in zip(lengths, ops[starts])))
+
+def alignment_from_ops(str seq1, str seq2, ops):
+    '''
+    Gapped sequences of an alignment, as two rows of byte codes with GAP_CODE
+    in the gaps.
+    '''
+    ops = np.asarray(ops)
+    alignment = np.full((2, len(ops)), GAP_CODE, dtype=np.uint8)
+    alignment[0, ops != ALIGN_INSERTION] = encode(seq1)
+    alignment[1, ops != ALIGN_DELETION] = encode(seq2)
+    return(alignment)
+
+# 2-bit codes of bases for k-mer sketches, other bytes are 4
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+BASE_CODES[encode('ACGT')] = np.arange(4)
+BASE_CODES[encode('acgt')] = np.arange(4)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline np.uint64_t hash64(np.uint64_t key, np.uint64_t mask) nogil:
+    # invertible integer hash so that minimizers are not biased to poly-A
+    key = (~key + (key << 21)) & mask
+    key = key ^ (key >> 24)
+    key = ((key + (key << 3)) + (key << 8)) & mask
+    key = key ^ (key >> 14)
+    key = ((key + (key << 2)) + (key << 4)) & mask
+    key = key ^ (key >> 28)
+    key = (key + (key << 31)) & mask
+    return(key)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def minimizers(str seq, int k=15, int w=10):
+    '''
+    (w,k)-minimizers of a sequence: the k-mer with the smallest hash in every
+    window of w consecutive k-mers. K-mers containing a base other than ACGT
+    are skipped. Returns their start positions and hashes.
+    '''
+    if not 0 < k <= 31 or w < 1:
+        raise ValueError('Minimizers need 0 < k <= 31 and w >= 1 (k={}, w={})'.format(k, w))
+    cdef const np.uint8_t [:] s = BASE_CODES[encode(seq)]
+    cdef ssize_t n = len(s)
+    cdef np.uint64_t mask = (<np.uint64_t>1 << (2*k)) - 1
+    cdef np.uint64_t kmer = 0
+    cdef ssize_t i, j, valid = 0, n_out = 0, last = -1, best
+    cdef np.uint64_t invalid = np.iinfo(np.uint64).max
+
+    # hash of the k-mer starting at every position (all ones if invalid)
+    hashes_np = np.full(max(n-k+1, 0), invalid, dtype=np.uint64)
+    cdef np.uint64_t [:] hashes = hashes_np
+    for i in range(n):
+        if s[i] > 3:
+            valid = 0
+            kmer = 0
+            continue
+        kmer = ((kmer << 2) | s[i]) & mask
+        valid += 1
+        if valid >= k:
+            hashes[i-k+1] = hash64(kmer, mask)
+
+    positions_np = np.zeros(max(n-k+1, 0), dtype=np.int64)
+    cdef np.int64_t [:] positions = positions_np
+    for i in range(max(n-k-w+2, 1 if n >= k else 0)):
+        best = i
+        for j in range(i+1, min(i+w, n-k+1)):
+            if hashes[j] < hashes[best]:
+                best = j
+        if best != last and hashes[best] != invalid:
+            positions[n_out] = best
+            n_out += 1
+            last = best
+    positions_np = positions_np[:n_out]
+    return(positions_np, hashes_np[positions_np])
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def chain_minimizers(str seq1, str seq2, int k=15, int w=10, int max_gap=5000, int max_occurrences=20, int lookback=50):
+    '''
+    Colinear chain of minimizer hits between two sequences, scored as in
+    minimap2: bases covered by the seeds minus a penalty growing with the
+    difference of their diagonals. Minimizers of seq2 occurring more than
+    max_occurrences times are ignored. Returns the (n,2) start positions of
+    the chained k-mers in seq1 and seq2, in order.
+    '''
+    pos1, hash1 = minimizers(seq1, k, w)
+    pos2, hash2 = minimizers(seq2, k, w)
+
+    # hits of every minimizer of seq1 in seq2
+    order = np.argsort(hash2, kind='stable')
+    hash2, pos2 = hash2[order], pos2[order]
+    left = np.searchsorted(hash2, hash1, side='left')
+    right = np.searchsorted(hash2, hash1, side='right')
+    counts = right - left
+    counts[counts > max_occurrences] = 0
+    hit1 = np.repeat(pos1, counts)
+    starts = np.repeat(left - np.cumsum(counts) + counts, counts)
+    hit2 = pos2[starts + np.arange(len(hit1))]
+    order = np.lexsort((hit2, hit1))
+    hits_np = np.stack((hit1[order], hit2[order]), axis=1).astype(np.int64)
+    if len(hits_np) == 0:
+        return(hits_np)
+
+    cdef np.int64_t [:,:] hits = hits_np
+    cdef ssize_t n = len(hits_np)
+    f_np = np.zeros(n, dtype=np.float64)
+    p_np = np.full(n, -1, dtype=np.int64)
+    cdef double [:] f = f_np
+    cdef np.int64_t [:] p = p_np
+    cdef ssize_t a, b
+    cdef np.int64_t di, dj, dd
+    cdef double score
+    for a in range(n):
+        f[a] = k
+        for b in range(a-1, max(a-lookback, 0)-1, -1):
+            di = hits[a,0] - hits[b,0]
+            dj = hits[a,1] - hits[b,1]
+            if di > max_gap:
+                break
+            if di <= 0 or dj <= 0 or dj > max_gap:
+                continue
+            dd = di - dj if di > dj else dj - di
+            score = f[b] + min(min(di, dj), k) - 0.01*k*dd - 0.5*log2(dd+1)
+            if score > f[a]:
+                f[a] = score
+                p[a] = b
+
+    # trace back from the best scoring seed
+    chain = []
+    a = int(np.argmax(f_np))
+    while a >= 0:
+        chain.append(a)
+        a = p[a]
+    return(hits_np[chain[::-1]])
+
+COMPLEMENT = str.maketrans('ACGTacgt', 'TGCAtgca')
+
+def reverse_complement(str seq):
+    return(seq.translate(COMPLEMENT)[::-1])
+
+def shared_minimizers(str seq1, str seq2, int k=15, int w=10):
+    '''
+    Number of minimizers of seq1 that are also minimizers of seq2.
+    '''
+    _, hash1 = minimizers(seq1, k, w)
+    _, hash2 = minimizers(seq2, k, w)
+    return(int(np.sum(np.isin(hash1, hash2))))
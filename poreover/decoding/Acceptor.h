@@ -0,0 +1,215 @@
+#ifndef ACCEPTOR_H
+#define ACCEPTOR_H
+
+#include <string>
+#include <vector>
+#include <array>
+#include <cstdint>
+#include <cmath>
+#include <algorithm>
+
+#include "ArrayView.h"
+#include "BandedMatrix.h"
+#include "Log.h"
+
+/*
+Viterbi acceptor: the best path through a trace that emits a given label,
+i.e. the frames of every base of a basecall (resquiggling). Paths are in the
+states of viterbi() in Viterbi.h, so they can be read the same way.
+
+The states of the label are unrolled into rows, the best path to each row is
+filled frame by frame within a band around the diagonal of the label and the
+trace. Only the last four rows of probabilities are kept, the traceback is
+stored as one byte per cell of the band.
+*/
+
+// one state of the unrolled label
+struct AcceptorRow {
+  // column of the trace it emits
+  int column;
+  // bases of the label emitted once in this state, centers the band
+  int base;
+  // whether it can emit on consecutive frames
+  bool stay;
+  // bit d-1 is set if row r-d can move to this row (d = 1,2,3)
+  int from;
+};
+
+// ctc: blank, base 1, blank, ..., base L, blank. A base emits once and any
+// base can follow it directly.
+// ctc_merge_repeats: same rows but a base can stay, so only a blank separates
+// a repeated base.
+// ctc_flipflop: flip and flop state of every base. A base can follow in its
+// flip state unless the previous base was the same flip state, and in its
+// flop state only after the flip state of the same base.
+inline std::vector<AcceptorRow> acceptor_rows(const std::vector<int> &label, int alphabet_size, std::string model) {
+  std::vector<AcceptorRow> rows;
+  int l_max = label.size();
+  if (model == "ctc_flipflop") {
+    for (int l=0; l<l_max; l++) {
+      bool repeat = (l > 0) && (label[l] == label[l-1]);
+      int flip_from = (l > 0) ? (repeat ? 1 : 3) : 0;
+      int flop_from = repeat ? 4 : 0;
+      rows.push_back({label[l], l+1, true, flip_from});
+      rows.push_back({label[l]+alphabet_size, l+1, true, flop_from});
+    }
+  } else {
+    bool merge_repeats = (model == "ctc_merge_repeats");
+    int blank = alphabet_size;
+    rows.push_back({blank, 0, true, 0});
+    for (int l=0; l<l_max; l++) {
+      bool skip = (l > 0) && !(merge_repeats && label[l] == label[l-1]);
+      rows.push_back({label[l], l+1, merge_repeats, skip ? 3 : 1});
+      rows.push_back({blank, l+1, true, 1});
+    }
+  }
+  return rows;
+}
+
+// Fill the band of half-width frames around the diagonal. Returns the log
+// probability of the best path (and writes it to path) or -inf if the band
+// holds none. escape is set to an upper bound on the log probability of any
+// path that leaves the band: the best score of the cell it leaves from, plus
+// the emission of the cell outside, plus the best emission of every later
+// frame. If it is no higher than the path in the band, that path is the best
+// path.
+template <class T>
+double viterbi_acceptor_band(ArrayView<T> y, int t_max, const std::vector<AcceptorRow> &rows, const std::vector<double> &rest, double frames_per_base, int width, int *path, double &escape) {
+  int r_max = rows.size();
+  escape = DEFAULT_VALUE;
+
+  // paths start in the first two rows and end in the last two, which are
+  // always in the band
+  std::vector<std::array<int,2>> ranges(r_max);
+  for (int r=0; r<r_max; r++) {
+    int center = int(rows[r].base * frames_per_base);
+    ranges[r] = {std::max(center-width, 0), std::min(center+width, t_max-1)};
+    if (r < 2) {
+      ranges[r][0] = 0;
+    }
+    if (r >= r_max-2) {
+      ranges[r][1] = t_max-1;
+    }
+  }
+
+  // from which row each cell was reached, as the distance d to that row
+  BandedMatrix<std::uint8_t> ptr(ranges, r_max);
+  std::vector<double> v[4];
+  for (auto &row : v) {
+    row.assign(t_max, DEFAULT_VALUE);
+  }
+
+  for (int r=0; r<r_max; r++) {
+    std::vector<double> &curr = v[r % 4];
+    const AcceptorRow &row = rows[r];
+    int start = ranges[r][0];
+    int end = ranges[r][1];
+    if (r >= 4) {
+      std::fill(curr.begin() + ranges[r-4][0], curr.begin() + ranges[r-4][1] + 1, DEFAULT_VALUE);
+    }
+    std::uint8_t *p = ptr.row(r);
+
+    int t = start;
+    if (t == 0) {
+      // paths start in the first two rows
+      curr[0] = (r < 2) ? double(y[0][row.column]) : DEFAULT_VALUE;
+      p[0] = 0;
+      t = 1;
+    }
+    for (; t<=end; t++) {
+      double best = row.stay ? curr[t-1] : DEFAULT_VALUE;
+      std::uint8_t from = 0;
+      for (int d=1; d<=3; d++) {
+        if ((row.from >> (d-1)) & 1) {
+          double prev = v[(r-d) % 4][t-1];
+          if (prev > best) {
+            best = prev;
+            from = d;
+          }
+        }
+      }
+      curr[t] = best + y[t][row.column];
+      p[t-start] = from;
+    }
+
+    // steps from this row to cells of this or later rows out of the band
+    for (int r2=r; r2<std::min(r+4, r_max); r2++) {
+      bool step = (r2 == r) ? row.stay : ((rows[r2].from >> (r2-r-1)) & 1);
+      if (!step) {
+        continue;
+      }
+      int column = rows[r2].column;
+      for (t=start; t<=end && t+1<t_max; t++) {
+        if ((t+1 < ranges[r2][0] || t+1 > ranges[r2][1]) && curr[t] > DEFAULT_VALUE) {
+          escape = std::max(escape, curr[t] + y[t+1][column] + rest[t+2]);
+        }
+      }
+    }
+  }
+
+  // paths end in the last two rows
+  int r = r_max-1;
+  double score = v[r % 4][t_max-1];
+  if (r_max >= 2 && v[(r_max-2) % 4][t_max-1] > score) {
+    r = r_max-2;
+    score = v[r % 4][t_max-1];
+  }
+  if (score == DEFAULT_VALUE) {
+    return score;
+  }
+
+  for (int t=t_max-1; t>=0; t--) {
+    path[t] = rows[r].column;
+    r -= ptr.at(r, t);
+  }
+  return score;
+}
+
+// Best path through y that emits label (indices into the alphabet), model is
+// ctc, ctc_merge_repeats or ctc_flipflop. The band starts at width frames
+// either side of the diagonal, or at 0 at the frames of band_bases bases, and
+// is doubled until no path leaving it can score higher than the best path in
+// it, so the path is always the best one. Returns the log probability of the
+// path, -inf if there is none.
+template <class T>
+double viterbi_acceptor(ArrayView<T> y, int t_max, const std::vector<int> &label, int alphabet_size, std::string model, int width, int *path, int band_bases=50) {
+  int l_max = label.size();
+  if (t_max == 0) {
+    return (l_max == 0) ? 0 : DEFAULT_VALUE;
+  }
+  std::vector<AcceptorRow> rows = acceptor_rows(label, alphabet_size, model);
+  if (rows.empty()) {
+    return DEFAULT_VALUE;
+  }
+
+  // best emission of the frames from t on, among the columns of the label
+  std::vector<bool> used(alphabet_size*2+1, false);
+  for (const AcceptorRow &row : rows) {
+    used[row.column] = true;
+  }
+  std::vector<double> rest(t_max+2, 0);
+  for (int t=t_max-1; t>=0; t--) {
+    double best = DEFAULT_VALUE;
+    for (std::size_t k=0; k<used.size(); k++) {
+      if (used[k]) {
+        best = std::max(best, double(y[t][k]));
+      }
+    }
+    rest[t] = rest[t+1] + best;
+  }
+
+  double frames_per_base = double(t_max) / std::max(l_max, 1);
+  if (width <= 0) {
+    width = std::max(int(std::ceil(band_bases * frames_per_base)), 1);
+  }
+  while (true) {
+    double escape;
+    double score = viterbi_acceptor_band(y, t_max, rows, rest, frames_per_base, width, path, escape);
+    if (width >= t_max || (score > DEFAULT_VALUE && escape <= score)) {
+      return score;
+    }
+    width = std::min(2*width, t_max);
+  }
+}
+
+#endif
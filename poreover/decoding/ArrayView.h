@@ -0,0 +1,42 @@
+#ifndef ARRAY_VIEW_HPP
+#define ARRAY_VIEW_HPP
+
+#include <cstddef>
+
+// Read-only view of a 2D array owned by the caller, usually a numpy array.
+// Rows are addressed through a stride, which may be negative for reversed
+// arrays, and columns through a table of offsets, so a sliced, reversed or
+// column permuted array (e.g. the reverse complement of a trace) is read in
+// place. Strides and offsets are in elements, not bytes.
+template <class T>
+class ArrayView {
+  public:
+    class Row {
+      private:
+        const T *data;
+        const std::ptrdiff_t *columns;
+      public:
+        Row(const T *d, const std::ptrdiff_t *c) : data(d), columns(c) {}
+        const T& operator[](int k) const {
+          return data[columns[k]];
+        }
+    };
+
+    const T *data = nullptr;
+    std::ptrdiff_t row_stride = 0;
+    const std::ptrdiff_t *columns = nullptr;
+
+    ArrayView() {}
+    ArrayView(const T *d, std::ptrdiff_t s, const std::ptrdiff_t *c) : data(d), row_stride(s), columns(c) {}
+
+    Row operator[](int i) const {
+      return Row(data + i*row_stride, columns);
+    }
+
+    // a default constructed view stands for a missing array
+    explicit operator bool() const {
+      return data != nullptr;
+    }
+};
+
+#endif
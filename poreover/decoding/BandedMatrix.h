@@ -0,0 +1,106 @@
+#ifndef BANDED_MATRIX_H
+#define BANDED_MATRIX_H
+
+#include <vector>
+#include <limits>
+#include <cstddef>
+#include <algorithm>
+
+// Matrix that only stores columns start[i] to end[i] (inclusive) of row i.
+// Rows are kept CSR-style in one buffer, row i begins at values[offset[i]],
+// so building it from an envelope is a single allocation and neighbouring
+// rows are neighbours in memory.
+// get/set check the band and read default_value outside of it, at and row
+// skip the checks for inner loops that stay inside the band.
+template <class T>
+class BandedMatrix {
+  public:
+    std::vector<int> start;
+    std::vector<int> end;
+    std::vector<std::size_t> offset{0};
+    std::vector<T> values;
+    int length;
+    T default_value;
+
+    BandedMatrix(T d) :length{0}, default_value{d} {}
+    // if no default value provided, try to use -infinity
+    BandedMatrix() :length{0}, default_value{-std::numeric_limits<T>::infinity()} {}
+
+    // one row per envelope range [envelope_ranges[i][0], envelope_ranges[i][1]]
+    template <class TEnvelope>
+    BandedMatrix(const TEnvelope &envelope_ranges, int rows) : BandedMatrix() {
+      std::size_t cells = 0;
+      for (int i=0; i<rows; i++) {
+        cells += row_size(envelope_ranges[i][0], envelope_ranges[i][1]);
+      }
+      reserve(rows, cells);
+      for (int i=0; i<rows; i++) {
+        push_row(envelope_ranges[i][0], envelope_ranges[i][1]);
+      }
+    }
+
+    static std::size_t row_size(int s, int e) {
+      return std::max(e-s+1, 0);
+    }
+
+    void reserve(int rows, std::size_t cells) {
+      start.reserve(rows);
+      end.reserve(rows);
+      offset.reserve(rows+1);
+      values.reserve(cells);
+    }
+
+    void push_row(int s, int e, T value) {
+      // set row to some value
+      start.push_back(s);
+      end.push_back(e);
+      values.resize(values.size() + row_size(s, e), value);
+      offset.push_back(values.size());
+      length += 1;
+    }
+
+    void push_row(int s, int e) {
+      push_row(s, e, default_value);
+    }
+
+    bool contains(int i, int j) const {
+      return (0 <= i) && (i < length) && (start[i] <= j) && (j <= end[i]);
+    }
+
+    void set(int i, int j, T value) {
+      if (contains(i, j)) {
+        at(i, j) = value;
+      }
+    }
+
+    T get(int i, int j) const {
+      if (contains(i, j)) {
+        return at(i, j);
+      } else {
+        return default_value;
+      }
+    }
+
+    // unchecked, (i,j) has to be in the band
+    T& at(int i, int j) {
+      return values[offset[i] + (j - start[i])];
+    }
+    const T& at(int i, int j) const {
+      return values[offset[i] + (j - start[i])];
+    }
+
+    // first cell of row i, i.e. column start[i]
+    T* row(int i) {
+      return values.data() + offset[i];
+    }
+
+    T* data() {
+      return values.data();
+    }
+
+    std::size_t size() const {
+      return values.size();
+    }
+};
+
+#endif
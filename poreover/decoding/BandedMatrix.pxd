@@ -0,0 +1,17 @@
+from libcpp.vector cimport vector
+
+# Declare the class with cdef
+cdef extern from "BandedMatrix.h":
+    cdef cppclass BandedMatrix[T]:
+        int length
+        vector[int] start
+        vector[int] end
+        vector[size_t] offset
+        BandedMatrix()
+        BandedMatrix(T)
+        void push_row(int, int)
+        bint contains(int, int)
+        void set(int, int, T)
+        T get(int, int)
+        T* data()
+        size_t size()
@@ -6,11 +6,13 @@
 #include <unordered_set>
 #include <iterator>
 #include <cmath>
+#include <cstdint>
+#include <algorithm>
 
 template <class T>
 class node_greater {
 public:
-  bool operator()(T x, T y) {
+  bool operator()(T x, T y) const {
     auto lhs = x->last_probability();
     auto rhs = y->last_probability();
     return (lhs > rhs);
@@ -20,7 +22,7 @@ public:
 template <class T>
 class node_greater_max {
 public:
-  bool operator()(T x, T y) {
+  bool operator()(T x, T y) const {
     auto lhs = x->max_probability();
     auto rhs = y->max_probability();
     return (lhs > rhs);
@@ -31,7 +33,7 @@ template <class T>
 class node_greater_max_lengthnorm {
 // length normalized
 public:
-  bool operator()(T x, T y) {
+  bool operator()(T x, T y) const {
     float length_norm_x = std::pow(x->depth, 0.2);
     float length_norm_y = std::pow(y->depth, 0.2);
     auto lhs = x->max_probability()/length_norm_x;
@@ -80,6 +82,10 @@ class Beam {
       return elements.size();
     }
 
+    void clear() {
+      elements.clear();
+    }
+
     void prune() {
         // sort elements, eliminate duplicates, then prune beam to top W
         // first sort pointers to eliminate duplicates with std::unique
@@ -103,25 +109,120 @@ class Beam {
 
 };
 
+template <class T, class F>
+class HashBeam {
+    /*
+    Beam implementation that drops duplicates on insert with an open-addressing
+    set of node pointers, then selects the top W with std::nth_element and only
+    sorts those W
+    */
+  public:
+    int width;
+    std::vector<T> elements;
+
+    HashBeam(int w): width{w}, table(64, nullptr) {}
+
+    void push(T n) {
+      if (insert(n)) {
+        elements.push_back(n);
+      }
+    }
+
+    void push(std::vector<T> n_vector) {
+      for (int i=0; i < n_vector.size(); i++) {
+        push(n_vector[i]);
+      }
+    }
+
+    int size() {
+      return elements.size();
+    }
+
+    void clear() {
+      elements.clear();
+      std::fill(table.begin(), table.end(), nullptr);
+      count = 0;
+    }
+
+    void prune() {
+        if (elements.size() > width) {
+          std::nth_element(elements.begin(), elements.begin()+width, elements.end(), F());
+          elements.erase(elements.begin()+width, elements.end());
+        }
+        std::sort(elements.begin(), elements.end(), F());
+
+        // survivors stay in the set so that pushing them again is a no-op
+        std::fill(table.begin(), table.end(), nullptr);
+        count = 0;
+        for (auto n : elements) {
+          insert(n);
+        }
+    }
+
+    T top() {
+      return elements[0];
+    }
+
+  private:
+    std::vector<T> table;
+    int count = 0;
+
+    size_t slot(T n) const {
+      // Fibonacci hashing of the pointer, table size is a power of two
+      uintptr_t key = reinterpret_cast<uintptr_t>(n) >> 4;
+      return (key * 11400714819323198485ull) & (table.size() - 1);
+    }
+
+    // returns false if n is already in the set
+    bool insert(T n) {
+      if (2*(count+1) > table.size()) {
+        grow();
+      }
+      size_t i = slot(n);
+      while (table[i] != nullptr) {
+        if (table[i] == n) {
+          return false;
+        }
+        i = (i + 1) & (table.size() - 1);
+      }
+      table[i] = n;
+      count++;
+      return true;
+    }
+
+    void grow() {
+      std::vector<T> old_table(2*table.size(), nullptr);
+      old_table.swap(table);
+      count = 0;
+      for (auto n : old_table) {
+        if (n != nullptr) {
+          insert(n);
+        }
+      }
+    }
+
+};
+
 template <class T, class F>
 class Beam2 {
     /*
-    Beam implementation using std::set as backend
+    Beam implementation using std::set as backend. Node probabilities change
+    between prunes, so the set is rebuilt from the candidates on each prune.
+    Nodes with equal probabilities compare equivalent and only one is kept.
     */
   public:
     int width;
-    std::set<T, F> elements;
-    //std::set<T> elements;
+    std::vector<T> elements;
 
     Beam2(int w): width{w} {}
 
     void push(T n) {
-      elements.insert(n);
+      elements.push_back(n);
     }
 
     void push(std::vector<T> n_vector) {
       for (int i=0; i < n_vector.size(); i++) {
-        elements.insert(n_vector[i]);
+        elements.push_back(n_vector[i]);
       }
     }
 
@@ -129,27 +230,31 @@ class Beam2 {
       return elements.size();
     }
 
+    void clear() {
+      elements.clear();
+    }
+
     void prune() {
-        auto it = elements.begin();
-        int num_save = 0;
-        while (it != elements.end() && num_save < width) {
-            //std::cout << "Keeping... " << (*it)->last_probability() << "\n";
+        std::set<T, F> ordered(elements.begin(), elements.end());
+        elements.clear();
+        auto it = ordered.begin();
+        while (it != ordered.end() && elements.size() < width) {
+            elements.push_back(*it);
             it++;
-            num_save++;
         }
-        elements.erase(it, elements.end());
     }
 
     T top() {
-      return *elements.begin();
+      return elements[0];
     }
 
 };
 
-template <class T>
+template <class T, class F>
 class Beam3 {
     /*
     CONTROL TEST FOR BENCHMARKING -- UNSORTED VECTOR
+    Keeps the first W candidates in insertion order (F is unused)
     */
   public:
     int width;
@@ -163,7 +268,7 @@ class Beam3 {
 
     void push(std::vector<T> n_vector) {
       for (int i=0; i < n_vector.size(); i++) {
-        elements.insert(n_vector[i]);
+        elements.push_back(n_vector[i]);
       }
     }
 
@@ -171,19 +276,18 @@ class Beam3 {
       return elements.size();
     }
 
+    void clear() {
+      elements.clear();
+    }
+
     void prune() {
-        auto it = elements.begin();
-        int num_save = 0;
-        while (it != elements.end() && num_save < width) {
-            //std::cout << "Keeping... " << (*it)->last_probability() << "\n";
-            it++;
-            num_save++;
+        if (elements.size() > width) {
+          elements.erase(elements.begin()+width, elements.end());
         }
-        elements.erase(it, elements.end());
     }
 
     T top() {
-      return *elements.begin();
+      return elements[0];
     }
 
 };
@@ -9,57 +9,142 @@
 #include <limits>
 #include <functional>
 #include <cmath>
+#include <numeric>
 
 #include "Log.h"
 #include "Beam.h"
 #include "BeamSearch2.h"
 #include "PrefixTree.h"
+#include "ThreadPool.h"
+
+// Beam search over frames that arrive in chunks. Each push() returns the part
+// of the label that every hypothesis in the beam agrees on, and the tree is
+// rerooted below it so memory stays bounded by the beam rather than by the
+// length of the read.
+template <class T>
+class BeamSearchStreamBase {
+  public:
+    virtual ~BeamSearchStreamBase() {}
+    virtual std::string push(ArrayView<T> y, int n) = 0;
+    virtual std::string finish() = 0;
+};
 
 template <class TTree, class TBeam>
-std::string beam_search_(double **y, int t_max, std::string alphabet, int beam_width) {
+class BeamSearchStream : public BeamSearchStreamBase<typename TTree::scalar_type> {
+  public:
+    typedef typename TTree::node_type node_type;
+    typedef typename TTree::scalar_type scalar_type;
+
+    TTree tree;
+    TBeam beam_;
+    // number of frames decoded so far
+    int t = 0;
+    // deepest node whose label has been returned
+    node_type *committed;
+
+    BeamSearchStream(std::string alphabet, int beam_width) : tree(ArrayView<scalar_type>(), 0, alphabet), beam_(beam_width) {
+      committed = tree.root;
+    }
 
-  TTree tree(y, t_max, alphabet);
-  TBeam beam_(beam_width);
+    // decode the next n frames
+    void advance(ArrayView<scalar_type> y, int n) {
+      tree.y = y;
+      tree.frame_offset = t;
+      for (int t_end = t + n; t < t_end; t++) {
+        tree.update_root(t);
+
+        // first iteration
+        if (t == 0) {
+          auto children = tree.expand(tree.root);
+          for (int i=0; i<children.size(); i++) {
+            auto n = children[i];
+            tree.update_prob(n, 0);
+            beam_.push(n);
+          }
+          continue;
+        }
 
-  // first iteration
-  auto children = tree.expand(tree.root);
-  for (int i=0; i<children.size(); i++) {
-    auto n = children[i];
-    tree.update_prob(n, 0);
-    beam_.push(n);
-  }
+        // iterate over each node in beam
+        int beam_size = beam_.size();
+        for (int b=0; b < beam_size; b++) {
+          auto beam_node = beam_.elements[b];
+
+          // update probabilities
+          tree.update_prob(beam_node, t);
+
+          // expand node and add children to the beam
+          auto children = tree.expand(beam_node);
+          for (int i=0; i<children.size(); i++) {
+            auto child = children[i];
+            tree.update_prob(child, t);
+            beam_.push(child);
+          }
+        }
 
-  // iterate over each node in beam
-  for (int t=1; t < t_max; t++) {
-    int beam_size = beam_.size();
-    for (int b=0; b < beam_size; b++) {
-      auto beam_node = beam_.elements[b];
-
-      // update probabilities
-      tree.update_prob(beam_node, t);
-
-      // expand node and add children to the beam
-      auto children = tree.expand(beam_node);
-      for (int i=0; i<children.size(); i++) {
-        auto child = children[i];
-        tree.update_prob(child, t);
-        beam_.push(child);
+        // take top beam_width nodes
+        beam_.prune();
+        tree.reclaim(beam_.elements);
       }
     }
 
-    // take top beam_width nodes
-    beam_.prune();
+    // return the label of the common ancestor of the beam since the last commit
+    std::string commit() {
+      if (beam_.size() == 0) {
+        return "";
+      }
+      node_type *lca = beam_.elements[0];
+      for (int b=1; b < beam_.size(); b++) {
+        node_type *n = beam_.elements[b];
+        while (n->depth > lca->depth) {
+          n = n->parent;
+        }
+        while (lca->depth > n->depth) {
+          lca = lca->parent;
+        }
+        while (n != lca) {
+          n = n->parent;
+          lca = lca->parent;
+        }
+      }
+      if (lca == committed) {
+        return "";
+      }
+      std::string label = tree.get_label(lca, committed);
+      committed = lca;
+
+      // the next frame still reads the parent of lca if it was in the beam
+      if (lca->parent->max_t < t-1) {
+        tree.reroot(lca);
+      } else {
+        tree.reroot(lca->parent);
+      }
+      return label;
+    }
 
-  }
+    std::string push(ArrayView<scalar_type> y, int n) {
+      advance(y, n);
+      return commit();
+    }
 
-  // return top element
-  auto top_node = beam_.top();
-  return tree.get_label(top_node);
+    // return the rest of the label of the top element
+    std::string finish() {
+      if (t == 0) {
+        return "";
+      }
+      return tree.get_label(beam_.top(), committed);
+    }
+};
+
+template <class TTree, class TBeam>
+std::string beam_search_(typename TTree::trace_type y, int t_max, std::string alphabet, int beam_width) {
+  BeamSearchStream<TTree, TBeam> stream(alphabet, beam_width);
+  stream.advance(y, t_max);
+  return stream.finish();
 }
 
 // update beam after each move, still testing
 template <class TTree, class TBeam>
-std::string beam_search_2d_by_node(double **y1, double **y2, int **envelope_ranges, int U, int V, std::string alphabet, int beam_width) {
+std::string beam_search_2d_by_node(typename TTree::trace_type y1, typename TTree::trace_type y2, ArrayView<int> envelope_ranges, int U, int V, std::string alphabet, int beam_width) {
 
   TTree tree(y1, U, y2, V, alphabet);
   TBeam beam_(beam_width);
@@ -73,10 +158,13 @@ std::string beam_search_2d_by_node(double **y1, double **y2, int **envelope_rang
     beam_.push(n);
   }
 
+  auto window_floors = envelope_window_floors(envelope_ranges, U);
+
   for (int u=0; u<U; ++u) {
       std::cout << "Starting row " << u << "/" << U << "\n";
     int row_start = envelope_ranges[u][0];
     int row_end = envelope_ranges[u][1];
+    tree.set_window_floor(window_floors[u]);
     for (int v=row_start; v<row_end; ++v) {
 
       for (int b=0; b < beam_width; ++b) {
@@ -98,6 +186,7 @@ std::string beam_search_2d_by_node(double **y1, double **y2, int **envelope_rang
 
       // take top beam_width nodes
       beam_.prune();
+      tree.reclaim(beam_.elements);
 
       }
     }
@@ -108,7 +197,7 @@ std::string beam_search_2d_by_node(double **y1, double **y2, int **envelope_rang
 }
 
 template <class TTree, class TBeam>
-std::string beam_search_2d_by_row(double **y1, double **y2, int **envelope_ranges, int U, int V, std::string alphabet, int beam_width) {
+std::string beam_search_2d_by_row(typename TTree::trace_type y1, typename TTree::trace_type y2, ArrayView<int> envelope_ranges, int U, int V, std::string alphabet, int beam_width) {
 
     TTree tree(y1, U, y2, V, alphabet);
     TBeam beam_(beam_width);
@@ -124,10 +213,13 @@ std::string beam_search_2d_by_row(double **y1, double **y2, int **envelope_range
 
     //std::cout << "u" << "\t" << "v_start" << "\t" << "v_end" << "\t" << "top_node" << "\t" << "max_probability" << "\t" << "max_t" << "\t" << "length"<< "\n";
 
+    auto window_floors = envelope_window_floors(envelope_ranges, U);
+
     for (int u=0; u<U; ++u) {
         // std::cout << "Starting row " << u << "/" << U << "\n";
         int row_start = envelope_ranges[u][0];
         int row_end = envelope_ranges[u][1];
+        tree.set_window_floor(window_floors[u]);
 
         for (int b=0; b < beam_width; ++b) {
 
@@ -157,6 +249,7 @@ std::string beam_search_2d_by_row(double **y1, double **y2, int **envelope_range
 
         // take top beam_width nodes
         beam_.prune();
+        tree.reclaim(beam_.elements);
 
         // just output statistics from top node
         auto top_node_ = beam_.top();
@@ -173,7 +266,7 @@ return tree.get_label(top_node);
 
 // overloaded without alignment envelope
 template <class TTree, class TBeam>
-std::string beam_search_2d_by_row(double **y1, double **y2, int U, int V, std::string alphabet, int beam_width) {
+std::string beam_search_2d_by_row(typename TTree::trace_type y1, typename TTree::trace_type y2, int U, int V, std::string alphabet, int beam_width) {
 
     TTree tree(y1, U, y2, V, alphabet);
     TBeam beam_(beam_width);
@@ -224,6 +317,7 @@ std::string beam_search_2d_by_row(double **y1, double **y2, int U, int V, std::s
 
         // take top beam_width nodes
         beam_.prune();
+        tree.reclaim(beam_.elements);
 
         // write out beam
         /*
@@ -254,57 +348,150 @@ return tree.get_label(top_node);
 
 }
 
+// Beam implementations are selected by name: "hash" (HashBeam, default),
+// "sort" (Beam), "set" (Beam2) or "unsorted" (Beam3, control for benchmarking)
+template <class TTree, class TNode>
+std::string beam_search_1d(typename TTree::trace_type y, int t_max, std::string alphabet, int beam_width, std::string beam) {
+    typedef node_greater<TNode*> F;
+    if (beam == "sort") {
+        return beam_search_<TTree, Beam<TNode*, F>>(y, t_max, alphabet, beam_width);
+    } else if (beam == "set") {
+        return beam_search_<TTree, Beam2<TNode*, F>>(y, t_max, alphabet, beam_width);
+    } else if (beam == "unsorted") {
+        return beam_search_<TTree, Beam3<TNode*, F>>(y, t_max, alphabet, beam_width);
+    } else {
+        return beam_search_<TTree, HashBeam<TNode*, F>>(y, t_max, alphabet, beam_width);
+    }
+}
+
+template <class TTree, class TNode>
+BeamSearchStreamBase<typename TTree::scalar_type>* beam_search_stream_1d(std::string alphabet, int beam_width, std::string beam) {
+    typedef node_greater<TNode*> F;
+    if (beam == "sort") {
+        return new BeamSearchStream<TTree, Beam<TNode*, F>>(alphabet, beam_width);
+    } else if (beam == "set") {
+        return new BeamSearchStream<TTree, Beam2<TNode*, F>>(alphabet, beam_width);
+    } else if (beam == "unsorted") {
+        return new BeamSearchStream<TTree, Beam3<TNode*, F>>(alphabet, beam_width);
+    } else {
+        return new BeamSearchStream<TTree, HashBeam<TNode*, F>>(alphabet, beam_width);
+    }
+}
+
+// envelope_ranges is empty when searching the full U x V grid
+template <class TTree, class TBeam>
+std::string beam_search_2d_row(typename TTree::trace_type y1, typename TTree::trace_type y2, ArrayView<int> envelope_ranges, int U, int V, std::string alphabet, int beam_width) {
+    if (envelope_ranges) {
+        return beam_search_2d_by_row<TTree, TBeam>(y1, y2, envelope_ranges, U, V, alphabet, beam_width);
+    } else {
+        return beam_search_2d_by_row<TTree, TBeam>(y1, y2, U, V, alphabet, beam_width);
+    }
+}
+
+template <class TTree, class TBeam>
+std::string beam_search_2d_grid_(typename TTree::trace_type y1, typename TTree::trace_type y2, ArrayView<int> envelope_ranges, int U, int V, std::string alphabet, int beam_width) {
+    if (envelope_ranges) {
+        return beam_search_2d_grid<TTree, TBeam>(y1, y2, envelope_ranges, U, V, alphabet, beam_width);
+    } else {
+        return beam_search_2d_grid<TTree, TBeam>(y1, y2, U, V, alphabet, beam_width);
+    }
+}
+
+// method "wavefront" is the grid search over anti-diagonals on threads, it
+// keeps its own per-cell beams so the beam type does not apply. Its result
+// does not depend on threads but can differ from "grid", which is serial.
+template <class TTree, class TNode>
+std::string beam_search_2d(typename TTree::trace_type y1, typename TTree::trace_type y2, ArrayView<int> envelope_ranges, int U, int V, std::string alphabet, int beam_width, std::string method, std::string beam, int threads) {
+    if (method == "wavefront") {
+        return beam_search_2d_wavefront<TTree>(y1, y2, envelope_ranges, U, V, alphabet, beam_width, threads);
+    } else if (method == "row") {
+        typedef node_greater_max<TNode*> F;
+        if (beam == "sort") {
+            return beam_search_2d_row<TTree, Beam<TNode*, F>>(y1, y2, envelope_ranges, U, V, alphabet, beam_width);
+        } else if (beam == "set") {
+            return beam_search_2d_row<TTree, Beam2<TNode*, F>>(y1, y2, envelope_ranges, U, V, alphabet, beam_width);
+        } else if (beam == "unsorted") {
+            return beam_search_2d_row<TTree, Beam3<TNode*, F>>(y1, y2, envelope_ranges, U, V, alphabet, beam_width);
+        } else {
+            return beam_search_2d_row<TTree, HashBeam<TNode*, F>>(y1, y2, envelope_ranges, U, V, alphabet, beam_width);
+        }
+    } else {
+        typedef node_greater<TNode*> F;
+        if (beam == "sort") {
+            return beam_search_2d_grid_<TTree, Beam<TNode*, F>>(y1, y2, envelope_ranges, U, V, alphabet, beam_width);
+        } else if (beam == "set") {
+            return beam_search_2d_grid_<TTree, Beam2<TNode*, F>>(y1, y2, envelope_ranges, U, V, alphabet, beam_width);
+        } else if (beam == "unsorted") {
+            return beam_search_2d_grid_<TTree, Beam3<TNode*, F>>(y1, y2, envelope_ranges, U, V, alphabet, beam_width);
+        } else {
+            return beam_search_2d_grid_<TTree, HashBeam<TNode*, F>>(y1, y2, envelope_ranges, U, V, alphabet, beam_width);
+        }
+    }
+}
+
 // beam search on single read
-std::string beam_search(double **y, int t_max, std::string alphabet, int beam_width, std::string model="ctc") {
+template <class T>
+std::string beam_search(ArrayView<T> y, int t_max, std::string alphabet, int beam_width, std::string model="ctc", std::string beam="hash") {
     if (model == "ctc") {
-        return beam_search_<PoreOverPrefixTree, Beam<PoreOverNode*, node_greater<PoreOverNode*>>>(y, t_max, alphabet, beam_width);
+        return beam_search_1d<PoreOverPrefixTree<T>, PoreOverNode>(y, t_max, alphabet, beam_width, beam);
     } else if (model == "ctc_merge_repeats") {
-        return beam_search_<BonitoPrefixTree, Beam<BonitoNode*, node_greater<BonitoNode*>>>(y, t_max, alphabet, beam_width);
+        return beam_search_1d<BonitoPrefixTree<T>, BonitoNode>(y, t_max, alphabet, beam_width, beam);
     } else if (model == "ctc_flipflop") {
-        return beam_search_<FlipFlopPrefixTree, Beam<FlipFlopNode*, node_greater<FlipFlopNode*>>>(y, t_max, alphabet, beam_width);
+        return beam_search_1d<FlipFlopPrefixTree<T>, FlipFlopNode>(y, t_max, alphabet, beam_width, beam);
     }
 }
 
-// pair beam search with envelope
-std::string beam_search(double **y1, double **y2, int U, int V, std::string alphabet, int **envelope_ranges, int beam_width, std::string model="ctc", std::string method="row") {
-    if (method == "row") {
-        if (model == "ctc") {
-            return beam_search_2d_by_row<PoreOverPrefixTree2D, Beam<PoreOverNode2D*, node_greater_max<PoreOverNode2D*>>>(y1, y2, envelope_ranges, U, V, alphabet, beam_width);
-        } else if (model == "ctc_merge_repeats") {
-            return beam_search_2d_by_row<BonitoPrefixTree2D, Beam<BonitoNode2D*, node_greater_max<BonitoNode2D*>>>(y1, y2, envelope_ranges, U, V, alphabet, beam_width);
-        } else if (model == "ctc_flipflop") {
-            return beam_search_2d_by_row<FlipFlopPrefixTree2D, Beam<FlipFlopNode2D*, node_greater_max<FlipFlopNode2D*>>>(y1, y2, envelope_ranges, U, V, alphabet, beam_width);
-        }
+// beam search on reads concatenated in y, read i spans frames offsets[i] to
+// offsets[i+1]. The reads are shared out to a pool of threads longest first,
+// so that a long read is not left to run alone at the end.
+template <class T>
+std::vector<std::string> beam_search_batch(ArrayView<T> y, std::vector<long> offsets, std::string alphabet, int beam_width, std::string model="ctc", std::string beam="hash", int threads=1) {
+    int reads = std::max<int>(offsets.size(), 1) - 1;
+    std::vector<std::string> sequences(reads);
+
+    std::vector<int> order(reads);
+    std::iota(order.begin(), order.end(), 0);
+    std::stable_sort(order.begin(), order.end(), [&](int a, int b) {
+        return offsets[a+1] - offsets[a] > offsets[b+1] - offsets[b];
+    });
+
+    ThreadPool workers(std::max(std::min(threads, reads), 1));
+    workers.parallel_for(reads, [&](int i) {
+        int r = order[i];
+        ArrayView<T> read(y.data + offsets[r]*y.row_stride, y.row_stride, y.columns);
+        sequences[r] = beam_search(read, offsets[r+1]-offsets[r], alphabet, beam_width, model, beam);
+    });
+    return sequences;
+}
+
+// streaming beam search on single read, caller owns the returned object
+template <class T>
+BeamSearchStreamBase<T>* beam_search_stream(std::string alphabet, int beam_width, std::string model="ctc", std::string beam="hash") {
+    if (model == "ctc_merge_repeats") {
+        return beam_search_stream_1d<BonitoPrefixTree<T>, BonitoNode>(alphabet, beam_width, beam);
+    } else if (model == "ctc_flipflop") {
+        return beam_search_stream_1d<FlipFlopPrefixTree<T>, FlipFlopNode>(alphabet, beam_width, beam);
     } else {
-        if (model == "ctc") {
-            return beam_search_2d_grid<PoreOverPrefixTree2D, Beam<PoreOverNode2D*, node_greater<PoreOverNode2D*>>>(y1, y2, envelope_ranges, U, V, alphabet, beam_width);
-        } else if (model == "ctc_merge_repeats") {
-            return beam_search_2d_grid<BonitoPrefixTree2D, Beam<BonitoNode2D*, node_greater<BonitoNode2D*>>>(y1, y2, envelope_ranges, U, V, alphabet, beam_width);
-        } else if (model == "ctc_flipflop") {
-            return beam_search_2d_grid<FlipFlopPrefixTree2D, Beam<FlipFlopNode2D*, node_greater<FlipFlopNode2D*>>>(y1, y2, envelope_ranges, U, V, alphabet, beam_width);
-        }
+        return beam_search_stream_1d<PoreOverPrefixTree<T>, PoreOverNode>(alphabet, beam_width, beam);
     }
 }
 
-// pair beam search without envelope
-std::string beam_search(double **y1, double **y2, int U, int V, std::string alphabet, int beam_width, std::string model="ctc", std::string method="row") {
-    if (method == "row") {
-        if (model == "ctc") {
-            return beam_search_2d_by_row<PoreOverPrefixTree2D, Beam<PoreOverNode2D*, node_greater_max<PoreOverNode2D*>>>(y1, y2, U, V, alphabet, beam_width);
-        } else if (model == "ctc_merge_repeats") {
-            return beam_search_2d_by_row<BonitoPrefixTree2D, Beam<BonitoNode2D*, node_greater_max<BonitoNode2D*>>>(y1, y2, U, V, alphabet, beam_width);
-        } else if (model == "ctc_flipflop") {
-            return beam_search_2d_by_row<FlipFlopPrefixTree2D, Beam<FlipFlopNode2D*, node_greater_max<FlipFlopNode2D*>>>(y1, y2, U, V, alphabet, beam_width);
-        }
-    } else {
-        if (model == "ctc") {
-            return beam_search_2d_grid<PoreOverPrefixTree2D, Beam<PoreOverNode2D*, node_greater<PoreOverNode2D*>>>(y1, y2, U, V, alphabet, beam_width);
-        } else if (model == "ctc_merge_repeats") {
-            return beam_search_2d_grid<BonitoPrefixTree2D, Beam<BonitoNode2D*, node_greater<BonitoNode2D*>>>(y1, y2, U, V, alphabet, beam_width);
-        } else if (model == "ctc_flipflop") {
-            return beam_search_2d_grid<FlipFlopPrefixTree2D, Beam<FlipFlopNode2D*, node_greater<FlipFlopNode2D*>>>(y1, y2, U, V, alphabet, beam_width);
-        }
+// pair beam search with envelope
+template <class T>
+std::string beam_search(ArrayView<T> y1, ArrayView<T> y2, int U, int V, std::string alphabet, ArrayView<int> envelope_ranges, int beam_width, std::string model="ctc", std::string method="row", std::string beam="hash", int threads=1) {
+    if (model == "ctc") {
+        return beam_search_2d<PoreOverPrefixTree2D<T>, PoreOverNode2D>(y1, y2, envelope_ranges, U, V, alphabet, beam_width, method, beam, threads);
+    } else if (model == "ctc_merge_repeats") {
+        return beam_search_2d<BonitoPrefixTree2D<T>, BonitoNode2D>(y1, y2, envelope_ranges, U, V, alphabet, beam_width, method, beam, threads);
+    } else if (model == "ctc_flipflop") {
+        return beam_search_2d<FlipFlopPrefixTree2D<T>, FlipFlopNode2D>(y1, y2, envelope_ranges, U, V, alphabet, beam_width, method, beam, threads);
     }
 }
 
+// pair beam search without envelope
+template <class T>
+std::string beam_search(ArrayView<T> y1, ArrayView<T> y2, int U, int V, std::string alphabet, int beam_width, std::string model="ctc", std::string method="row", std::string beam="hash", int threads=1) {
+    return beam_search<T>(y1, y2, U, V, alphabet, ArrayView<int>(), beam_width, model, method, beam, threads);
+}
+
 #endif
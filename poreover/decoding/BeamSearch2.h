@@ -7,9 +7,10 @@ Options: model(ctc, ctc_merge_repeats, ctc_flipflop) x envelope(True, False) x m
 
 Overloading in C++ or Cython file? Model needs to live in C++, so also envelope and method
 
-beam_search_2d() : envelope, model, method "row" or "grid"
+beam_search_2d() : envelope, model, method "row", "grid" or "wavefront"
 beam_search_2d_row: single beam, faster "1.5D" search
 beam_search_2d_grid: 2D beam data, prune after each (i,j) step
+beam_search_2d_wavefront: grid search over anti-diagonals on a thread pool
 */
 
 #ifndef TEST_HPP
@@ -24,47 +25,83 @@ beam_search_2d_grid: 2D beam data, prune after each (i,j) step
 #include<set>
 #include <functional>
 #include <cmath>
+#include <cstdint>
 
 #include "Log.h"
-#include "SparseMatrix.h"
+#include "BandedMatrix.h"
 #include "PrefixTree.h"
 #include "Beam.h"
+#include "ThreadPool.h"
+
+// Beams of one envelope row. Cell (u,v) only reads (u-1,v-1), so the grid
+// searches keep two rows and recycle their beams instead of allocating one
+// per cell.
+template <class TBeam>
+class BeamRow {
+  public:
+    int start = 0;
+    int end = 0;
+    std::vector<TBeam> beams;
+
+    void reset(int row_start, int row_end, int beam_width) {
+      start = row_start;
+      end = row_end;
+      while (beams.size() < end - start) {
+        beams.emplace_back(beam_width);
+      }
+      for (int i=0; i < end - start; ++i) {
+        beams[i].clear();
+      }
+    }
+
+    // nullptr outside the row
+    TBeam* get(int v) {
+      if (v < start || v >= end) {
+        return nullptr;
+      }
+      return &beams[v-start];
+    }
+};
 
 template <class TTree, class TBeam>
-std::string beam_search_2d_grid(double **y1, double **y2, int U, int V, std::string alphabet, int beam_width) {
+std::string beam_search_2d_grid(typename TTree::trace_type y1, typename TTree::trace_type y2, ArrayView<int> envelope_ranges, int U, int V, std::string alphabet, int beam_width) {
 
   TTree tree(y1, U, y2, V, alphabet);
 
-  TBeam* empty_beam = new TBeam(beam_width);
-  //empty_beam->push(tree.root);
+  TBeam empty_beam(beam_width);
+  //empty_beam.push(tree.root);
   auto children = tree.expand(tree.root);
   for (int i=0; i<children.size(); i++) {
       auto n = children[i];
       tree.update_prob(n, 0, 0);
       tree.update_prob(n, 1, 0);
-      empty_beam->push(n);
+      empty_beam.push(n);
   }
 
-  //SparseMatrix<TBeam> beams(empty_beam);
-  std::vector<TBeam*> beams;
+  BeamRow<TBeam> prev_row;
+  BeamRow<TBeam> this_row;
+  auto window_floors = envelope_window_floors(envelope_ranges, U);
+  std::vector<typename TTree::node_type*> row_nodes;
 
   for (int u=0; u<U; ++u) {
-    for (int v=0; v<V; ++v) {
-      //std::cout << "u:" << u << "\tv:" << v << "index:"<< u*V+v<< "-------------------------------\n";
 
-      TBeam* this_beam = new TBeam(beam_width);
-      beams.push_back(this_beam);
+    int row_start = envelope_ranges[u][0];
+    int row_end = envelope_ranges[u][1];
+    tree.set_window_floor(window_floors[u]);
+    this_row.reset(row_start, row_end, beam_width);
+
+    for (int v=row_start; v<row_end; ++v) {
+      //std::cout << "u:" << u << "\tv:" << v << "-------------------------------\n";
+
+      TBeam* this_beam = this_row.get(v);
 
-      TBeam* prev_beam;
+      TBeam* prev_beam = nullptr;
       if (u > 0 && v > 0) {
-        prev_beam = beams[(u-1)*V+(v-1)];
-        //std::cout << "Previous beam is :" << "(" << (u-1) << "," << (v-1) << ")" << "\n";
-      } else {
-        prev_beam = empty_beam;
-        //std::cout << "Previous beam is : root\n";
+        prev_beam = prev_row.get(v-1);
+      }
+      if (!prev_beam) {
+        prev_beam = &empty_beam;
       }
-      //std::cout << "Beam_size:" << prev_beam->size() << "\n";
-      //std::cout << "Iterating over previous beam...\n";
 
       for (auto beam_node : prev_beam->elements) {
             //std::cout << "label:" << tree.get_label(beam_node) << "\n";
@@ -88,7 +125,6 @@ std::string beam_search_2d_grid(double **y1, double **y2, int U, int V, std::str
         /*
         // write out current beam after pruning
         std::cout << "Beam before pruning:\n";
-        //for (auto beam_node=this_beam->elements.rbegin(); beam_node != this_beam->elements.rend(); beam_node++) {
         for (auto beam_node : this_beam->elements) {
         std::cout << "----" << tree.get_label(beam_node) << " : "
         << (beam_node)->last_probability() << "\n";
@@ -97,90 +133,247 @@ std::string beam_search_2d_grid(double **y1, double **y2, int U, int V, std::str
 
         this_beam->prune();
 
-        /*
-        // write out current beam after pruning
-        std::cout << "Beam after pruning:\n";
-        //for (auto beam_node=this_beam->elements.rbegin(); beam_node != this_beam->elements.rend(); beam_node++) {
-        for (auto beam_node : this_beam->elements) {
-        std::cout << "----" << tree.get_label(beam_node) << " : "
-        << (beam_node)->last_probability() << "\n";
-        }
-
-        std::cout << "-----------------\n";
-        */
+      }
 
+      // only this row's beams (and the initial beam) are read from now on,
+      // and cells only extend their previous beam by one level
+      row_nodes = empty_beam.elements;
+      for (int v=row_start; v<row_end; ++v) {
+        auto& elements = this_row.get(v)->elements;
+        row_nodes.insert(row_nodes.end(), elements.begin(), elements.end());
       }
+      tree.reclaim(row_nodes, 1);
+
+      std::swap(prev_row, this_row);
   }
 
   // return top element
-  auto top_node = beams[(U-1)*V+(V-1)]->top();
-  return tree.get_label(top_node);
+  TBeam* last_beam = prev_row.get(V-1);
+  if (!last_beam) {
+    last_beam = &empty_beam;
+  }
+  return tree.get_label(last_beam->top());
 
 }
 
 template <class TTree, class TBeam>
-std::string beam_search_2d_grid(double **y1, double **y2, int **envelope_ranges, int U, int V, std::string alphabet, int beam_width) {
+std::string beam_search_2d_grid(typename TTree::trace_type y1, typename TTree::trace_type y2, int U, int V, std::string alphabet, int beam_width) {
+  // a row stride of 0 repeats the same row for every u
+  int full_row[2] = {0, V};
+  const std::ptrdiff_t columns[2] = {0, 1};
+  return beam_search_2d_grid<TTree, TBeam>(y1, y2, ArrayView<int>(full_row, 0, columns), U, V, alphabet, beam_width);
+}
+
+// Candidate node of one grid cell with its probabilities along each read.
+// Cells score candidates from these values rather than the node fields, since
+// the same node can be a candidate in several cells of a wavefront.
+template <class TNode>
+struct GridCandidate {
+  TNode node;
+  ReadProbability p[2];
+  double score;
+};
+
+template <class TNode>
+struct GridCell {
+  int u;
+  std::vector<TNode> beam;
+  std::vector<GridCandidate<TNode>> candidates;
+};
+
+// cells of one anti-diagonal, index[u-u_min] is the cell of row u or -1
+template <class TNode>
+struct GridWavefront {
+  int u_min = 0;
+  std::vector<int> index;
+  std::vector<GridCell<TNode>> cells;
+
+  const std::vector<TNode>* beam_at(int u) const {
+    int i = u - u_min;
+    if (i < 0 || i >= index.size() || index[i] < 0) {
+      return nullptr;
+    }
+    return &cells[index[i]].beam;
+  }
+};
+
+// Grid search processed in anti-diagonal wavefronts. Cell (u,v) only extends
+// the beam of (u-1,v-1), so the cells of an anti-diagonal are independent
+// apart from the probabilities they store in shared tree nodes. Each
+// wavefront is done in three steps:
+//   1. expand the previous beams (serial, the only step that adds nodes)
+//   2. compute and prune the candidates of every cell (parallel, read only)
+//   3. store the candidate probabilities in the tree (parallel, each thread
+//      owns a fixed subset of the nodes)
+// Cells therefore see the tree as it was after the previous wavefront, and
+// the result does not depend on the number of threads. It can differ from
+// beam_search_2d_grid, where a cell also sees earlier cells of its own row.
+// envelope_ranges is empty when searching the full U x V grid.
+template <class TTree>
+std::string beam_search_2d_wavefront(typename TTree::trace_type y1, typename TTree::trace_type y2, ArrayView<int> envelope_ranges, int U, int V, std::string alphabet, int beam_width, int threads) {
+  typedef typename TTree::node_type* TNode;
 
   TTree tree(y1, U, y2, V, alphabet);
+  ThreadPool workers(threads);
+  int shards = workers.size();
+
+  std::vector<int> row_start(U, 0);
+  std::vector<int> row_end(U, V);
+  if (envelope_ranges) {
+    for (int u=0; u<U; ++u) {
+      row_start[u] = envelope_ranges[u][0];
+      row_end[u] = envelope_ranges[u][1];
+    }
+  }
 
-  TBeam* empty_beam = new TBeam(beam_width);
-  //empty_beam->push(tree.root);
+  std::vector<TNode> empty_beam;
   auto children = tree.expand(tree.root);
   for (int i=0; i<children.size(); i++) {
       auto n = children[i];
       tree.update_prob(n, 0, 0);
       tree.update_prob(n, 1, 0);
-      empty_beam->push(n);
+      empty_beam.push_back(n);
   }
 
-  SparseMatrix<TBeam*> beams(empty_beam);
-
+  // earliest time step along each read that wavefront d or a later one reads
+  int D = U + V - 1;
+  std::vector<int> floor_u(D+1, std::numeric_limits<int>::max());
+  std::vector<int> floor_v(D+1, std::numeric_limits<int>::max());
   for (int u=0; u<U; ++u) {
+    for (int v=row_start[u]; v<row_end[u]; ++v) {
+      floor_u[u+v] = std::min(floor_u[u+v], u-1);
+      floor_v[u+v] = std::min(floor_v[u+v], v-1);
+    }
+  }
+  for (int d=D-1; d>=0; --d) {
+    floor_u[d] = std::min(floor_u[d], floor_u[d+1]);
+    floor_v[d] = std::min(floor_v[d], floor_v[d+1]);
+  }
 
-    int row_start = envelope_ranges[u][0];
-    int row_end = envelope_ranges[u][1];
-    beams.push_row(row_start, row_end);
-
-    for (int v=row_start; v<row_end; ++v) {
-
-      TBeam* this_beam = new TBeam(beam_width);
-      beams.set(u, v, this_beam);
-
-      TBeam* prev_beam;
-      if (u > 0 && v > 0) {
-        prev_beam = beams.get(u-1,v-1);
-      } else {
-        prev_beam = empty_beam;
+  // wavefronts d-2 (read), d-1 (kept for the next wavefront) and d
+  std::vector<GridWavefront<TNode>> fronts(3);
+  std::vector<TNode> live_nodes;
+
+  for (int d=0; d<D; ++d) {
+    GridWavefront<TNode>& front = fronts[d % 3];
+    const GridWavefront<TNode>& prev_front = fronts[(d+1) % 3];
+
+    int u_min = std::max(0, d-V+1);
+    int u_max = std::min(U-1, d);
+    front.u_min = u_min;
+    front.index.assign(std::max(0, u_max-u_min+1), -1);
+    int cell_count = 0;
+    for (int u=u_min; u<=u_max; ++u) {
+      int v = d - u;
+      if (v >= row_start[u] && v < row_end[u]) {
+        if (front.cells.size() <= cell_count) {
+          front.cells.emplace_back();
+        }
+        front.cells[cell_count].u = u;
+        front.index[u-u_min] = cell_count++;
       }
+    }
 
-      for (auto beam_node : prev_beam->elements) {
-            //std::cout << "label:" << tree.get_label(beam_node) << "\n";
-
-            // update probabilities
-            tree.update_prob(beam_node, 0, u);
-            tree.update_prob(beam_node, 1, v);
-            this_beam->push(beam_node);
-
-            // expand node and add children to the beam
-            auto children = tree.expand(beam_node);
-            for (int i=0; i < children.size(); i++) {
-              auto child = children[i];
-              //std::cout << "Adding child:"<< tree.get_label(child) << "\n";
-              tree.update_prob(child, 0, u);
-              tree.update_prob(child, 1, v);
-              this_beam->push(child);
-            }
+    auto prev_beam = [&](int u, int v) -> const std::vector<TNode>& {
+      const std::vector<TNode>* beam = nullptr;
+      if (u > 0 && v > 0 && d >= 2) {
+        beam = prev_front.beam_at(u-1);
+      }
+      return beam ? *beam : empty_beam;
+    };
+
+    // 1. expand nodes of the previous beams
+    for (int c=0; c<cell_count; ++c) {
+      int u = front.cells[c].u;
+      for (auto beam_node : prev_beam(u, d-u)) {
+        tree.expand(beam_node);
+      }
+    }
+
+    // 2. evaluate and prune candidates of each cell
+    workers.parallel_for(cell_count, [&](int c) {
+      GridCell<TNode>& cell = front.cells[c];
+      int u = cell.u;
+      int v = d - u;
+
+      std::vector<TNode> nodes;
+      for (auto beam_node : prev_beam(u, v)) {
+        nodes.push_back(beam_node);
+        for (auto child : beam_node->children) {
+          if (child) {
+            nodes.push_back(child);
+          }
         }
+      }
+      std::sort(nodes.begin(), nodes.end());
+      nodes.erase(std::unique(nodes.begin(), nodes.end()), nodes.end());
+
+      cell.candidates.clear();
+      for (auto n : nodes) {
+        GridCandidate<TNode> candidate;
+        candidate.node = n;
+        candidate.p[0] = tree.compute_prob(n, 0, u);
+        candidate.p[1] = tree.compute_prob(n, 1, v);
+        candidate.score = candidate.p[0].probability + candidate.p[1].probability;
+        cell.candidates.push_back(candidate);
+      }
 
-        this_beam->prune();
-
+      std::vector<int> order(cell.candidates.size());
+      for (int i=0; i<order.size(); ++i) {
+        order[i] = i;
+      }
+      // ties keep the node order so that the beam is deterministic
+      auto greater = [&](int a, int b) {
+        double score_a = cell.candidates[a].score;
+        double score_b = cell.candidates[b].score;
+        return (score_a > score_b) || (score_a == score_b && a < b);
+      };
+      int keep = std::min<int>(beam_width, order.size());
+      std::partial_sort(order.begin(), order.begin()+keep, order.end(), greater);
+      cell.beam.clear();
+      for (int i=0; i<keep; ++i) {
+        cell.beam.push_back(cell.candidates[order[i]].node);
+      }
+    });
+
+    // 3. store probabilities, nodes are split between threads by address
+    workers.parallel_for(shards, [&](int shard) {
+      for (int c=0; c<cell_count; ++c) {
+        const GridCell<TNode>& cell = front.cells[c];
+        int u = cell.u;
+        int v = d - u;
+        for (const auto& candidate : cell.candidates) {
+          if ((reinterpret_cast<std::uintptr_t>(candidate.node) / sizeof(*candidate.node)) % shards != shard) {
+            continue;
+          }
+          tree.store_prob(candidate.node, 0, u, candidate.p[0], floor_u[d]);
+          tree.store_prob(candidate.node, 1, v, candidate.p[1], floor_v[d]);
+        }
       }
+    });
+
+    // wavefronts d-1 and d are read by the next two wavefronts. Cells only
+    // read their previous beam and its children, and keeping whole subtrees
+    // would keep the entire tree alive through the shallow initial beam.
+    live_nodes = empty_beam;
+    for (int f : {d % 3, (d+2) % 3}) {
+      const GridWavefront<TNode>& live_front = fronts[f];
+      for (int i : live_front.index) {
+        if (i >= 0) {
+          auto& beam = live_front.cells[i].beam;
+          live_nodes.insert(live_nodes.end(), beam.begin(), beam.end());
+        }
+      }
+    }
+    tree.reclaim(live_nodes, 1);
   }
 
   // return top element
-  auto top_node = beams.get(U-1,V-1)->top();
-  return tree.get_label(top_node);
-
+  const std::vector<TNode>* last_beam = fronts[(D-1) % 3].beam_at(U-1);
+  if (!last_beam || last_beam->empty()) {
+    last_beam = &empty_beam;
+  }
+  return tree.get_label((*last_beam)[0]);
 }
 
 #endif
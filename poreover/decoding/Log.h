@@ -1,8 +1,10 @@
 #ifndef LOG_HPP
 #define LOG_HPP
 
+#include <string>
 #include <limits>
 #include <cmath>
+#include <algorithm>
 
 #define DEFAULT_VALUE -std::numeric_limits<double>::infinity()
 
@@ -14,12 +16,137 @@ double log_(double x) {
   }
 }
 
-double logaddexp(double x1, double x2) {
-  if (x1 >= x2) {
-    return(x1 + log_(1 + exp(x2-x1)));
+// Precision used by logaddexp and the batch kernels below. LOG_EXACT gives the
+// same results as calling exp and log directly, LOG_FAST interpolates
+// log(1+exp(-d)) from a table (absolute error below 2e-6).
+// The mode belongs to the calling thread, so threads decoding in parallel can
+// set it without racing. ThreadPool hands the mode of the caller to its
+// workers.
+enum LogMode {LOG_EXACT, LOG_FAST};
+
+thread_local LogMode log_mode = LOG_EXACT;
+
+void set_log_mode(std::string mode) {
+  if (mode == "fast") {
+    log_mode = LOG_FAST;
   } else {
-    return(x2 + log_(1 + exp(x1-x2)));
+    log_mode = LOG_EXACT;
+  }
+}
+
+// beyond this exp(-d) no longer changes 1+exp(-d) in double precision
+const double LOG1P_EXP_EXACT_CUTOFF = 37.;
+// beyond this log(1+exp(-d)) < 1.2e-7 and is dropped by the fast mode
+const double LOG1P_EXP_FAST_CUTOFF = 16.;
+const int LOG1P_EXP_TABLE_STEPS = 128;
+const int LOG1P_EXP_TABLE_SIZE = int(LOG1P_EXP_FAST_CUTOFF)*LOG1P_EXP_TABLE_STEPS + 2;
+
+// log(1+exp(-d)) sampled at d = i/LOG1P_EXP_TABLE_STEPS, 16KB so it stays in L1
+struct Log1pExpTable {
+  double values[LOG1P_EXP_TABLE_SIZE];
+
+  Log1pExpTable() {
+    for (int i=0; i<LOG1P_EXP_TABLE_SIZE; i++) {
+      values[i] = std::log1p(std::exp(-(double)i/LOG1P_EXP_TABLE_STEPS));
+    }
+  }
+};
+
+const Log1pExpTable log1p_exp_table;
+
+// log(1+exp(-d)) for d >= 0
+inline double log1p_exp_exact(double d) {
+  if (d > LOG1P_EXP_EXACT_CUTOFF) {
+    return 0;
+  }
+  return std::log(1 + std::exp(-d));
+}
+
+inline double log1p_exp_fast(double d) {
+  if (d >= LOG1P_EXP_FAST_CUTOFF) {
+    return 0;
+  }
+  double x = d*LOG1P_EXP_TABLE_STEPS;
+  int i = (int)x;
+  double f = x - i;
+  const double *v = log1p_exp_table.values;
+  return v[i] + f*(v[i+1] - v[i]);
+}
+
+inline double log1p_exp(double d) {
+  return (log_mode == LOG_FAST) ? log1p_exp_fast(d) : log1p_exp_exact(d);
+}
+
+inline double logaddexp(double x1, double x2) {
+  double hi = std::max(x1, x2);
+  double lo = std::min(x1, x2);
+  if (hi == DEFAULT_VALUE) {
+    return DEFAULT_VALUE;
+  }
+  return hi + log1p_exp(hi - lo);
+}
+
+// Batch variants. logaddexp branches on its operands and on the mode, so its
+// loop does not vectorize. logsumexp in the exact mode takes the maximum and
+// then sums exp without branches, the fast mode adds up with the table.
+
+// out[i] = logaddexp(x1[i], x2[i])
+void logaddexp(const double *x1, const double *x2, double *out, int n) {
+  for (int i=0; i<n; i++) {
+    out[i] = logaddexp(x1[i], x2[i]);
+  }
+}
+
+// log(sum(exp(x[i])))
+double logsumexp(const double *x, int n) {
+  if (n <= 0) {
+    return DEFAULT_VALUE;
+  }
+  double x_max = x[0];
+  for (int i=1; i<n; i++) {
+    x_max = std::max(x_max, x[i]);
+  }
+  if (x_max == DEFAULT_VALUE) {
+    return DEFAULT_VALUE;
+  }
+  if (log_mode == LOG_FAST) {
+    double total = DEFAULT_VALUE;
+    for (int i=0; i<n; i++) {
+      total = logaddexp(total, x[i]);
+    }
+    return total;
+  }
+  double total = 0;
+  for (int i=0; i<n; i++) {
+    total += std::exp(x[i] - x_max);
+  }
+  return x_max + std::log(total);
+}
+
+// log(sum(exp(x1[i]+x2[i]))), e.g. the joint emission of two reads. The
+// inputs may be float pointers or ArrayView rows, the sums are always taken in
+// double.
+template <class TRow>
+double logsumexp(const TRow &x1, const TRow &x2, int n) {
+  double x_max = DEFAULT_VALUE;
+  for (int i=0; i<n; i++) {
+    x_max = std::max(x_max, (double)x1[i] + x2[i]);
+  }
+  if (x_max == DEFAULT_VALUE) {
+    return DEFAULT_VALUE;
+  }
+  if (log_mode == LOG_FAST) {
+    double total = DEFAULT_VALUE;
+    for (int i=0; i<n; i++) {
+      total = logaddexp(total, (double)x1[i] + x2[i]);
+    }
+    return total;
+  }
+  double total = 0;
+  for (int i=0; i<n; i++) {
+    total += std::exp((double)x1[i] + x2[i] - x_max);
   }
+  return x_max + std::log(total);
 }
 
 #endif
@@ -0,0 +1,58 @@
+#ifndef NODE_POOL_HPP
+#define NODE_POOL_HPP
+
+#include <vector>
+#include <memory>
+
+// Slab allocator for prefix tree nodes. Nodes are handed out from fixed-size
+// slabs and returned to a free list when the tree reclaims a pruned subtree,
+// so the number of live nodes (rather than the number ever created) bounds
+// memory and the per-frame loop does not call new/delete.
+template <class N>
+class NodePool {
+  private:
+    std::vector<std::unique_ptr<N[]>> slabs;
+    std::vector<N*> free_list;
+    int slab_size;
+    int slab_used;
+    int live = 0;
+
+  public:
+    NodePool(int s=4096) :slab_size{s}, slab_used{s} {}
+
+    N* create(int s, N* p) {
+      N* n;
+      if (!free_list.empty()) {
+        n = free_list.back();
+        free_list.pop_back();
+      } else {
+        if (slab_used == slab_size) {
+          slabs.emplace_back(new N[slab_size]);
+          slab_used = 0;
+        }
+        n = &slabs.back()[slab_used++];
+      }
+      *n = N(s, p);
+      live++;
+      return n;
+    }
+
+    void release(N* n) {
+      // reset node so that its buffers are freed while on the free list
+      *n = N();
+      free_list.push_back(n);
+      live--;
+    }
+
+    // number of nodes currently handed out
+    int size() const {
+      return live;
+    }
+
+    // number of nodes allocated in slabs, live or free
+    int capacity() const {
+      return slabs.size()*slab_size;
+    }
+};
+
+#endif
@@ -4,8 +4,9 @@
 #include <string>
 #include <map>
 #include <cmath>
+#include <algorithm>
 
-#include "SparseMatrix.h"
+#include "BandedMatrix.h"
 #include "Gamma.h"
 
 #define DEFAULT_VALUE -std::numeric_limits<double>::infinity()
@@ -17,7 +18,8 @@ void print_row(double* row, int row_size) {
   std::cout << std::endl;
 }
 
-void forward_vec_log(std::string alphabet, int s, int i, int t_max, double** y, double* fw, double* fw_prev) {
+template <class TTrace>
+void forward_vec_log(std::string alphabet, int s, int i, int t_max, const TTrace &y, double* fw, double* fw_prev) {
   int alphabet_size = alphabet.length();
   for (int t=0; t<t_max; t++) {
     if (t==0) {
@@ -30,7 +32,8 @@ void forward_vec_log(std::string alphabet, int s, int i, int t_max, double** y,
   }
 }
 
-void forward_vec_log(std::string alphabet, int s, int i, int t_max, double** y, double* fw) {
+template <class TTrace>
+void forward_vec_log(std::string alphabet, int s, int i, int t_max, const TTrace &y, double* fw) {
   int alphabet_size = alphabet.length();
   for (int t=0; t<t_max; t++) {
     if (t == 0) {
@@ -41,7 +44,8 @@ void forward_vec_log(std::string alphabet, int s, int i, int t_max, double** y,
   }
 }
 
-void forward_vec_no_gap_log(std::string alphabet, int s, int i, int t_max, double** y, double* fw, double* fw_prev) {
+template <class TTrace>
+void forward_vec_no_gap_log(std::string alphabet, int s, int i, int t_max, const TTrace &y, double* fw, double* fw_prev) {
   int alphabet_size = alphabet.length();
   if (i==1) {
     fw[0] = y[0][s];
@@ -53,7 +57,8 @@ void forward_vec_no_gap_log(std::string alphabet, int s, int i, int t_max, doubl
   }
 }
 
-void forward(std::string alphabet, std::string label, double** y, int U) {
+template <class TTrace>
+void forward(std::string alphabet, std::string label, const TTrace &y, int U) {
   double* fw_prev = new double[U];
   double* fw = new double[U];
   int label_size = label.length();
@@ -76,7 +81,9 @@ void forward(std::string alphabet, std::string label, double** y, int U) {
   }
 }
 
-std::string pair_prefix_search_log(double **y1, double **y2, int **envelope_ranges, int U, int V, std::string alphabet) {
+// TTrace and TEnvelope are pointer arrays or ArrayViews
+template <class TTrace, class TEnvelope>
+std::string pair_prefix_search_log(const TTrace &y1, const TTrace &y2, const TEnvelope &envelope_ranges, int U, int V, std::string alphabet) {
 
   //std::cout << "STARTING PREFIX SEARCH" << std::endl;
 
@@ -87,11 +94,7 @@ std::string pair_prefix_search_log(double **y1, double **y2, int **envelope_rang
   std::string curr_label = "";
 
   // gamma matrix DP
-  SparseMatrix<double> gamma_, gamma_ast;
-  for (int u=0; u<U+1; u++) {
-    gamma_.push_row(envelope_ranges[u][0],envelope_ranges[u][1]);
-    gamma_ast.push_row(envelope_ranges[u][0],envelope_ranges[u][1]);
-  }
+  BandedMatrix<double> gamma_(envelope_ranges, U+1), gamma_ast(envelope_ranges, U+1);
   //std::cout << "STARTING GAMMA DP" << std::endl;
   pair_gamma_log_envelope_inplace(gamma_, gamma_ast, y1, y2, envelope_ranges, U, V, alphabet_size+1);
   //std::cout << "Gamma(0,0): " << gamma_.get(0,0) << std::endl;
@@ -129,6 +132,9 @@ std::string pair_prefix_search_log(double **y1, double **y2, int **envelope_rang
   double** alpha1 = new double*[alphabet_size];
   double** alpha2 = new double*[alphabet_size];
 
+  // prefix probability terms along one envelope row
+  std::vector<double> row_terms;
+
   while (continue_search) {
     search_level++;
 
@@ -156,14 +162,18 @@ std::string pair_prefix_search_log(double **y1, double **y2, int **envelope_rang
       print_row(alpha_ast2,U);
       */
 
+      // the forward vectors hold U and V frames, gamma past the last frame
+      // of either read is out of the envelope
       double prefix_prob = DEFAULT_VALUE;
-      for (int u=0; u<=U; u++) {
+      for (int u=0; u<U; u++) {
         int row_start = envelope_ranges[u][0];
-        int row_end = envelope_ranges[u][1];
+        int row_end = std::min(envelope_ranges[u][1], V-1);
+        row_terms.clear();
         for (int v=row_start; v<=row_end; v++) {
           //std::cout << prefix_prob << ':' << u << ',' << v << ':' << alpha_ast1[u] + alpha_ast2[v] << ',' << gamma_.get(u+1,v+1) << std::endl;
-          prefix_prob = logaddexp(prefix_prob, alpha_ast1[u]+alpha_ast2[v]+gamma_.get(u+1,v+1));
+          row_terms.push_back(alpha_ast1[u]+alpha_ast2[v]+gamma_.get(u+1,v+1));
         }
+        prefix_prob = logaddexp(prefix_prob, logsumexp(row_terms.data(), row_terms.size()));
       }
       prefix_prob -= gamma_.get(0,0);
 
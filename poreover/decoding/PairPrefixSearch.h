@@ -8,9 +8,10 @@
 #include <map>
 #include <cmath>
 
-#include "SparseMatrix.h"
+#include "BandedMatrix.h"
 #include "Gamma.h"
 
-std::string pair_prefix_search_log(double**, double**, int**, int, int, std::string);
+template <class TTrace, class TEnvelope>
+std::string pair_prefix_search_log(const TTrace&, const TTrace&, const TEnvelope&, int, int, std::string);
 
 #endif
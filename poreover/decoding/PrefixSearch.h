@@ -0,0 +1,166 @@
+#ifndef PREFIX_SEARCH_H
+#define PREFIX_SEARCH_H
+
+#include <string>
+#include <vector>
+#include <limits>
+#include <cmath>
+
+#include "ArrayView.h"
+#include "Log.h"
+
+/*
+Prefix search on a single CTC trace (bases of the alphabet then a blank),
+the same search as prefix_search.prefix_search_log. Only the forward row of
+the current prefix and the rows of its extensions are kept, so memory is
+linear in the number of frames instead of quadratic and whole reads can be
+searched.
+*/
+
+// Greedy walk along the forward rows of consecutive prefixes of a label,
+// giving the frame of every base (see pair_decode.viterbi_path). The walk
+// from base seq to seq+1 only needs rows seq and seq+1, so it follows the
+// prefixes as the search extends them.
+class ForwardWalk {
+  public:
+    int t_max;
+    int sig = 0;
+    int seq = 1;
+
+    ForwardWalk(int t) : t_max(t) {}
+
+    // walk through base seq == column, a and b are the rows of bases column
+    // and column+1. Returns the frame of base column if the walk moved on to
+    // the next base, else -1.
+    int step(const double *a, const double *b, int column) {
+      while (seq == column && sig < t_max-1) {
+        int next_pos = 0;
+        double best = a[sig+1];
+        if (b[sig] > best) {
+          next_pos = 1;
+          best = b[sig];
+        }
+        if (b[sig+1] > best) {
+          next_pos = 2;
+        }
+        int moved = -1;
+        if (next_pos > 0) {
+          moved = sig;
+          seq += 1;
+        }
+        if (next_pos < 2) {
+          sig += 1;
+        }
+        if (moved >= 0) {
+          return moved;
+        }
+      }
+      return -1;
+    }
+};
+
+template <class T>
+std::string prefix_search(ArrayView<T> y, int t_max, std::string alphabet, double &top_label_prob, std::vector<int> *path=nullptr) {
+  const int alphabet_size = alphabet.length();
+  const int gap_char = alphabet_size;
+
+  // forward rows of the current prefix, its extensions and their prefix
+  // probability terms
+  std::vector<double> alpha_prev(t_max), alpha_ast(t_max);
+  std::vector<std::vector<double>> alpha(alphabet_size, std::vector<double>(t_max));
+
+  double gap_prob = 0;
+  for (int t=0; t<t_max; t++) {
+    gap_prob += y[t][gap_char];
+    alpha_prev[t] = gap_prob;
+  }
+
+  std::string curr_label = "";
+  std::string top_label = "";
+  top_label_prob = gap_prob;
+
+  // forward path of the top label: the first top_walked frames of the walk
+  // over the current prefixes, then top_extra if its last step moved on.
+  // The first base is always at frame 0.
+  ForwardWalk walk(t_max);
+  std::vector<int> walked{0};
+  int top_walked = 1;
+  int top_extra = -1;
+
+  // a label can't be longer than the trace
+  for (int level=1; level <= t_max; level++) {
+    int best_prefix = 0;
+    double best_prefix_prob = DEFAULT_VALUE;
+
+    // the bases of a prefix take at least as many frames, so the forward
+    // rows are zero (-inf) before frame level-1 and the loops start there
+    const int first = level-1;
+
+    for (int c=0; c<alphabet_size; c++) {
+      std::vector<double> &fw = alpha[c];
+
+      // prefix probability, paths that emit c last
+      alpha_ast[0] = (level == 1) ? y[0][c] : DEFAULT_VALUE;
+      for (int t=std::max(first, 1); t<t_max; t++) {
+        alpha_ast[t] = alpha_prev[t-1] + y[t][c];
+      }
+      double prefix_prob = logsumexp(alpha_ast.data() + first, t_max - first);
+
+      // label probability, the rows are reused so the frames shorter
+      // prefixes could reach are cleared
+      for (int t=std::max(first-2, 0); t<first; t++) {
+        fw[t] = DEFAULT_VALUE;
+      }
+      fw[0] = (level == 1) ? y[0][c] : DEFAULT_VALUE;
+      for (int t=std::max(first, 1); t<t_max; t++) {
+        fw[t] = logaddexp(y[t][gap_char] + fw[t-1], y[t][c] + alpha_prev[t-1]);
+      }
+
+      if (fw[t_max-1] > top_label_prob) {
+        top_label = curr_label + alphabet[c];
+        top_label_prob = fw[t_max-1];
+        if (path != nullptr) {
+          // finish a copy of the walk with this label's own row
+          top_walked = walked.size();
+          top_extra = -1;
+          if (level >= 3) {
+            ForwardWalk last = walk;
+            top_extra = last.step(alpha_prev.data(), fw.data(), level-2);
+          }
+        }
+      }
+      if (c == 0 || prefix_prob > best_prefix_prob) {
+        best_prefix = c;
+        best_prefix_prob = prefix_prob;
+      }
+    }
+
+    if (best_prefix_prob < top_label_prob) {
+      break;
+    }
+
+    // move to the prefix with highest prefix probability
+    curr_label += alphabet[best_prefix];
+    if (path != nullptr && level >= 3) {
+      int moved = walk.step(alpha_prev.data(), alpha[best_prefix].data(), level-2);
+      if (moved >= 0) {
+        walked.push_back(moved);
+      }
+    }
+    alpha_prev.swap(alpha[best_prefix]);
+  }
+
+  if (path != nullptr) {
+    path->clear();
+    if (top_label.length() > 0) {
+      path->assign(walked.begin(), walked.begin() + top_walked);
+      if (top_extra >= 0) {
+        path->push_back(top_extra);
+      }
+      path->resize(top_label.length(), t_max);
+    }
+  }
+  return top_label;
+}
+
+#endif
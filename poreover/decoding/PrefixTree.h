@@ -9,11 +9,17 @@
 #include <limits>
 #include <functional>
 #include <cmath>
+#include <type_traits>
 
 #include "Log.h"
+#include "RollingBuffer.h"
+#include "NodePool.h"
+#include "ArrayView.h"
 
 #define DEFAULT_VALUE -std::numeric_limits<double>::infinity()
 
+// Nodes are owned by the NodePool of their tree. Children are indexed by
+// character and may be nullptr after a pruned subtree has been reclaimed.
 template <class N>
 class Node {
 public:
@@ -21,31 +27,19 @@ public:
   N* parent;
   std::vector<N*> children;
   int depth = 0;
+  int mark = 0;
 
   Node(int s, N* p) :last{s}, parent{p} {}
   Node(int s) :last{s}, parent{nullptr} {}
   Node() :last{-1}, parent{nullptr} {}
-  virtual ~Node() {
-      for (auto x : children) {
-          delete x;
-      }
-  }
 
   int get_last() const { return last; }
   N* get_parent() const { return parent; }
-
-  N* add_child(int c) {
-    N* child = new N(c);
-    child->parent = static_cast<N*>(this);
-    child->depth = this->depth + 1;
-    children.push_back(child);
-    return child;
-  }
 };
 
 class PoreOverNode : public Node<PoreOverNode> {
 public:
-  std::unordered_map<int, double> probability;
+  RollingBuffer probability;
   int max_t = 0;
 
   PoreOverNode(int s, PoreOverNode* p) : Node<PoreOverNode>(s, p) {}
@@ -53,11 +47,7 @@ public:
   PoreOverNode() : Node<PoreOverNode>() {}
 
   double probability_at(int t) const {
-   if (probability.count(t) > 0) {
-     return probability.at(t);
-   } else {
-     return DEFAULT_VALUE;
-   }
+   return probability.at(t);
  }
 
  double last_probability() const {
@@ -65,7 +55,7 @@ public:
  }
 
  void set_probability(int t, double val) {
-   probability[t] = val;
+   probability.set(t, val);
    max_t = t;
  }
 
@@ -74,7 +64,7 @@ public:
 class PoreOverNode2D : public Node<PoreOverNode2D> {
 public:
   static const int dim = 2;
-  std::unordered_map<int, double> probability[dim];
+  WindowBuffer probability[dim];
   int last_t[dim] = {0, 0};
   int max_t[dim] = {0, 0};
   double last_prob[dim] = {0, 0};
@@ -85,11 +75,7 @@ public:
   PoreOverNode2D() : Node<PoreOverNode2D>() {}
 
   double probability_at(int n, int t) const {
-   if (probability[n].count(t) > 0) {
-     return probability[n].at(t);
-   } else {
-     return DEFAULT_VALUE;
-   }
+   return probability[n].at(t);
  }
 
  double probability_at(int t) const {
@@ -113,8 +99,8 @@ double joint_probability(int u, int v) const {
    max_prob[1] = DEFAULT_VALUE;
  }
 
- void set_probability(int i, int t, double val) {
-   probability[i][t] = val;
+ void set_probability(int i, int t, double val, int floor) {
+   probability[i].set(t, val, floor);
    last_t[i] = t;
    last_prob[i] = val;
    if (val > max_prob[i]) {
@@ -137,9 +123,9 @@ double joint_probability(int u, int v) const {
 
 class FlipFlopNode : public Node<FlipFlopNode>{
 public:
-  std::unordered_map<int, double> probability;
-  std::unordered_map<int, double> probability_flip;
-  std::unordered_map<int, double> probability_flop;
+  RollingBuffer probability;
+  RollingBuffer probability_flip;
+  RollingBuffer probability_flop;
   int max_t = 0;
 
   FlipFlopNode(int s, FlipFlopNode* p) : Node<FlipFlopNode>(s, p) {}
@@ -147,27 +133,15 @@ public:
   FlipFlopNode() : Node<FlipFlopNode>() {}
 
    double probability_at(int t) const {
-    if (probability.count(t) > 0) {
-      return probability.at(t);
-    } else {
-      return DEFAULT_VALUE;
-    }
+    return probability.at(t);
   }
 
   double probability_flip_at(int t) const {
-   if (probability_flip.count(t) > 0) {
-     return probability_flip.at(t);
-   } else {
-     return DEFAULT_VALUE;
-   }
+   return probability_flip.at(t);
  }
 
    double probability_flop_at(int t) const {
-    if (probability_flop.count(t) > 0) {
-      return probability_flop.at(t);
-    } else {
-      return DEFAULT_VALUE;
-    }
+    return probability_flop.at(t);
   }
 
   double last_probability() const {
@@ -175,9 +149,9 @@ public:
   }
 
   void set_probability(int t, double flip_val, double flop_val) {
-    probability[t] = logaddexp(flip_val, flop_val);
-    probability_flip[t] = flip_val;
-    probability_flop[t] = flop_val;
+    probability.set(t, logaddexp(flip_val, flop_val));
+    probability_flip.set(t, flip_val);
+    probability_flop.set(t, flop_val);
     max_t = t;
   }
 
@@ -186,9 +160,9 @@ public:
 class FlipFlopNode2D : public Node<FlipFlopNode2D> {
 public:
   static const int dim = 2;
-  std::unordered_map<int, double> probability[dim];
-  std::unordered_map<int, double> probability_flip[dim];
-  std::unordered_map<int, double> probability_flop[dim];
+  WindowBuffer probability[dim];
+  WindowBuffer probability_flip[dim];
+  WindowBuffer probability_flop[dim];
   double max_prob[dim] = {DEFAULT_VALUE, DEFAULT_VALUE};
   int last_t[dim] = {0, 0};
   int max_t[dim] = {0, 0};
@@ -198,27 +172,15 @@ public:
   FlipFlopNode2D() : Node<FlipFlopNode2D>() {}
 
   double probability_at(int n, int t) const {
-   if (probability[n].count(t) > 0) {
-     return probability[n].at(t);
-   } else {
-     return DEFAULT_VALUE;
-   }
+   return probability[n].at(t);
   }
 
  double probability_flip_at(int n, int t) const {
-  if (probability_flip[n].count(t) > 0) {
-    return probability_flip[n].at(t);
-  } else {
-    return DEFAULT_VALUE;
-  }
+  return probability_flip[n].at(t);
  }
 
  double probability_flop_at(int n, int t) const {
-  if (probability_flop[n].count(t) > 0) {
-    return probability_flop[n].at(t);
-  } else {
-    return DEFAULT_VALUE;
-  }
+  return probability_flop[n].at(t);
  }
 
  double probability_at(int t) const {
@@ -233,10 +195,8 @@ double joint_probability(int u, int v) const {
    double prob_sum = 0;
    for (int n=0; n<dim; ++n) {
      prob_sum += probability[n].at(last_t[n]);
-     //prob_sum += probability_at(n,last_t[n]);
    }
    return prob_sum;
-    //return probability[0].at(last_t[0]) + probability[1].at(last_t[1]); //2D case
  }
 
  double max_probability() const {
@@ -248,13 +208,14 @@ double joint_probability(int u, int v) const {
    max_prob[1] = DEFAULT_VALUE;
  }
 
- void set_probability(int i, int t, double flip_val, double flop_val) {
-   probability[i][t] = logaddexp(flip_val, flop_val);
-   probability_flip[i][t] = flip_val;
-   probability_flop[i][t] = flop_val;
+ void set_probability(int i, int t, double flip_val, double flop_val, int floor) {
+   double val = logaddexp(flip_val, flop_val);
+   probability[i].set(t, val, floor);
+   probability_flip[i].set(t, flip_val, floor);
+   probability_flop[i].set(t, flop_val, floor);
    last_t[i] = t;
-   if (probability[i][t] > max_prob[i]) {
-     max_prob[i] = probability[i][t];
+   if (val > max_prob[i]) {
+     max_prob[i] = val;
      max_t[i] = t;
    }
  }
@@ -263,9 +224,9 @@ double joint_probability(int u, int v) const {
 
 class BonitoNode : public Node<BonitoNode>{
 public:
-  std::unordered_map<int, double> probability;
-  std::unordered_map<int, double> probability_gap;
-  std::unordered_map<int, double> probability_no_gap;
+  RollingBuffer probability;
+  RollingBuffer probability_gap;
+  RollingBuffer probability_no_gap;
   int max_t = 0;
 
   BonitoNode(int s, BonitoNode* p) : Node<BonitoNode>(s, p) {}
@@ -273,27 +234,15 @@ public:
   BonitoNode() : Node<BonitoNode>() {}
 
    double probability_at(int t) const {
-    if (probability.count(t) > 0) {
-      return probability.at(t);
-    } else {
-      return DEFAULT_VALUE;
-    }
+    return probability.at(t);
   }
 
   double probability_gap_at(int t) const {
-   if (probability_gap.count(t) > 0) {
-     return probability_gap.at(t);
-   } else {
-     return DEFAULT_VALUE;
-   }
+   return probability_gap.at(t);
  }
 
    double probability_no_gap_at(int t) const {
-    if (probability_no_gap.count(t) > 0) {
-      return probability_no_gap.at(t);
-    } else {
-      return DEFAULT_VALUE;
-    }
+    return probability_no_gap.at(t);
   }
 
   double last_probability() const {
@@ -301,9 +250,9 @@ public:
   }
 
   void set_probability(int t, double gap_val, double no_gap_val) {
-    probability[t] = logaddexp(gap_val, no_gap_val);
-    probability_gap[t] = gap_val;
-    probability_no_gap[t] = no_gap_val;
+    probability.set(t, logaddexp(gap_val, no_gap_val));
+    probability_gap.set(t, gap_val);
+    probability_no_gap.set(t, no_gap_val);
     max_t = t;
   }
 
@@ -312,9 +261,9 @@ public:
 class BonitoNode2D : public Node<BonitoNode2D>{
 public:
   static const int dim = 2;
-  std::unordered_map<int, double> probability[dim];
-  std::unordered_map<int, double> probability_gap[dim];
-  std::unordered_map<int, double> probability_no_gap[dim];
+  WindowBuffer probability[dim];
+  WindowBuffer probability_gap[dim];
+  WindowBuffer probability_no_gap[dim];
   double max_prob[dim] = {DEFAULT_VALUE, DEFAULT_VALUE};
   int last_t[dim] = {0, 0};
   int max_t[dim] = {0, 0};
@@ -324,27 +273,15 @@ public:
   BonitoNode2D() : Node<BonitoNode2D>() {}
 
    double probability_at(int n, int t) const {
-    if (probability[n].count(t) > 0) {
-      return probability[n].at(t);
-    } else {
-      return DEFAULT_VALUE;
-    }
+    return probability[n].at(t);
   }
 
   double probability_gap_at(int n, int t) const {
-   if (probability_gap[n].count(t) > 0) {
-     return probability_gap[n].at(t);
-   } else {
-     return DEFAULT_VALUE;
-   }
+   return probability_gap[n].at(t);
  }
 
    double probability_no_gap_at(int n, int t) const {
-    if (probability_no_gap[n].count(t) > 0) {
-      return probability_no_gap[n].at(t);
-    } else {
-      return DEFAULT_VALUE;
-    }
+    return probability_no_gap[n].at(t);
   }
 
   double probability_at(int t) const {
@@ -359,10 +296,8 @@ public:
     double prob_sum = 0;
     for (int n=0; n<dim; ++n) {
       prob_sum += probability[n].at(last_t[n]);
-      //prob_sum += probability_at(n,last_t[n]);
     }
     return prob_sum;
-     //return probability[0].at(last_t[0]) + probability[1].at(last_t[1]); //2D case
   }
 
   double max_probability() const {
@@ -374,77 +309,232 @@ public:
     max_prob[1] = DEFAULT_VALUE;
   }
 
-  void set_probability(int i, int t, double gap_val, double no_gap_val) {
-    probability[i][t] = logaddexp(gap_val, no_gap_val);
-    probability_gap[i][t] = gap_val;
-    probability_no_gap[i][t] = no_gap_val;
+  void set_probability(int i, int t, double gap_val, double no_gap_val, int floor) {
+    double val = logaddexp(gap_val, no_gap_val);
+    probability[i].set(t, val, floor);
+    probability_gap[i].set(t, gap_val, floor);
+    probability_no_gap[i].set(t, no_gap_val, floor);
     last_t[i] = t;
-    if (probability[i][t] > max_prob[i]) {
-      max_prob[i] = probability[i][t];
+    if (val > max_prob[i]) {
+      max_prob[i] = val;
       max_t[i] = t;
     }
   }
 
 };
 
+// Forward probability of a 2D tree node along one read at one time step.
+// The flip-flop and Bonito trees keep two states (flip/flop, gap/no gap) with
+// probability their sum, PoreOver only uses probability.
+struct ReadProbability {
+  double probability;
+  double a;
+  double b;
+};
+
 template <class TNode>
 class PrefixTree {
 public:
+    typedef typename std::remove_pointer<TNode>::type node_type;
+
     std::string alphabet;
     TNode root;
+    NodePool<node_type> pool;
+    // reclaim() only sweeps once the pool has doubled since the last pass
+    static const int min_reclaim = 1 << 14;
+    int reclaim_threshold = min_reclaim;
+    int reclaim_epoch = 0;
 
     PrefixTree(std::string a) : alphabet{a} {}
-     virtual ~PrefixTree() {
-        delete root;
-     }
+    virtual ~PrefixTree() {}
+
+    TNode add_child(TNode n, int c) {
+      TNode child = pool.create(c, n);
+      child->depth = n->depth + 1;
+      if (n->children.size() <= c) {
+        n->children.resize(c+1, nullptr);
+      }
+      n->children[c] = child;
+      return child;
+    }
 
-    // expand children if node hasn't been expanded
+    // expand children if node hasn't been expanded (or some were reclaimed)
     std::vector<TNode> expand(TNode n) {
-      if (n->children.size() == 0) {
-        for (int i=0; i < alphabet.length(); i++) {
-          n->add_child(i);
+      if (n->children.size() < alphabet.length()) {
+        n->children.resize(alphabet.length(), nullptr);
+      }
+      for (int i=0; i < alphabet.length(); i++) {
+        if (!n->children[i]) {
+          add_child(n, i);
         }
       }
       return n->children;
     }
 
+    // Return nodes that can no longer be reached by the search to the pool.
+    // Every future beam is made of descendants of the current beam, and labels
+    // and parent probabilities only need ancestors, so anything that is
+    // neither above nor below a beam node is dead.
+    // With subtree_levels >= 0 only that many levels below the beam nodes are
+    // kept, for searches whose next step only reads the beam and its children.
+    template <class TContainer>
+    void reclaim(const TContainer& beam_nodes, int subtree_levels=-1) {
+      if (pool.size() < 2*reclaim_threshold) {
+        return;
+      }
+      int epoch = ++reclaim_epoch;
+      std::vector<std::pair<TNode, int>> stack;
+
+      // mark beam nodes and their subtrees
+      for (auto n : beam_nodes) {
+        stack.push_back({n, subtree_levels});
+      }
+      while (!stack.empty()) {
+        TNode n = stack.back().first;
+        int levels = stack.back().second;
+        stack.pop_back();
+        if (n->mark == epoch && subtree_levels < 0) {
+          continue;
+        }
+        n->mark = epoch;
+        if (levels == 0) {
+          continue;
+        }
+        for (auto c : n->children) {
+          if (c) {
+            stack.push_back({c, levels-1});
+          }
+        }
+      }
+
+      // mark ancestors of beam nodes
+      root->mark = epoch;
+      for (auto n : beam_nodes) {
+        TNode p = n->parent;
+        while (p && p->mark != epoch) {
+          p->mark = epoch;
+          p = p->parent;
+        }
+      }
+
+      // sweep unmarked subtrees hanging off the marked part of the tree
+      std::vector<TNode> sweep = {root};
+      while (!sweep.empty()) {
+        TNode n = sweep.back();
+        sweep.pop_back();
+        for (auto& c : n->children) {
+          if (!c) {
+            continue;
+          } else if (c->mark == epoch) {
+            sweep.push_back(c);
+          } else {
+            release_subtree(c);
+            c = nullptr;
+          }
+        }
+      }
+
+      reclaim_threshold = std::max(int(min_reclaim), pool.size());
+    }
+
+    void release_subtree(TNode n) {
+      std::vector<TNode> stack = {n};
+      while (!stack.empty()) {
+        TNode x = stack.back();
+        stack.pop_back();
+        for (auto c : x->children) {
+          if (c) {
+            stack.push_back(c);
+          }
+        }
+        pool.release(x);
+      }
+    }
+
+    // Make r the root of the tree and release everything that is not below r.
+    // r is attached to an empty parent, so this is only valid once the real
+    // parent of r can no longer be read by update_prob.
+    void reroot(TNode r) {
+      if (r == root) {
+        return;
+      }
+      std::vector<TNode> chain;
+      for (TNode p = r->parent; p != root; p = p->parent) {
+        chain.push_back(p);
+      }
+      chain.push_back(root);
+
+      TNode keep = r;
+      for (auto p : chain) {
+        for (auto c : p->children) {
+          if (c && c != keep) {
+            release_subtree(c);
+          }
+        }
+        keep = p;
+      }
+      for (auto p : chain) {
+        pool.release(p);
+      }
+      r->parent = &detached;
+      root = r;
+    }
+
     // trace path back to root and output label
     std::string get_label(TNode n) {
+      return get_label(n, nullptr);
+    }
+
+    // label of n below (and not including) node stop
+    std::string get_label(TNode n, TNode stop) {
       std::string label = "";
-      TNode prefix = n;
-      while (prefix) {
-        label = alphabet[prefix->last] + label;
-        prefix = prefix->parent;
+      for (TNode prefix = n; prefix != stop && prefix != &detached; prefix = prefix->parent) {
+        label += alphabet[prefix->last];
       }
+      std::reverse(label.begin(), label.end());
       return label;
     }
 
+    // all probabilities of this node stay at DEFAULT_VALUE, it stands in for
+    // the released parent of a rerooted tree
+    node_type detached;
+
 };
 
+// TScalar is the type of the trace, probabilities are kept in double
+template <class TScalar>
 class PoreOverPrefixTree : public PrefixTree<PoreOverNode*> {
 public:
+  typedef TScalar scalar_type;
+  typedef ArrayView<TScalar> trace_type;
   int gap_char;
   int t_max;
-  double **y;
+  trace_type y;
+  // time step of y[0], for decoding frames that arrive in chunks
+  int frame_offset = 0;
 
-  PoreOverPrefixTree(double **d, int v, std::string a) : PrefixTree<PoreOverNode*>(a), y{d}, t_max{v} {
+  PoreOverPrefixTree(trace_type d, int v, std::string a) : PrefixTree<PoreOverNode*>(a), t_max{v}, y{d} {
     gap_char = alphabet.length();
-    root = new PoreOverNode(gap_char);
-    root->probability[-1] = 0;
-    double blank_sum = 0;
-    for (int i=0; i<t_max; i++) {
-      blank_sum += y[i][gap_char];
-      root->probability[i] = blank_sum;
+    root = pool.create(gap_char, nullptr);
+    root->set_probability(-1, 0);
+  }
+
+  // the root (empty label) is extended by a gap at each time step, which
+  // needs to happen before its children are updated at t+1
+  void update_root(int t) {
+    if (root->depth == 0) {
+      root->set_probability(t, root->probability_at(t-1) + y[t-frame_offset][gap_char]);
     }
   }
 
   void update_prob(PoreOverNode* n, int t) {
+    auto y_t = y[t-frame_offset];
     double a = n->parent->probability_at(t-1);
-    double b = y[t][n->last];
+    double b = y_t[n->last];
     double emit_state = a+b;
 
     double c = n->probability_at(t-1);
-    double d = y[t][gap_char];
+    double d = y_t[gap_char];
     double stay_state = c+d;
 
     n->set_probability(t, logaddexp(emit_state, stay_state));
@@ -452,35 +542,59 @@ public:
 
 };
 
+template <class TScalar>
 class PoreOverPrefixTree2D : public PrefixTree<PoreOverNode2D*> {
 public:
+  typedef TScalar scalar_type;
+  typedef ArrayView<TScalar> trace_type;
   static const int dim = 2;
   int gap_char;
   int t_max[dim];
-  double **y[dim];
+  trace_type y[dim];
+  int window_floor = -1;
+  std::vector<double> blank_probability[dim];
 
-  PoreOverPrefixTree2D(double **d1, int u, double **d2, int v, std::string a) : PrefixTree<PoreOverNode2D*>(a) {
+  PoreOverPrefixTree2D(trace_type d1, int u, trace_type d2, int v, std::string a) : PrefixTree<PoreOverNode2D*>(a) {
     y[0] = d1;
     y[1] = d2;
     t_max[0] = u;
     t_max[1] = v;
     gap_char = alphabet.length();
-    root = new PoreOverNode2D(gap_char);
-    root->probability[0][-1] = 0;
-    root->probability[1][-1] = 0;
+    root = pool.create(gap_char, nullptr);
     for (int i=0; i<dim; ++i) {
       double blank_sum = 0;
       for (int t=0; t<t_max[i]; ++t) {
         blank_sum += y[i][t][gap_char];
-        root->probability[i][t] = blank_sum;
+        blank_probability[i].push_back(blank_sum);
       }
+      root->set_probability(i, -1, 0, -1);
     }
 
   }
 
-  void update_prob(PoreOverNode2D* n, int i, int t) {
+  // earliest time step of the second read that can still be read back,
+  // set by the beam search before each envelope row
+  void set_window_floor(int t) {
+    window_floor = t;
+  }
+
+  int floor(int i, int t) const {
+    return (i == 0) ? t-1 : window_floor;
+  }
 
-      double a = n->parent->probability_at(i, t-1);
+  double parent_probability_at(PoreOverNode2D* n, int i, int t) const {
+    if (n->parent == root) {
+      return (t < 0) ? 0 : blank_probability[i][t];
+    } else {
+      return n->parent->probability_at(i, t);
+    }
+  }
+
+  // compute_prob only reads the tree, so separate cells can evaluate nodes
+  // concurrently and store the results afterwards
+  ReadProbability compute_prob(PoreOverNode2D* n, int i, int t) const {
+
+      double a = parent_probability_at(n, i, t-1);
       double b = y[i][t][n->last];
       double emit_state = a+b;
 
@@ -490,38 +604,55 @@ public:
 
       //std::cout << "label=" << this->get_label(n) << " read=" << i << " time=" << t << " P(emit)=" << emit_state << " P(stay)=" << stay_state << " P(total)=" << logaddexp(emit_state, stay_state)  << "\n";
 
-      n->set_probability(i, t, logaddexp(emit_state, stay_state));
+      double prob = logaddexp(emit_state, stay_state);
+      return {prob, prob, DEFAULT_VALUE};
+  }
+
+  void store_prob(PoreOverNode2D* n, int i, int t, const ReadProbability& p, int floor) {
+      n->set_probability(i, t, p.probability, floor);
+  }
+
+  void update_prob(PoreOverNode2D* n, int i, int t) {
+      store_prob(n, i, t, compute_prob(n, i, t), floor(i, t));
   }
 
 };
 
+template <class TScalar>
 class FlipFlopPrefixTree : public PrefixTree<FlipFlopNode*> {
 public:
+  typedef TScalar scalar_type;
+  typedef ArrayView<TScalar> trace_type;
   int flipflop_size = alphabet.length();
   int t_max;
-  double **y;
+  trace_type y;
+  int frame_offset = 0;
 
-  FlipFlopPrefixTree(double **d, int v, std::string a) : PrefixTree<FlipFlopNode*>(a), y{d}, t_max{v} {
-    root = new FlipFlopNode(flipflop_size);
-    root->probability[-1] = 0;
-    root->probability_flip[-1] = log(0.5);
-    root->probability_flop[-1] = log(0.5);
+  FlipFlopPrefixTree(trace_type d, int v, std::string a) : PrefixTree<FlipFlopNode*>(a), t_max{v}, y{d} {
+    root = pool.create(flipflop_size, nullptr);
+    root->probability.set(-1, 0);
+    root->probability_flip.set(-1, log(0.5));
+    root->probability_flop.set(-1, log(0.5));
   }
 
+  // paths have to leave the root at t=0, so it is never extended
+  void update_root(int t) {}
+
   void update_prob(FlipFlopNode* n, int t) {
-    double stay_flip = n->probability_flip_at(t-1) + y[t][n->last];
-    double stay_flop = n->probability_flop_at(t-1) + y[t][n->last + flipflop_size];
+    auto y_t = y[t-frame_offset];
+    double stay_flip = n->probability_flip_at(t-1) + y_t[n->last];
+    double stay_flop = n->probability_flop_at(t-1) + y_t[n->last + flipflop_size];
 
     double emit_flip, emit_flop;
 
     if (n->parent->depth == 0 and t==0) {
-        emit_flip = y[t][n->last];
-        emit_flop = y[t][n->last + flipflop_size];
+        emit_flip = y_t[n->last];
+        emit_flop = y_t[n->last + flipflop_size];
     } else if (n->parent->last == n->last) {
-      emit_flip = n->parent->probability_flop_at(t-1) + y[t][n->last];
-      emit_flop = n->parent->probability_flip_at(t-1) + y[t][n->last + flipflop_size];
+      emit_flip = n->parent->probability_flop_at(t-1) + y_t[n->last];
+      emit_flop = n->parent->probability_flip_at(t-1) + y_t[n->last + flipflop_size];
     } else {
-      emit_flip = logaddexp(n->parent->probability_flip_at(t-1), n->parent->probability_flop_at(t-1)) + y[t][n->last];
+      emit_flip = logaddexp(n->parent->probability_flip_at(t-1), n->parent->probability_flop_at(t-1)) + y_t[n->last];
       emit_flop = DEFAULT_VALUE;
     }
 
@@ -532,35 +663,46 @@ public:
 
     //n->set_probability(t, logaddexp(emit_flip, stay_flip), logaddexp(emit_flop, stay_flop));
     //std::cout << "Looking at parent:" << this->get_label(n->parent) << ": probability_flip(t-1)=" << n->parent->probability_flip_at(t-1) << ": probability_flop(t-1)=" << n->parent->probability_flop_at(t-1) << "\n";
-    //std::cout << y[t][n->last] << " " << y[t][n->last + flipflop_size] << "\n";
+    //std::cout << y_t[n->last] << " " << y_t[n->last + flipflop_size] << "\n";
     //std::cout << this->get_label(n) << " at t=" << t << ":" <<  exp(emit_flip) << "+" << exp(stay_flip) << "," << exp(emit_flop) << "+" << exp(stay_flop) << "=" << n->probability_at(t) << "\n";
   }
 
 };
 
+template <class TScalar>
 class FlipFlopPrefixTree2D : public PrefixTree<FlipFlopNode2D*> {
 public:
+  typedef TScalar scalar_type;
+  typedef ArrayView<TScalar> trace_type;
   static const int dim = 2;
-  double **y[dim];
+  trace_type y[dim];
   int t_max[dim];
   int flipflop_size = alphabet.length();
+  int window_floor = -1;
 
-  FlipFlopPrefixTree2D(double **d1, int u, double **d2, int v, std::string a) : PrefixTree<FlipFlopNode2D*>(a) {
+  FlipFlopPrefixTree2D(trace_type d1, int u, trace_type d2, int v, std::string a) : PrefixTree<FlipFlopNode2D*>(a) {
     y[0] = d1;
     y[1] = d2;
     t_max[0] = u;
     t_max[1] = v;
 
-    root = new FlipFlopNode2D(flipflop_size);
-    root->probability[0][-1] = 0;
-    root->probability[1][-1] = 0;
-    root->probability_flip[0][-1] = log(0.5);
-    root->probability_flop[0][-1] = log(0.5);
-    root->probability_flip[1][-1] = log(0.5);
-    root->probability_flop[1][-1] = log(0.5);
+    root = pool.create(flipflop_size, nullptr);
+    for (int i=0; i<dim; ++i) {
+      root->probability[i].set(-1, 0, -1);
+      root->probability_flip[i].set(-1, log(0.5), -1);
+      root->probability_flop[i].set(-1, log(0.5), -1);
+    }
+  }
+
+  void set_window_floor(int t) {
+    window_floor = t;
   }
 
-  void update_prob(FlipFlopNode2D* n, int i, int t) {
+  int floor(int i, int t) const {
+    return (i == 0) ? t-1 : window_floor;
+  }
+
+  ReadProbability compute_prob(FlipFlopNode2D* n, int i, int t) const {
     double stay_flip = n->probability_flip_at(i, t-1) + y[i][t][n->last];
     double stay_flop = n->probability_flop_at(i, t-1) + y[i][t][n->last + flipflop_size];
 
@@ -591,34 +733,50 @@ public:
     flip_prob = DEFAULT_VALUE;
     */
 
-    n->set_probability(i, t, flip_prob, flop_prob);
+    return {logaddexp(flip_prob, flop_prob), flip_prob, flop_prob};
+  }
+
+  void store_prob(FlipFlopNode2D* n, int i, int t, const ReadProbability& p, int floor) {
+    n->set_probability(i, t, p.a, p.b, floor);
+  }
+
+  void update_prob(FlipFlopNode2D* n, int i, int t) {
+    store_prob(n, i, t, compute_prob(n, i, t), floor(i, t));
   }
 };
 
+template <class TScalar>
 class BonitoPrefixTree : public PrefixTree<BonitoNode*> {
 public:
+  typedef TScalar scalar_type;
+  typedef ArrayView<TScalar> trace_type;
   int t_max;
-  double **y;
+  trace_type y;
   int gap_char;
+  int frame_offset = 0;
 
-  BonitoPrefixTree(double **d, int v, std::string a) : PrefixTree<BonitoNode*>(a), y{d}, t_max{v} {
+  BonitoPrefixTree(trace_type d, int v, std::string a) : PrefixTree<BonitoNode*>(a), t_max{v}, y{d} {
     gap_char = alphabet.length();
-    root = new BonitoNode(gap_char);
-    root->probability[-1] = 0;
-    root->probability_gap[-1] = 0;
-    root->probability_no_gap[-1] = DEFAULT_VALUE;
+    root = pool.create(gap_char, nullptr);
+    root->probability.set(-1, 0);
+    root->probability_gap.set(-1, 0);
+    root->probability_no_gap.set(-1, DEFAULT_VALUE);
   }
 
+  // paths have to leave the root at t=0, so it is never extended
+  void update_root(int t) {}
+
   void update_prob(BonitoNode* n, int t) {
-    double gap_prob = n->probability_at(t-1) + y[t][gap_char];
+    auto y_t = y[t-frame_offset];
+    double gap_prob = n->probability_at(t-1) + y_t[gap_char];
     double no_gap_prob;
 
     if (n->parent->depth == 0 and t==0) {
-        no_gap_prob = y[t][n->last];
+        no_gap_prob = y_t[n->last];
     } else if (n->parent->last == n->last) {
-      no_gap_prob = logaddexp(n->parent->probability_gap_at(t-1) + y[t][n->last], n->probability_no_gap_at(t-1) + y[t][n->last]);
+      no_gap_prob = logaddexp(n->parent->probability_gap_at(t-1) + y_t[n->last], n->probability_no_gap_at(t-1) + y_t[n->last]);
     } else {
-      no_gap_prob = logaddexp(n->parent->probability_at(t-1) + y[t][n->last], n->probability_no_gap_at(t-1) + y[t][n->last]);
+      no_gap_prob = logaddexp(n->parent->probability_at(t-1) + y_t[n->last], n->probability_no_gap_at(t-1) + y_t[n->last]);
     }
 
     n->set_probability(t, gap_prob, no_gap_prob);
@@ -627,30 +785,41 @@ public:
 
 };
 
+template <class TScalar>
 class BonitoPrefixTree2D : public PrefixTree<BonitoNode2D*> {
 public:
+  typedef TScalar scalar_type;
+  typedef ArrayView<TScalar> trace_type;
   static const int dim = 2;
   int t_max[dim];
-  double **y[dim];
+  trace_type y[dim];
   int gap_char;
+  int window_floor = -1;
 
-  BonitoPrefixTree2D(double **d1, int u, double **d2, int v, std::string a) : PrefixTree<BonitoNode2D*>(a) {
+  BonitoPrefixTree2D(trace_type d1, int u, trace_type d2, int v, std::string a) : PrefixTree<BonitoNode2D*>(a) {
 
     y[0] = d1;
     y[1] = d2;
     t_max[0] = u;
     t_max[1] = v;
     gap_char = alphabet.length();
-    root = new BonitoNode2D(gap_char);
-    root->probability[0][-1] = 0;
-    root->probability[1][-1] = 0;
-    root->probability_gap[0][-1] = 0;
-    root->probability_gap[1][-1] = 0;
-    root->probability_no_gap[0][-1] = DEFAULT_VALUE;
-    root->probability_no_gap[0][-1] = DEFAULT_VALUE;
+    root = pool.create(gap_char, nullptr);
+    for (int i=0; i<dim; ++i) {
+      root->probability[i].set(-1, 0, -1);
+      root->probability_gap[i].set(-1, 0, -1);
+      root->probability_no_gap[i].set(-1, DEFAULT_VALUE, -1);
+    }
   }
 
-  void update_prob(BonitoNode2D* n, int i, int t) {
+  void set_window_floor(int t) {
+    window_floor = t;
+  }
+
+  int floor(int i, int t) const {
+    return (i == 0) ? t-1 : window_floor;
+  }
+
+  ReadProbability compute_prob(BonitoNode2D* n, int i, int t) const {
     double gap_prob = n->probability_at(i, t-1) + y[i][t][gap_char];
     double no_gap_prob;
 
@@ -662,16 +831,36 @@ public:
       no_gap_prob = logaddexp(n->parent->probability_at(i,t-1) + y[i][t][n->last], n->probability_no_gap_at(i,t-1) + y[i][t][n->last]);
     }
 
-    n->set_probability(i, t, gap_prob, no_gap_prob);
+    return {logaddexp(gap_prob, no_gap_prob), gap_prob, no_gap_prob};
+  }
 
+  void store_prob(BonitoNode2D* n, int i, int t, const ReadProbability& p, int floor) {
+    n->set_probability(i, t, p.a, p.b, floor);
+  }
+
+  void update_prob(BonitoNode2D* n, int i, int t) {
+    store_prob(n, i, t, compute_prob(n, i, t), floor(i, t));
   }
 
 };
 
+// For each envelope row u, the earliest time step of the second read that any
+// row from u onwards can read back (one before the smallest remaining row
+// start). Values below this are dropped from the nodes of the 2D trees.
+std::vector<int> envelope_window_floors(ArrayView<int> envelope_ranges, int U) {
+    std::vector<int> floors(U);
+    int row_min = std::numeric_limits<int>::max();
+    for (int u=U-1; u>=0; --u) {
+        row_min = std::min(row_min, envelope_ranges[u][0]);
+        floors[u] = row_min - 1;
+    }
+    return floors;
+}
+
 // Use existing PrefixTree data structure to calculate forward probabilities
 //  instead of explicit DP matrix. Should produce identical results.
 template <class TNode, class TTree>
-double forward_(double **y, int t_max, std::string label, std::string alphabet) {
+double forward_(typename TTree::trace_type y, int t_max, std::string label, std::string alphabet) {
 
     int s_max = label.length();
     int alphabet_size = alphabet.length();
@@ -692,11 +881,16 @@ double forward_(double **y, int t_max, std::string label, std::string alphabet)
 
     auto currNode = tree.root;
     for (int s=0; s<s_max; s++) {
-        currNode = currNode->add_child(label_int[s]);
+        currNode = tree.add_child(currNode, label_int[s]);
         substrings.push_back(currNode);
-        //currNode->set_probability(0, y[0][label_int[0]], y[0][label_int[0]+tree.flipflop_size]);
-        for (int t=0; t<t_max; t++) {
-            tree.update_prob(currNode, t);
+    }
+
+    // nodes only keep the last two time steps, so sweep over time in the outer
+    // loop and update each prefix from its parent at t-1
+    for (int t=0; t<t_max; t++) {
+        tree.update_root(t);
+        for (int s=0; s<s_max; s++) {
+            tree.update_prob(substrings[s], t);
         }
     }
 
@@ -711,13 +905,14 @@ double forward_(double **y, int t_max, std::string label, std::string alphabet)
     return currNode->last_probability();
 }
 
-double forward(double **y, int t_max, std::string label, std::string alphabet, std::string model="ctc") {
+template <class T>
+double forward(ArrayView<T> y, int t_max, std::string label, std::string alphabet, std::string model="ctc") {
     if (model == "ctc") {
-        return forward_<PoreOverNode, PoreOverPrefixTree>(y, t_max, label, alphabet);
+        return forward_<PoreOverNode, PoreOverPrefixTree<T>>(y, t_max, label, alphabet);
     } else if (model == "ctc_merge_repeats") {
-        return forward_<BonitoNode, BonitoPrefixTree>(y, t_max, label, alphabet);
+        return forward_<BonitoNode, BonitoPrefixTree<T>>(y, t_max, label, alphabet);
     } else if (model == "ctc_flipflop") {
-        return forward_<FlipFlopNode, FlipFlopPrefixTree>(y, t_max, label, alphabet);
+        return forward_<FlipFlopNode, FlipFlopPrefixTree<T>>(y, t_max, label, alphabet);
     }
 }
 
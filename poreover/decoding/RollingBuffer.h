@@ -0,0 +1,98 @@
+#ifndef ROLLING_BUFFER_HPP
+#define ROLLING_BUFFER_HPP
+
+#include <vector>
+#include <limits>
+#include <algorithm>
+
+#define DEFAULT_VALUE -std::numeric_limits<double>::infinity()
+
+// Forward probabilities of a node along a single read. Nodes are only ever
+// updated at time t from values at t-1, so two slots are enough. Each slot is
+// tagged with its time step so that stale values left over from an earlier
+// visit to the node read as DEFAULT_VALUE.
+class RollingBuffer {
+  private:
+    int time[2] = {std::numeric_limits<int>::min(), std::numeric_limits<int>::min()};
+    double values[2] = {DEFAULT_VALUE, DEFAULT_VALUE};
+
+  public:
+    double at(int t) const {
+      int slot = t & 1;
+      if (time[slot] == t) {
+        return values[slot];
+      } else {
+        return DEFAULT_VALUE;
+      }
+    }
+
+    void set(int t, double x) {
+      int slot = t & 1;
+      time[slot] = t;
+      values[slot] = x;
+    }
+};
+
+// Forward probabilities of a node over a contiguous window of time steps,
+// used for pair decoding where the second read is swept once per envelope row.
+// Values before floor can no longer be read and are discarded on each write,
+// so the window never grows beyond the envelope row width. Dropped values
+// stay in the vector until they make up most of it, and an empty buffer
+// allocates nothing, which matters since every 2D node has several of them.
+class WindowBuffer {
+  private:
+    // time step of values[offset], values before offset have been dropped
+    int start = 0;
+    int offset = 0;
+    std::vector<double> values;
+
+  public:
+    double at(int t) const {
+      if ((t < start) || (t >= start + size())) {
+        return DEFAULT_VALUE;
+      } else {
+        return values[offset + t - start];
+      }
+    }
+
+    void set(int t, double x, int floor) {
+      // drop values that fall below the window
+      if (size() > 0 && start < floor) {
+        int drop = std::min(floor - start, size());
+        offset += drop;
+        start += drop;
+      }
+      if (size() == 0) {
+        values.clear();
+        offset = 0;
+        start = t;
+      }
+      if (t < start) {
+        int grow = start - t;
+        if (grow <= offset) {
+          offset -= grow;
+          std::fill(values.begin() + offset, values.begin() + offset + grow, DEFAULT_VALUE);
+        } else {
+          values.insert(values.begin() + offset, grow - offset, DEFAULT_VALUE);
+          std::fill(values.begin(), values.begin() + offset, DEFAULT_VALUE);
+          offset = 0;
+        }
+        start = t;
+      }
+      if (t >= start + size()) {
+        values.resize(offset + t - start + 1, DEFAULT_VALUE);
+      }
+      values[offset + t - start] = x;
+
+      if (offset > 16 && offset > size()) {
+        values.erase(values.begin(), values.begin() + offset);
+        offset = 0;
+      }
+    }
+
+    int size() const {
+      return values.size() - offset;
+    }
+};
+
+#endif
@@ -0,0 +1,109 @@
+#ifndef THREAD_POOL_HPP
+#define THREAD_POOL_HPP
+
+#include <vector>
+#include <thread>
+#include <mutex>
+#include <condition_variable>
+#include <atomic>
+#include <functional>
+
+#include "Log.h"
+
+// Fixed set of worker threads for fork-join loops. The calling thread takes
+// part in each loop, so a pool of size 1 has no workers and runs inline.
+// Workers stay parked between loops, which keeps the cost of a loop low enough
+// to run one per wavefront of a DP.
+class ThreadPool {
+  private:
+    std::vector<std::thread> workers;
+    std::mutex mutex;
+    std::condition_variable start_cv;
+    std::condition_variable done_cv;
+    const std::function<void(int)> *task = nullptr;
+    int task_size = 0;
+    // logaddexp mode of the thread that started the task
+    LogMode task_log_mode = LOG_EXACT;
+    std::atomic<int> next_index{0};
+    int active = 0;
+    long generation = 0;
+    bool stop = false;
+
+    void run_task() {
+      for (int i = next_index++; i < task_size; i = next_index++) {
+        (*task)(i);
+      }
+    }
+
+    void worker_loop() {
+      long seen = 0;
+      while (true) {
+        {
+          std::unique_lock<std::mutex> lock(mutex);
+          start_cv.wait(lock, [&]{ return stop || generation != seen; });
+          if (stop) {
+            return;
+          }
+          seen = generation;
+          log_mode = task_log_mode;
+        }
+        run_task();
+        {
+          std::lock_guard<std::mutex> lock(mutex);
+          if (--active == 0) {
+            done_cv.notify_one();
+          }
+        }
+      }
+    }
+
+  public:
+    ThreadPool(int threads) {
+      for (int i=1; i<threads; i++) {
+        workers.emplace_back(&ThreadPool::worker_loop, this);
+      }
+    }
+
+    ~ThreadPool() {
+      {
+        std::lock_guard<std::mutex> lock(mutex);
+        stop = true;
+      }
+      start_cv.notify_all();
+      for (auto& w : workers) {
+        w.join();
+      }
+    }
+
+    ThreadPool(const ThreadPool&) = delete;
+    ThreadPool& operator=(const ThreadPool&) = delete;
+
+    int size() const {
+      return workers.size() + 1;
+    }
+
+    // call f(i) for each i in [0,n) and return once all calls have finished
+    void parallel_for(int n, const std::function<void(int)>& f) {
+      if (workers.empty() || n <= 1) {
+        for (int i=0; i<n; i++) {
+          f(i);
+        }
+        return;
+      }
+      {
+        std::lock_guard<std::mutex> lock(mutex);
+        task = &f;
+        task_size = n;
+        task_log_mode = log_mode;
+        next_index = 0;
+        active = workers.size();
+        generation++;
+      }
+      start_cv.notify_all();
+      run_task();
+      std::unique_lock<std::mutex> lock(mutex);
+      done_cv.wait(lock, [&]{ return active == 0; });
+    }
+};
+
+#endif
@@ -0,0 +1,128 @@
+#ifndef VITERBI_H
+#define VITERBI_H
+
+#include <string>
+#include <vector>
+#include <cstdint>
+
+#include "ArrayView.h"
+
+/*
+Viterbi (best path) decoding for the fixed transducer topologies, fills
+path[t] with the state of frame t and returns the sequence.
+
+ctc: bases of the alphabet then a blank. Every transition is allowed so the
+best path is the best state of each frame and every base state emits.
+ctc_merge_repeats: same path, a repeated state emits once (bonito).
+ctc_flipflop: flip states A,C,G,T (0-3) and flop states a,c,g,t (4-7). Any
+state can move to a flip state, the flop state of a base can only be
+entered from the flip or flop state of that base. Every change of state
+emits a base. Ties go to the lowest state, as with numpy.argmax.
+*/
+
+template <class T>
+std::string viterbi_ctc(ArrayView<T> y, int t_max, std::string alphabet, bool merge_repeats, int *path) {
+  int num_states = alphabet.length() + 1;
+  std::string sequence;
+  int prev = -1;
+  for (int t=0; t<t_max; ++t) {
+    auto row = y[t];
+    int best = 0;
+    for (int k=1; k<num_states; ++k) {
+      if (row[k] > row[best]) {
+        best = k;
+      }
+    }
+    path[t] = best;
+    if (best < num_states-1 && !(merge_repeats && best == prev)) {
+      sequence += alphabet[best];
+    }
+    prev = best;
+  }
+  return sequence;
+}
+
+template <class T>
+std::string viterbi_flipflop(ArrayView<T> y, int t_max, std::string alphabet, int *path) {
+  std::string sequence;
+  if (t_max == 0) {
+    return sequence;
+  }
+
+  // best previous state of each state and frame
+  std::vector<std::uint8_t> ptr(std::size_t(t_max)*8);
+  double v[8], next[8];
+
+  for (int k=0; k<8; ++k) {
+    v[k] = y[0][k];
+  }
+  for (int t=1; t<t_max; ++t) {
+    auto row = y[t];
+    std::uint8_t *ptr_t = &ptr[std::size_t(t)*8];
+    int best = 0;
+    for (int k=1; k<8; ++k) {
+      if (v[k] > v[best]) {
+        best = k;
+      }
+    }
+    for (int b=0; b<4; ++b) {
+      // flip from any state
+      next[b] = v[best] + row[b];
+      ptr_t[b] = best;
+      // flop from the flip or flop of the same base
+      if (v[b] >= v[b+4]) {
+        next[b+4] = v[b] + row[b+4];
+        ptr_t[b+4] = b;
+      } else {
+        next[b+4] = v[b+4] + row[b+4];
+        ptr_t[b+4] = b+4;
+      }
+    }
+    for (int k=0; k<8; ++k) {
+      v[k] = next[k];
+    }
+  }
+
+  // traceback
+  int state = 0;
+  for (int k=1; k<8; ++k) {
+    if (v[k] > v[state]) {
+      state = k;
+    }
+  }
+  for (int t=t_max-1; t>=0; --t) {
+    path[t] = state;
+    state = ptr[std::size_t(t)*8 + state];
+  }
+
+  for (int t=0; t<t_max; ++t) {
+    if (t == 0 || path[t] != path[t-1]) {
+      sequence += alphabet[path[t] % 4];
+    }
+  }
+  return sequence;
+}
+
+template <class T>
+std::string viterbi(ArrayView<T> y, int t_max, std::string alphabet, std::string model, int *path) {
+  if (model == "ctc_merge_repeats") {
+    return viterbi_ctc(y, t_max, alphabet, true, path);
+  } else if (model == "ctc_flipflop") {
+    return viterbi_flipflop(y, t_max, alphabet, path);
+  } else {
+    return viterbi_ctc(y, t_max, alphabet, false, path);
+  }
+}
+
+// reads concatenated in y, read i spans frames offsets[i] to offsets[i+1]
+template <class T>
+std::vector<std::string> viterbi_batch(ArrayView<T> y, std::vector<long> offsets, std::string alphabet, std::string model, int *path) {
+  std::vector<std::string> sequences;
+  for (std::size_t i=0; i+1 < offsets.size(); ++i) {
+    ArrayView<T> read(y.data + offsets[i]*y.row_stride, y.row_stride, y.columns);
+    sequences.push_back(viterbi(read, offsets[i+1]-offsets[i], alphabet, model, path + offsets[i]));
+  }
+  return sequences;
+}
+
+#endif
@@ -1,4 +1,4 @@
-from . import decoding_cy, decoding_cpp, decode, prefix_search, transducer, envelope, pair_decode
+from . import decoding_cy, decoding_cpp, decode, prefix_search, transducer, envelope, journal, pair_decode
 from .decoding_cpp import cpp_beam_search, cpp_beam_search_2d
 from .decoding_cpp import *
 from .decoding_cy import *
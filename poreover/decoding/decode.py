@@ -6,14 +6,18 @@ import glob
 from scipy.special import logsumexp
 
 from multiprocessing import Pool, get_logger
+from multiprocessing.pool import ThreadPool
 import logging
 import copy
+import functools
 import progressbar
 from itertools import starmap
 
 from . import prefix_search
 from . import decoding_cpp
 from . import transducer
+from . import journal
+import poreover.align as align
 import poreover.network as network
 
 def fasta_format(name, seq, width=60):
@@ -25,6 +29,61 @@ def fasta_format(name, seq, width=60):
     fasta += (seq[window:]+'\n')
     return(fasta)
 
+def join_overlapping(seq1, seq2, overlap1, overlap2):
+    '''
+    Join two decoded segments whose last overlap1 and first overlap2 bases come
+    from the same stretch of signal. The overlaps are aligned and the sequences
+    are cut at the match closest to the middle of the alignment, away from the
+    segment ends where decoding is least reliable.
+    '''
+    overlap1 = min(overlap1, len(seq1))
+    overlap2 = min(overlap2, len(seq2))
+    if overlap1 == 0 or overlap2 == 0:
+        return(seq1 + seq2[overlap2:])
+    tail, head = seq1[len(seq1)-overlap1:], seq2[:overlap2]
+    align1, align2, _ = align.global_pair(tail, head)
+
+    # bases of each sequence before every alignment column
+    offset1 = np.cumsum([0] + [c != '-' for c in align1])
+    offset2 = np.cumsum([0] + [c != '-' for c in align2])
+    middle = len(align1) // 2
+    matches = [i for i in range(len(align1)) if align1[i] == align2[i]]
+    cut = min(matches, key=lambda i: abs(i-middle)) if matches else middle
+    return(seq1[:len(seq1)-overlap1+offset1[cut]] + seq2[offset2[cut]:])
+
+def split_chunks(length, chunk_size, overlap):
+    '''
+    Split length frames into chunks of chunk_size frames that overlap by
+    overlap frames, returns (start, end) of each chunk
+    '''
+    if chunk_size <= 0 or chunk_size >= length:
+        return([(0, length)])
+    if overlap >= chunk_size:
+        raise ValueError('Chunk overlap ({}) must be smaller than the chunk size ({})'.format(overlap, chunk_size))
+    chunks = []
+    start = 0
+    while True:
+        end = min(start+chunk_size, length)
+        chunks.append((start, end))
+        if end == length:
+            break
+        start += chunk_size - overlap
+    return(chunks)
+
+def join_chunks(sequences, chunks):
+    '''
+    Join the sequences decoded from overlapping (start, end) chunks of a read.
+    The overlaps in bases are estimated assuming a constant rate along each
+    chunk and then aligned by join_overlapping.
+    '''
+    joined = sequences[0]
+    for i in range(1, len(chunks)):
+        overlap = chunks[i-1][1] - chunks[i][0]
+        overlap1 = int(round(overlap / (chunks[i-1][1]-chunks[i-1][0]) * len(sequences[i-1])))
+        overlap2 = int(round(overlap / (chunks[i][1]-chunks[i][0]) * len(sequences[i])))
+        joined = join_overlapping(joined, sequences[i], overlap1, overlap2)
+    return(joined)
+
 def softmax(logits):
     dim = len(logits.shape)
     axis_to_sum = dim-1
@@ -63,34 +122,74 @@ def trace_from_guppy(p):
     hdf.close()
     return(trace)
 
-def model_from_trace(f, basecaller=""):
-    # infer model type from file
+def trace_length(f, basecaller=""):
+    # number of frames in a trace, from the .npy header or HDF5 dataset shape
+    # so that the trace itself is not loaded
+    file_name, file_extension = os.path.splitext(f)
+    if file_extension == '.npy':
+        shape = np.load(f, mmap_mode='r').shape
+        return(int(np.prod(shape[:-1])))
+    elif file_extension == '.csv':
+        with open(f) as csv:
+            return(sum(1 for line in csv) - 1)
+    elif file_extension == '.hdf5' or basecaller == 'flappie':
+        with h5py.File(f, 'r') as hdf:
+            return(hdf[list(hdf)[0]]['trace'].shape[0])
+    elif file_extension == '.fast5' or basecaller == 'guppy':
+        with h5py.File(f, 'r') as hdf:
+            return(hdf['/Analyses/Basecall_1D_000/BaseCalled_template/Trace'].shape[0])
+    else:
+        raise ValueError("Can't read the trace length of {}".format(f))
+
+# --engine auto decodes in batches when there are at least this many reads
+# and the median read is at most this many frames
+BATCH_MIN_READS = 64
+BATCH_MAX_FRAMES = 20000
+
+def choose_engine(in_files, args):
+    '''
+    Engine for --engine auto. Many short reads decoded whole by viterbi or
+    beam search go in batches, where the per read overhead would dominate,
+    anything else to a process pool. Read lengths come from a sample of the
+    files.
+    '''
+    if args.algorithm == 'prefix' or getattr(args, 'chunk_size', 0) > 0 or len(in_files) < BATCH_MIN_READS:
+        return('processes')
+    try:
+        lengths = [trace_length(f, args.basecaller) for f in in_files[:BATCH_MIN_READS]]
+    except ValueError:
+        return('processes')
+    return('batch' if np.median(lengths) <= BATCH_MAX_FRAMES else 'processes')
+
+def model_from_trace(f, basecaller="", precision="float64"):
+    # infer model type from file, precision sets the dtype of model.log_prob
+    dtype = {"float64":np.float64, "float32":np.float32}[precision]
     file_name, file_extension = os.path.splitext(f)
     if file_extension == '.npy' and basecaller == 'poreover':
         try:
             trace = load_logits(f, flatten=True)
-            model = transducer.poreover(trace)
+            model = transducer.poreover(trace, dtype=dtype)
         except:
             raise
     elif file_extension == '.npy' and basecaller == 'bonito':
             try:
                 trace = load_logits(f, flatten=True)
-                trace = trace[::,[1,2,3,4,0]]
-                model = transducer.bonito(trace)
+                # blank is the first column of bonito output
+                model = transducer.bonito(trace, dtype=dtype, columns=[1,2,3,4,0])
             except:
                 raise
     elif file_extension == '.csv':
         trace = np.log(np.loadtxt(f, delimiter=',', skiprows=1))
         if trace.shape[1] == 5:
-            model = transducer.poreover(trace)
+            model = transducer.poreover(trace, dtype=dtype)
         elif trace.shape[1] == 8:
-            model = transducer.flipflop(trace)
+            model = transducer.flipflop(trace, dtype=dtype)
     elif file_extension == '.hdf5' or basecaller == 'flappie':
         try:
             trace = trace_from_flappie(f)
             eps = 0.0000001
             trace = np.log((trace + eps)/(255 + eps))
-            model = transducer.flipflop(trace)
+            model = transducer.flipflop(trace, dtype=dtype)
         except:
             raise
     elif file_extension == '.fast5' or basecaller == 'guppy':
@@ -98,7 +197,7 @@ def model_from_trace(f, basecaller=""):
             trace = trace_from_guppy(f)
             eps = 0.0000001
             trace = np.log((trace + eps)/(255 + eps))
-            model = transducer.flipflop(trace)
+            model = transducer.flipflop(trace, dtype=dtype)
         except:
             raise
     else:
@@ -137,55 +236,127 @@ def decode(args):
             in_files = glob.glob("{}/*{}".format(in_path[0], file_ext))
 
     if len(in_files) > 1:
+        # with --journal finished reads are journaled so that an interrupted
+        # run can --resume, which keeps journaling
+        resume = getattr(args, 'resume', False)
+        journal_path = args.out+'.journal' if getattr(args, 'journal', False) or resume else None
+        done = journal.journal(journal_path, [args.out+'.fasta'], resume)
+        remaining = [p for p in in_files if p not in done]
+
         # set up progressbar and manage output
         class callback_helper:
             def __init__(self):
                 self.counter = 0
-                self.pbar = progressbar.ProgressBar(max_value=len(in_files))
-                self.out_f = open(args.out+'.fasta','w')
-            def callback(self, x):
+                self.pbar = progressbar.ProgressBar(max_value=len(remaining))
+                self.out_f = done.files[0]
+            def callback(self, in_file, x):
                 self.counter += 1
                 self.pbar.update(self.counter)
                 print(x, file=self.out_f)
+                done.record(in_file)
         callback_helper_ = callback_helper()
 
         bullet_point = u'\u25B8'+" "
         logger.info(bullet_point + "found {} reads to decode".format(len(in_files)))
+        if resume:
+            logger.info(bullet_point + "resuming, {} reads already decoded".format(len(in_files)-len(remaining)))
         logger.info(bullet_point + "writing sequences to {0}.fasta".format(args.out))
-        logger.info(bullet_point + "starting {} decoding processes...".format(args.threads))
+        engine = getattr(args, 'engine', 'processes')
+        if engine == 'auto':
+            engine = choose_engine(remaining, args)
+
+        if engine == 'batch' and args.algorithm == 'prefix':
+            logger.warning(bullet_point + "prefix search is not batched, decoding reads in threads")
+            engine = 'threads'
+        elif engine == 'batch' and getattr(args, 'chunk_size', 0) > 0:
+            logger.warning(bullet_point + "batches decode whole reads, decoding chunks in threads")
+            engine = 'threads'
+        logger.info(bullet_point + "starting {} decoding {}...".format(args.threads, engine))
 
-        with Pool(processes=args.threads) as pool:
-            for p in in_files:
-                pool.apply_async(decode_helper, (p, args,), callback=callback_helper_.callback)
-            pool.close()
-            pool.join()
+        if engine == 'batch':
+            # one C++ call per batch of reads, decoded on its own threads
+            batch_size = getattr(args, 'batch_size', 256)
+            for i in range(0, len(remaining), batch_size):
+                batch = remaining[i:i+batch_size]
+                for p, x in zip(batch, decode_batch(batch, args)):
+                    callback_helper_.callback(p, x)
+        else:
+            # threads share the process memory, the C++ decoders run without the GIL
+            pool_type = ThreadPool if engine == 'threads' else Pool
+            with pool_type(processes=args.threads) as pool:
+                for p in remaining:
+                    pool.apply_async(decode_helper, (p, args,), callback=functools.partial(callback_helper_.callback, p))
+                pool.close()
+                pool.join()
+        done.close()
 
     else:
         seqs = decode_helper(in_path[0], args)
         with open(args.out+'.fasta', 'w') as out_fasta:
             print(seqs, file=out_fasta)
 
-def decode_helper(in_path, args):
-    # load probabilities from running basecaller
-    model = model_from_trace(in_path, args.basecaller)
-    model_type = {'poreover':'ctc','bonito':'ctc_merge_repeats','guppy':'ctc_flipflop','flappie':'ctc_flipflop','flipflop':'ctc_flipflop'}
+# decoder model of each kind of transducer
+model_type = {'poreover':'ctc','bonito':'ctc_merge_repeats','guppy':'ctc_flipflop','flappie':'ctc_flipflop','flipflop':'ctc_flipflop'}
 
+def decode_model(model, args, window=0):
     # call appropriate decoding function
     if args.algorithm == 'viterbi':
         sequence = model.viterbi_decode()
     elif args.algorithm == 'beam':
-        sequence = decoding_cpp.cpp_beam_search(model.log_prob, args.beam_width, "ACGT", model_type[model.kind])
+        sequence = decoding_cpp.cpp_beam_search(model.trace, args.beam_width, "ACGT", model_type[model.kind], columns_=model.columns)
     elif args.algorithm == 'prefix':
         assert(model.kind == "poreover")
-        # for comparing with previous results
-        window = args.window
-        i = 0
-        sequence = ""
-        while i+window < model.t_max:
-            sequence += prefix_search.prefix_search_log_cy(model.log_prob[i:i+window])[0]
-            i += window
-        sequence += prefix_search.prefix_search_log_cy(model.log_prob[i:])[0]
+        # memory is linear in the window, 0 searches the whole read at once
+        window = window if window > 0 else max(model.t_max, 1)
+        sequence = ''.join(decoding_cpp.cpp_prefix_search_log(model.trace[i:i+window], columns_=model.columns)[0] for i in range(0, model.t_max, window))
+    return(sequence)
+
+def decode_helper(in_path, args):
+    # set in each worker since decoding can run in a process or thread pool
+    decoding_cpp.cpp_set_log_mode(getattr(args, 'logaddexp', 'exact'))
+
+    # load probabilities from running basecaller
+    model = model_from_trace(in_path, args.basecaller, getattr(args, 'precision', 'float64'))
+
+    # overlapping chunks of a long read are decoded in threads, the C++
+    # decoders release the GIL so they run concurrently
+    chunks = split_chunks(model.t_max, getattr(args, 'chunk_size', 0), getattr(args, 'chunk_overlap', 200))
+    if len(chunks) == 1:
+        sequence = decode_model(model, args, args.window)
+    else:
+        # each chunk is prefix searched as a whole instead of in windows
+        with ThreadPool(processes=getattr(args, 'chunk_threads', 1), initializer=decoding_cpp.cpp_set_log_mode, initargs=(getattr(args, 'logaddexp', 'exact'),)) as pool:
+            sequences = pool.map(lambda chunk: decode_model(model.chunk(*chunk), args, 0), chunks)
+        sequence = join_chunks(sequences, chunks)
 
     # output decoded sequence
     fasta_header = os.path.basename(in_path)
     return fasta_format(fasta_header, sequence)
+
+def decode_batch(in_paths, args):
+    '''
+    Viterbi or beam search decode a batch of reads with one C++ call, which
+    saves the per read overhead on many short reads. Reads with the same
+    model are concatenated into a single trace. Returns the FASTA records in
+    the order of in_paths.
+    '''
+    decoding_cpp.cpp_set_log_mode(getattr(args, 'logaddexp', 'exact'))
+    models = [model_from_trace(p, args.basecaller, getattr(args, 'precision', 'float64')) for p in in_paths]
+
+    groups = {}
+    for i, model in enumerate(models):
+        columns = None if model.columns is None else tuple(model.columns)
+        groups.setdefault((model.kind, columns), []).append(i)
+
+    sequences = [None]*len(models)
+    for (kind, columns), reads in groups.items():
+        trace = np.concatenate([models[i].trace for i in reads])
+        offsets = np.concatenate(([0], np.cumsum([models[i].t_max for i in reads])))
+        if args.algorithm == 'beam':
+            batch = decoding_cpp.cpp_beam_search_batch(trace, offsets, args.beam_width, "ACGT", model_type[kind], threads=args.threads, columns_=columns)
+        else:
+            batch, _ = decoding_cpp.cpp_viterbi_batch(trace, offsets, "ACGT", model_type[kind], columns)
+        for i, sequence in zip(reads, batch):
+            sequences[i] = sequence
+
+    return([fasta_format(os.path.basename(p), sequence) for p, sequence in zip(in_paths, sequences)])
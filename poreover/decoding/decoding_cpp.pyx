@@ -7,104 +7,375 @@ import numpy as np
 from cpython cimport array
 from libcpp cimport bool
 from libc.stdlib cimport malloc, free
+from libc.stddef cimport ptrdiff_t
 from libcpp.string cimport string
+from libcpp.vector cimport vector
 
 DTYPE = np.float64
 ctypedef np.float64_t DTYPE_t
 
-cdef extern from "BeamSearch.h":
-    string beam_search(double**, int, string, int, string)
-    string beam_search(double**, double**, int, int, string, int**, int, string, string)
-    string beam_search(double**, double**, int, int, string, int, string, string)
-    double forward(double**, int, string, string, string)
+# Traces are decoded in the precision they are passed in, float32 traces are
+# not copied to float64. Probabilities are accumulated in double either way.
+ctypedef fused trace_t:
+    float
+    double
 
-cdef extern from "Forward.h":
-    string viterbi_acceptor_poreover(double**, int, int, string, string alphabet)
+# The C++ kernels only touch the arrays they are given, so every call runs with
+# the GIL released and can decode in parallel with other Python threads.
 
-cdef extern from "Gamma.h":
-    double pair_gamma_log_envelope(double**, double**, int**, int, int, int)
+# Arrays are passed to C++ as a base pointer and strides, so slices, reversed
+# views and column permutations reach the kernels without a copy.
+cdef extern from "ArrayView.h" nogil:
+    cdef cppclass ArrayView[T]:
+        ArrayView()
+        ArrayView(const T*, ptrdiff_t, const ptrdiff_t*)
 
-cdef extern from "PairPrefixSearch.cpp":
-    pass
+cdef extern from "BeamSearch.h" nogil:
+    string beam_search[T](ArrayView[T], int, string, int, string, string)
+    vector[string] beam_search_batch[T](ArrayView[T], vector[long], string, int, string, string, int)
+    string beam_search[T](ArrayView[T], ArrayView[T], int, int, string, ArrayView[int], int, string, string, string, int)
+    cdef cppclass BeamSearchStreamBase[T]:
+        string push(ArrayView[T], int)
+        string finish()
+    BeamSearchStreamBase[T]* beam_search_stream[T](string, int, string, string)
+    double forward[T](ArrayView[T], int, string, string, string)
+
+cdef extern from "Log.h" nogil:
+    void set_log_mode(string)
+
+cdef extern from "Acceptor.h" nogil:
+    double viterbi_acceptor[T](ArrayView[T], int, const vector[int]&, int, string, int, int*)
+
+cdef extern from "Viterbi.h" nogil:
+    vector[string] viterbi_batch[T](ArrayView[T], vector[long], string, string, int*)
 
-cdef extern from "PairPrefixSearch.h":
-    string pair_prefix_search_log(double**, double**, int**, int, int, string)
+cdef extern from "PrefixSearch.h" nogil:
+    string prefix_search[T](ArrayView[T], int, string, double&, vector[int]*)
 
-cdef double** pointer_from_array_double(double [:,:] y):
-    cdef int U = y.shape[0]
-    cdef double** point_to_y = <double **>malloc(U * sizeof(double*))
-    for u in range(U):
-        point_to_y[u] = &y[u, 0]
-    return point_to_y
+cdef extern from "Gamma.h" nogil:
+    double pair_gamma_log_envelope[TTrace, TEnvelope](const TTrace&, const TTrace&, const TEnvelope&, int, int, int)
 
-cdef int** pointer_from_array_int(int [:,:] y):
-    cdef int U = y.shape[0]
-    cdef int** point_to_y = <int **>malloc(U * sizeof(int*))
-    for u in range(U):
-        point_to_y[u] = &y[u, 0]
-    return point_to_y
+cdef extern from "PairPrefixSearch.cpp":
+    pass
+
+cdef extern from "PairPrefixSearch.h" nogil:
+    string pair_prefix_search_log[TTrace, TEnvelope](const TTrace&, const TTrace&, const TEnvelope&, int, int, string)
+
+def column_offsets(y, columns=None):
+    """Element offset of each column of y, in the order given by columns.
+
+    columns is a column map such as transducer.columns, None keeps the
+    columns in order.
+    """
+    if columns is None:
+        columns = np.arange(y.shape[1])
+    columns = np.asarray(columns, dtype=np.intp)
+    if len(columns) > 0 and (columns.min() < 0 or columns.max() >= y.shape[1]):
+        raise ValueError("Column map {} is out of range for {} columns".format(columns.tolist(), y.shape[1]))
+    return(columns * (y.strides[1] // y.itemsize))
+
+cdef as_trace(y_):
+    # keep float32 traces as they are, anything else is decoded in float64
+    if getattr(y_, "dtype", None) == np.float32:
+        y = np.asarray(y_, dtype=np.float32)
+    else:
+        y = np.asarray(y_, dtype=DTYPE)
+    # strides that are not a multiple of the item size cannot be expressed in
+    # elements, e.g. a field of a structured array
+    if y.strides[0] % y.itemsize or y.strides[1] % y.itemsize:
+        y = np.ascontiguousarray(y)
+    return(y)
+
+cdef as_envelope(envelope_ranges_):
+    y = np.asarray(envelope_ranges_, dtype=np.intc)
+    if y.strides[0] % y.itemsize or y.strides[1] % y.itemsize:
+        y = np.ascontiguousarray(y)
+    return(y)
+
+# offsets must outlive the returned view
+cdef ArrayView[trace_t] trace_view(trace_t [:,:] y, Py_ssize_t [:] offsets):
+    if y.shape[0] == 0:
+        return(ArrayView[trace_t]())
+    return(ArrayView[trace_t](&y[0, 0], y.strides[0] // sizeof(trace_t), <ptrdiff_t*>&offsets[0]))
+
+cdef ArrayView[int] envelope_view(int [:,:] y, Py_ssize_t [:] offsets):
+    if y.shape[0] == 0:
+        return(ArrayView[int]())
+    return(ArrayView[int](&y[0, 0], y.strides[0] // sizeof(int), <ptrdiff_t*>&offsets[0]))
+
+def cpp_set_log_mode(mode_="exact"):
+    """Select how logaddexp is evaluated by the C++ kernels called from this
+    thread, either "exact" (libm) or "fast" (table lookup, absolute error
+    < 2e-6)."""
+    if mode_ not in ("exact", "fast"):
+        raise ValueError("Unknown logaddexp mode: {}".format(mode_))
+    set_log_mode(mode_.encode("UTF-8"))
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def cpp_forward(y_, label_, alphabet_="ACGT", model_="ctc"):
+def cpp_forward(y_, label_, alphabet_="ACGT", model_="ctc", columns_=None):
 
     cdef int U = y_.shape[0]
     cdef int alphabet_size = y_.shape[1]
     cdef string label = label_.encode("UTF-8")
     cdef string alphabet = alphabet_.encode("UTF-8")
     cdef string model = model_.encode("UTF-8")
+    cdef ArrayView[float] y_float
+    cdef ArrayView[double] y_double
     cdef double result
 
-    cdef np.ndarray[double,ndim=2,mode="c"] y = np.asarray(y_, dtype=DTYPE, order="C")
-    cdef double** point_to_y = pointer_from_array_double(y)
-
-    try:
-        result = forward(&point_to_y[0], U, label, alphabet, model)
-        return(result)
-    finally:
-        free(point_to_y)
+    y = as_trace(y_)
+    offsets = column_offsets(y, columns_)
+    if y.dtype == np.float32:
+        y_float = trace_view[float](y, offsets)
+        with nogil:
+            result = forward(y_float, U, label, alphabet, model)
+    else:
+        y_double = trace_view[double](y, offsets)
+        with nogil:
+            result = forward(y_double, U, label, alphabet, model)
+    return(result)
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def cpp_viterbi_acceptor(y_, label_, int band_size=1000, alphabet_="ACGT"):
+def cpp_prefix_search_log(y_, alphabet_="ACGT", return_path=False, columns_=None):
+    """Prefix search on a CTC trace in memory linear in its length. Returns
+    the top label and its log probability, or with return_path the label and
+    the frame of each of its bases (as pair_decode.viterbi_path)."""
 
     cdef int U = y_.shape[0]
-    cdef int alphabet_size = y_.shape[1]
-    cdef string label = label_.encode("UTF-8")
     cdef string alphabet = alphabet_.encode("UTF-8")
+    cdef ArrayView[float] y_float
+    cdef ArrayView[double] y_double
+    cdef string label
+    cdef double label_prob = -np.inf
+    cdef vector[int] path
+    cdef vector[int] *path_ptr = &path if return_path else NULL
+
+    y = as_trace(y_)
+    offsets = column_offsets(y, columns_)
+    if y.dtype == np.float32:
+        y_float = trace_view[float](y, offsets)
+        with nogil:
+            label = prefix_search(y_float, U, alphabet, label_prob, path_ptr)
+    else:
+        y_double = trace_view[double](y, offsets)
+        with nogil:
+            label = prefix_search(y_double, U, alphabet, label_prob, path_ptr)
+
+    if return_path:
+        return(label.decode("UTF-8"), np.array(path, dtype=int))
+    return(label.decode("UTF-8"), label_prob)
+
+VITERBI_MODELS = ("ctc", "ctc_merge_repeats", "ctc_flipflop")
 
-    cdef np.ndarray[double,ndim=2,mode="c"] y = np.asarray(y_, dtype=DTYPE, order="C")
-    cdef double** point_to_y = pointer_from_array_double(y)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def cpp_viterbi(y_, alphabet_="ACGT", model_="ctc", columns_=None):
+    """Best path through a trace, returns the sequence and the state of
+    every frame. model is ctc (5 states), ctc_merge_repeats or ctc_flipflop
+    (8 states)."""
+    sequences, path = cpp_viterbi_batch(y_, [0, len(y_)], alphabet_, model_, columns_)
+    return(sequences[0], path)
 
-    try:
-        path = viterbi_acceptor_poreover(&point_to_y[0], U, band_size, label, alphabet)
-    finally:
-        free(point_to_y)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def cpp_viterbi_batch(y_, offsets_, alphabet_="ACGT", model_="ctc", columns_=None):
+    """Best paths of reads concatenated in y_, read i is y_[offsets_[i]:offsets_[i+1]].
+    Returns the list of sequences and the concatenated paths, decoded in a
+    single call without the GIL."""
+    if model_ not in VITERBI_MODELS:
+        raise ValueError("Unknown model: {}".format(model_))
+    cdef string alphabet = alphabet_.encode("UTF-8")
+    cdef string model = model_.encode("UTF-8")
+    cdef ArrayView[float] y_float
+    cdef ArrayView[double] y_double
+    cdef vector[string] sequences
+
+    offsets_np = np.asarray(offsets_, dtype=np.int_)
+    if len(offsets_np) == 0 or offsets_np[0] != 0 or offsets_np[len(offsets_np)-1] > len(y_) or np.any(np.diff(offsets_np) < 0):
+        raise ValueError("Offsets must increase from 0 to at most the number of frames")
+    cdef vector[long] offsets = offsets_np
+    y = as_trace(y_)
+    columns = column_offsets(y, columns_)
+    path_np = np.zeros(offsets.back(), dtype=np.intc)
+    cdef int [:] path = path_np
+    cdef int *path_ptr = &path[0] if offsets.back() > 0 else NULL
+    if y.dtype == np.float32:
+        y_float = trace_view[float](y, columns)
+        with nogil:
+            sequences = viterbi_batch(y_float, offsets, alphabet, model, path_ptr)
+    else:
+        y_double = trace_view[double](y, columns)
+        with nogil:
+            sequences = viterbi_batch(y_double, offsets, alphabet, model, path_ptr)
+    return([sequence.decode("UTF-8") for sequence in sequences], path_np)
 
-    return(np.array(list(path.decode('utf-8'))).astype(int))
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def cpp_viterbi_acceptor(y_, label_, int band_size=0, alphabet_="ACGT", model_="ctc", columns_=None):
+    """Best path through a trace that emits label_, i.e. the frames of each
+    of its bases. Returns the state of every frame as in cpp_viterbi.
+
+    The path is searched in a band of band_size frames either side of the
+    diagonal, 0 sizes it from the frames per base of the label. The band is
+    widened until no path leaving it can score higher than the path in it."""
+    if model_ not in VITERBI_MODELS:
+        raise ValueError("Unknown model: {}".format(model_))
+    unknown = set(label_) - set(alphabet_)
+    if unknown:
+        raise ValueError("Label has characters that are not in the alphabet: {}".format(''.join(sorted(unknown))))
+    cdef int U = y_.shape[0]
+    cdef vector[int] label = [alphabet_.index(c) for c in label_]
+    cdef int alphabet_size = len(alphabet_)
+    cdef string model = model_.encode("UTF-8")
+    cdef ArrayView[float] y_float
+    cdef ArrayView[double] y_double
+    cdef double score
+
+    y = as_trace(y_)
+    offsets = column_offsets(y, columns_)
+    path_np = np.zeros(U, dtype=np.intc)
+    cdef int [:] path = path_np
+    cdef int *path_ptr = &path[0] if U > 0 else NULL
+    if y.dtype == np.float32:
+        y_float = trace_view[float](y, offsets)
+        with nogil:
+            score = viterbi_acceptor(y_float, U, label, alphabet_size, model, band_size, path_ptr)
+    else:
+        y_double = trace_view[double](y, offsets)
+        with nogil:
+            score = viterbi_acceptor(y_double, U, label, alphabet_size, model, band_size, path_ptr)
+
+    if score == -np.inf:
+        raise ValueError("No path through the {} frames emits the {} bases of the label".format(U, len(label_)))
+    return(path_np)
+
+BEAM_SEARCH_MODELS = ("ctc", "ctc_merge_repeats", "ctc_flipflop")
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def cpp_beam_search(y_, beam_width_=25, alphabet_="ACGT", model_="ctc"):
+def cpp_beam_search(y_, beam_width_=25, alphabet_="ACGT", model_="ctc", beam_type_="hash", columns_=None):
 
     cdef int U = y_.shape[0]
     cdef int alphabet_size = y_.shape[1]
     cdef string alphabet = alphabet_.encode("UTF-8")
     cdef string model = model_.encode("UTF-8")
+    cdef string beam_type = beam_type_.encode("UTF-8")
     cdef int beam_width = beam_width_
+    cdef ArrayView[float] y_float
+    cdef ArrayView[double] y_double
+    cdef string decoded_sequence
+
+    y = as_trace(y_)
+    offsets = column_offsets(y, columns_)
+    if y.dtype == np.float32:
+        y_float = trace_view[float](y, offsets)
+        with nogil:
+            decoded_sequence = beam_search(y_float, U, alphabet, beam_width, model, beam_type)
+    else:
+        y_double = trace_view[double](y, offsets)
+        with nogil:
+            decoded_sequence = beam_search(y_double, U, alphabet, beam_width, model, beam_type)
+    return(decoded_sequence.decode("UTF-8").lstrip('\x00'))
 
-    cdef np.ndarray[double,ndim=2,mode="c"] y = np.asarray(y_, dtype=DTYPE, order="C")
-    cdef double** point_to_y = pointer_from_array_double(y)
-
-    try:
-        decoded_sequence = beam_search(&point_to_y[0], U, alphabet, beam_width, model)
-        return(decoded_sequence.decode("UTF-8").lstrip('\x00'))
-    finally:
-        free(point_to_y)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def cpp_beam_search_batch(y_, offsets_, beam_width_=25, alphabet_="ACGT", model_="ctc", beam_type_="hash", int threads=1, columns_=None):
+    """Beam search on reads concatenated in y_, read i is y_[offsets_[i]:offsets_[i+1]].
+    Returns the list of sequences, decoded in a single call without the GIL
+    on a pool of C++ threads."""
+    if model_ not in BEAM_SEARCH_MODELS:
+        raise ValueError("Unknown model: {}".format(model_))
+    cdef string alphabet = alphabet_.encode("UTF-8")
+    cdef string model = model_.encode("UTF-8")
+    cdef string beam_type = beam_type_.encode("UTF-8")
+    cdef int beam_width = beam_width_
+    cdef ArrayView[float] y_float
+    cdef ArrayView[double] y_double
+    cdef vector[string] sequences
+
+    offsets_np = np.asarray(offsets_, dtype=np.int_)
+    if len(offsets_np) == 0 or offsets_np[0] != 0 or offsets_np[len(offsets_np)-1] > len(y_) or np.any(np.diff(offsets_np) < 0):
+        raise ValueError("Offsets must increase from 0 to at most the number of frames")
+    cdef vector[long] offsets = offsets_np
+    y = as_trace(y_)
+    columns = column_offsets(y, columns_)
+    if y.dtype == np.float32:
+        y_float = trace_view[float](y, columns)
+        with nogil:
+            sequences = beam_search_batch(y_float, offsets, alphabet, beam_width, model, beam_type, threads)
+    else:
+        y_double = trace_view[double](y, columns)
+        with nogil:
+            sequences = beam_search_batch(y_double, offsets, alphabet, beam_width, model, beam_type, threads)
+    return([sequence.decode("UTF-8").lstrip('\x00') for sequence in sequences])
+
+cdef class BeamSearchStream:
+    """Beam search over a read whose frames arrive in chunks.
+
+    push() returns the part of the label that is already fixed by the frames
+    seen so far, finish() returns the rest. The concatenation of all returned
+    strings is the same as cpp_beam_search() on the whole read.
+
+    The precision is fixed by the first chunk, later chunks are converted to
+    it. columns_ is a column map applied to every chunk.
+    """
+    cdef BeamSearchStreamBase[float]* stream_float
+    cdef BeamSearchStreamBase[double]* stream_double
+    cdef string alphabet, model, beam_type
+    cdef int beam_width
+    cdef object columns
+
+    def __cinit__(self, beam_width_=25, alphabet_="ACGT", model_="ctc", beam_type_="hash", columns_=None):
+        self.stream_float = NULL
+        self.stream_double = NULL
+        self.alphabet = alphabet_.encode("UTF-8")
+        self.model = model_.encode("UTF-8")
+        self.beam_type = beam_type_.encode("UTF-8")
+        self.beam_width = beam_width_
+        self.columns = columns_
+
+    def __dealloc__(self):
+        del self.stream_float
+        del self.stream_double
+
+    def push(self, y_):
+        cdef int U = y_.shape[0]
+        cdef ArrayView[float] y_float
+        cdef ArrayView[double] y_double
+        cdef string committed
+
+        if self.stream_float == NULL and self.stream_double == NULL:
+            if as_trace(y_).dtype == np.float32:
+                self.stream_float = beam_search_stream[float](self.alphabet, self.beam_width, self.model, self.beam_type)
+            else:
+                self.stream_double = beam_search_stream[double](self.alphabet, self.beam_width, self.model, self.beam_type)
+
+        if self.stream_float != NULL:
+            y = as_trace(np.asarray(y_, dtype=np.float32))
+            offsets = column_offsets(y, self.columns)
+            y_float = trace_view[float](y, offsets)
+            with nogil:
+                committed = self.stream_float.push(y_float, U)
+        else:
+            y = as_trace(np.asarray(y_, dtype=DTYPE))
+            offsets = column_offsets(y, self.columns)
+            y_double = trace_view[double](y, offsets)
+            with nogil:
+                committed = self.stream_double.push(y_double, U)
+        return(committed.decode("UTF-8"))
+
+    def finish(self):
+        if self.stream_float != NULL:
+            return(self.stream_float.finish().decode("UTF-8"))
+        elif self.stream_double != NULL:
+            return(self.stream_double.finish().decode("UTF-8"))
+        return("")
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def cpp_beam_search_2d(y1_, y2_, envelope_ranges_=None, beam_width_=25, alphabet_="ACGT", model_="ctc", method_="row"):
+def cpp_beam_search_2d(y1_, y2_, envelope_ranges_=None, beam_width_=25, alphabet_="ACGT", model_="ctc", method_="row", beam_type_="hash", threads=1, columns1_=None, columns2_=None):
 
     cdef int U = y1_.shape[0]
     cdef int V = y2_.shape[0]
@@ -113,55 +384,66 @@ def cpp_beam_search_2d(y1_, y2_, envelope_ranges_=None, beam_width_=25, alphabet
     cdef string alphabet = alphabet_.encode("UTF-8")
     cdef string model = model_.encode("UTF-8")
     cdef string method = method_.encode("UTF-8")
-
-    cdef np.ndarray[double,ndim=2,mode="c"] y1 = np.asarray(y1_, dtype=DTYPE, order="C")
-    cdef np.ndarray[double,ndim=2,mode="c"] y2 = np.asarray(y2_, dtype=DTYPE, order="C")
-    cdef np.ndarray[int,ndim=2,mode="c"] envelope_ranges
-    if envelope_ranges_ is not None:
-        envelope_ranges = np.asarray(envelope_ranges_, dtype=np.intc, order="C")
-
-    cdef double** point_to_y1 = pointer_from_array_double(y1)
-    cdef double** point_to_y2 = pointer_from_array_double(y2)
-    cdef int** point_to_envelope_ranges
+    cdef string beam_type = beam_type_.encode("UTF-8")
+    cdef int num_threads = threads
+    cdef ArrayView[float] y1_float, y2_float
+    cdef ArrayView[double] y1_double, y2_double
+    cdef ArrayView[int] envelope
+    cdef string decoded_sequence
+
+    # both reads are decoded in float32 only if both are given in float32
+    y1 = as_trace(y1_)
+    y2 = as_trace(y2_)
+    if y1.dtype != y2.dtype:
+        y1 = np.asarray(y1, dtype=DTYPE)
+        y2 = np.asarray(y2, dtype=DTYPE)
+
+    offsets1 = column_offsets(y1, columns1_)
+    offsets2 = column_offsets(y2, columns2_)
+
+    # an empty view searches the full U x V grid
     if envelope_ranges_ is not None:
-        point_to_envelope_ranges = pointer_from_array_int(envelope_ranges)
-
-    try:
-        if envelope_ranges_ is not None:
-            decoded_sequence = beam_search(&point_to_y1[0], &point_to_y2[0], U, V, alphabet, &point_to_envelope_ranges[0], beam_width, model, method)
-        else:
-            decoded_sequence = beam_search(&point_to_y1[0], &point_to_y2[0], U, V, alphabet, beam_width, model, method)
-        return(decoded_sequence.decode("UTF-8").lstrip('\x00'))
-    finally:
-        free(point_to_y1)
-        free(point_to_y2)
-        if envelope_ranges_ is not None:
-            free(point_to_envelope_ranges)
+        envelope_ranges = as_envelope(envelope_ranges_)
+        envelope_offsets = column_offsets(envelope_ranges)
+        envelope = envelope_view(envelope_ranges, envelope_offsets)
+
+    if y1.dtype == np.float32:
+        y1_float = trace_view[float](y1, offsets1)
+        y2_float = trace_view[float](y2, offsets2)
+        with nogil:
+            decoded_sequence = beam_search(y1_float, y2_float, U, V, alphabet, envelope, beam_width, model, method, beam_type, num_threads)
+    else:
+        y1_double = trace_view[double](y1, offsets1)
+        y2_double = trace_view[double](y2, offsets2)
+        with nogil:
+            decoded_sequence = beam_search(y1_double, y2_double, U, V, alphabet, envelope, beam_width, model, method, beam_type, num_threads)
+    return(decoded_sequence.decode("UTF-8").lstrip('\x00'))
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def cpp_pair_prefix_search_log(y1_, y2_, envelope_ranges_, alphabet_=b'ACGT'):
+def cpp_pair_prefix_search_log(y1_, y2_, envelope_ranges_, alphabet_=b'ACGT', columns1_=None, columns2_=None):
 
     cdef int U = y1_.shape[0]
     cdef int V = y2_.shape[0]
     cdef int alphabet_size = y1_.shape[1]
     cdef string alphabet = alphabet_.encode("UTF-8")
-
-    cdef np.ndarray[double,ndim=2,mode="c"] y1 = np.asarray(y1_, dtype=DTYPE, order="C")
-    cdef np.ndarray[double,ndim=2,mode="c"] y2 = np.asarray(y2_, dtype=DTYPE, order="C")
-    cdef np.ndarray[int,ndim=2,mode="c"] envelope_ranges = np.asarray(envelope_ranges_, dtype=np.intc, order="C")
-
-    cdef double** point_to_y1 = pointer_from_array_double(y1)
-    cdef double** point_to_y2 = pointer_from_array_double(y2)
-    cdef int** point_to_envelope_ranges = pointer_from_array_int(envelope_ranges)
-
-    try:
-        decoded_sequence = pair_prefix_search_log(&point_to_y1[0], &point_to_y2[0], &point_to_envelope_ranges[0], U, V, alphabet)
-        return(decoded_sequence)
-    finally:
-        free(point_to_y1)
-        free(point_to_y2)
-        free(point_to_envelope_ranges)
+    cdef ArrayView[double] y1_double, y2_double
+    cdef ArrayView[int] envelope
+    cdef string decoded_sequence
+
+    y1 = np.asarray(as_trace(y1_), dtype=DTYPE)
+    y2 = np.asarray(as_trace(y2_), dtype=DTYPE)
+    offsets1 = column_offsets(y1, columns1_)
+    offsets2 = column_offsets(y2, columns2_)
+    envelope_ranges = as_envelope(envelope_ranges_)
+    envelope_offsets = column_offsets(envelope_ranges)
+
+    y1_double = trace_view[double](y1, offsets1)
+    y2_double = trace_view[double](y2, offsets2)
+    envelope = envelope_view(envelope_ranges, envelope_offsets)
+    with nogil:
+        decoded_sequence = pair_prefix_search_log(y1_double, y2_double, envelope, U, V, alphabet)
+    return(decoded_sequence)
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
@@ -170,19 +452,20 @@ def cpp_pair_gamma_log_envelope(y1_, y2_, envelope_ranges_):
     cdef int U = y1_.shape[0]
     cdef int V = y2_.shape[0]
     cdef int alphabet_size = y1_.shape[1]
+    cdef ArrayView[double] y1_double, y2_double
+    cdef ArrayView[int] envelope
+    cdef double result
 
-    cdef np.ndarray[double,ndim=2,mode="c"] y1 = np.asarray(y1_, dtype=DTYPE, order="C")
-    cdef np.ndarray[double,ndim=2,mode="c"] y2 = np.asarray(y2_, dtype=DTYPE, order="C")
-    cdef np.ndarray[int,ndim=2,mode="c"] envelope_ranges = np.asarray(envelope_ranges_, dtype=np.intc, order="C")
-
-    cdef double** point_to_y1 = pointer_from_array_double(y1)
-    cdef double** point_to_y2 = pointer_from_array_double(y2)
-    cdef int** point_to_envelope_ranges = pointer_from_array_int(envelope_ranges)
-
-    try:
-        testy_mctest = pair_gamma_log_envelope(&point_to_y1[0], &point_to_y2[0], &point_to_envelope_ranges[0], U, V, alphabet_size)
-        print(testy_mctest)
-    finally:
-        free(point_to_y1)
-        free(point_to_y2)
-        free(point_to_envelope_ranges)
+    y1 = np.asarray(as_trace(y1_), dtype=DTYPE)
+    y2 = np.asarray(as_trace(y2_), dtype=DTYPE)
+    offsets1 = column_offsets(y1)
+    offsets2 = column_offsets(y2)
+    envelope_ranges = as_envelope(envelope_ranges_)
+    envelope_offsets = column_offsets(envelope_ranges)
+
+    y1_double = trace_view[double](y1, offsets1)
+    y2_double = trace_view[double](y2, offsets2)
+    envelope = envelope_view(envelope_ranges, envelope_offsets)
+    with nogil:
+        result = pair_gamma_log_envelope(y1_double, y2_double, envelope, U, V, alphabet_size)
+    return(result)
@@ -6,11 +6,13 @@ import copy
 from libcpp.string cimport string
 #from scipy.special import logsumexp
 
-from SparseMatrix cimport SparseMatrix
+from BandedMatrix cimport BandedMatrix
 
 cdef extern from "math.h":
     double log(double m)
     double exp(double m)
+    double log1p(double m)
+    double INFINITY
 
 DTYPE = np.float64
 ctypedef np.float64_t DTYPE_t
@@ -18,11 +20,22 @@ ctypedef np.float64_t DTYPE_t
 cdef double LOG_0 = -9999
 cdef double LOG_1 = 0
 
-cdef class PySparseMatrix:
-    cdef SparseMatrix*mat  # Hold a C++ instance which we're wrapping
+cdef class PyBandedMatrix:
+    '''
+    Banded matrix of doubles, row i holds columns starts[i] to ends[i]. The
+    rows are stored one after another in a single buffer, which numpy can
+    view without copying, e.g. np.asarray(m) or m.values, with row i at
+    m.values[m.offsets[i]:m.offsets[i+1]]. Rows can't be added while the
+    buffer is viewed.
+    '''
+    cdef BandedMatrix[double] *mat  # Hold a C++ instance which we're wrapping
+    cdef int exports
+    cdef Py_ssize_t shape[1]
+    cdef Py_ssize_t strides[1]
 
     def __cinit__(self):
-        self.mat =  new SparseMatrix()
+        self.mat = new BandedMatrix[double]()
+        self.exports = 0
 
     def __dealloc__(self):
         del self.mat
@@ -35,13 +48,59 @@ cdef class PySparseMatrix:
         return True
 
     def push_row(self, int start, int end):
+        if self.exports > 0:
+            raise BufferError("Can't add rows to a BandedMatrix while its values are viewed")
         self.mat.push_row(start, end)
         return True
 
+    def __len__(self):
+        return self.mat.length
+
+    def __contains__(self, ij):
+        return self.mat.contains(ij[0], ij[1])
+
+    def __getbuffer__(self, Py_buffer *buffer, int flags):
+        self.shape[0] = self.mat.size()
+        self.strides[0] = sizeof(double)
+        buffer.buf = <char *>self.mat.data()
+        buffer.obj = self
+        buffer.len = self.shape[0] * sizeof(double)
+        buffer.readonly = 0
+        buffer.itemsize = sizeof(double)
+        buffer.format = 'd'
+        buffer.ndim = 1
+        buffer.shape = self.shape
+        buffer.strides = self.strides
+        buffer.suboffsets = NULL
+        buffer.internal = NULL
+        self.exports += 1
+
+    def __releasebuffer__(self, Py_buffer *buffer):
+        self.exports -= 1
+
+    @property
+    def values(self):
+        return(np.asarray(self))
+
+    @property
+    def offsets(self):
+        return(np.array(self.mat.offset, dtype=np.intp))
+
+    @property
+    def starts(self):
+        return(np.array(self.mat.start, dtype=np.intp))
+
+    @property
+    def ends(self):
+        return(np.array(self.mat.end, dtype=np.intp))
+
+# older name
+PySparseMatrix = PyBandedMatrix
+
 def diagonal_band_envelope(U,V,width,inside=1,outside=0):
     # just steps across main diagonal line. Width is size above and below
     # the main diagonal
-    envelope = PySparseMatrix()
+    envelope = PyBandedMatrix()
     envelope_indices = []
     envelope_ranges = []
     for u in range(U):
@@ -55,6 +114,19 @@ def diagonal_band_envelope(U,V,width,inside=1,outside=0):
             envelope_indices.append((u,v))
     return(envelope, np.array(envelope_ranges), np.array(envelope_indices))
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def envelope_overlap(int [:,:] envelope):
+    # make rows of a padded envelope overlap with the ones before, in place
+    cdef Py_ssize_t i
+    cdef int prev_end = 0
+    for i in range(envelope.shape[0]):
+        if envelope[i,0] > envelope[i,1]:
+            envelope[i,0] = 0
+        if envelope[i,0] > prev_end:
+            envelope[i,0] = prev_end
+            prev_end = envelope[i,1]
+
 @cython.boundscheck(False)  # Deactivate bounds checking
 @cython.wraparound(True)   # Deactivate negative indexing.
 def viterbi_acceptor(double [:,:] y, label_, alphabet='ACGT', band_size=0):
@@ -172,6 +244,14 @@ cpdef double logsumexp(double [:] x):
         total += exp(x[i])
     return(log(total))
 
+cdef inline double log_add(double a, double b):
+    # log(exp(a)+exp(b)) without underflow for very small probabilities
+    if a < b:
+        a, b = b, a
+    if b == -INFINITY:
+        return(a)
+    return(a + log1p(exp(b-a)))
+
 @cython.boundscheck(False)  # Deactivate bounds checking
 @cython.wraparound(False)   # Deactivate negative indexing.
 def pair_gamma_log(double [:,:] y1, double [:,:] y2):
@@ -187,15 +267,15 @@ def pair_gamma_log(double [:,:] y1, double [:,:] y2):
 
     cdef np.ndarray[DTYPE_t, ndim=2] gamma_ast_np = np.zeros(shape=(U+1,V+1), dtype=DTYPE) + LOG_0
     cdef double [:,:] gamma_ast = gamma_ast_np
-    cdef double gamma_eps, gamma_ast_eps, gamma_ast_ast
+    cdef double gamma_eps, gamma_ast_eps, gamma_ast_ast, joint_max, total2
 
     gamma_[U,V] = LOG_1
     gamma_ast[U,V] = LOG_1
 
-    for v in range(V):
-        gamma_[U,v] = sum(y2[v:,alphabet_size-1])
-    for u in range(U):
-        gamma_[u,V] = sum(y1[u:,alphabet_size-1])
+    for v in reversed(range(V)):
+        gamma_[U,v] = gamma_[U,v+1] + y2[v,alphabet_size-1]
+    for u in reversed(range(U)):
+        gamma_[u,V] = gamma_[u+1,V] + y1[u,alphabet_size-1]
 
     for u in reversed(range(U)):
         for v in reversed(range(V)):
@@ -206,22 +286,28 @@ def pair_gamma_log(double [:,:] y1, double [:,:] y2):
             # method 1
             #total1 = logsumexp(np.add(y1[u,:alphabet_size-1], y2[v,:alphabet_size-1]))
 
-            # method 2
+            # method 2, shifted by the largest term
+            joint_max = y1[u,0]+y2[v,0]
+            for t in range(1,alphabet_size-1):
+                joint_max = max(joint_max, y1[u,t]+y2[v,t])
             total2 = 0
             for t in range(0,alphabet_size-1):
-                total2 += exp(y1[u,t]+y2[v,t])
+                total2 += exp(y1[u,t]+y2[v,t]-joint_max)
 
-            gamma_ast_ast = gamma_[u+1,v+1] + log(total2)
+            if joint_max == -INFINITY:
+                gamma_ast_ast = -INFINITY
+            else:
+                gamma_ast_ast = gamma_[u+1,v+1] + joint_max + log(total2)
 
             # storing DP matrices
-            gamma_ast[u,v] = log(exp(gamma_ast_eps) + exp(gamma_ast_ast))
-            gamma_[u,v] = log(exp(gamma_eps) + exp(gamma_ast[u,v]))
+            gamma_ast[u,v] = log_add(gamma_ast_eps, gamma_ast_ast)
+            gamma_[u,v] = log_add(gamma_eps, gamma_ast[u,v])
 
     return(gamma_np)
 
 @cython.boundscheck(False)  # Deactivate bounds checking
 @cython.wraparound(False)   # Deactivate negative indexing.
-def pair_gamma_log_envelope(double [:,:] y1, double [:,:] y2, PySparseMatrix envelope, Py_ssize_t [:,:] envelope_indices, PySparseMatrix gamma_, PySparseMatrix gamma_ast):
+def pair_gamma_log_envelope(double [:,:] y1, double [:,:] y2, PyBandedMatrix envelope, Py_ssize_t [:,:] envelope_indices, PyBandedMatrix gamma_, PyBandedMatrix gamma_ast):
 
     cdef Py_ssize_t U = y1.shape[0]
     cdef Py_ssize_t V = y2.shape[0]
@@ -308,19 +394,83 @@ def pair_gamma_log_envelope2(double [:,:] y1, double [:,:] y2, envelope):
             # method 1
             #total1 = logsumexp(np.add(y1[u,:alphabet_size-1], y2[v,:alphabet_size-1]))
 
-            # method 2
+            # method 2, shifted by the largest term
+            joint_max = y1[u,0]+y2[v,0]
+            for t in range(1,alphabet_size-1):
+                joint_max = max(joint_max, y1[u,t]+y2[v,t])
             total2 = 0
             for t in range(0,alphabet_size-1):
-                total2 += exp(y1[u,t]+y2[v,t])
+                total2 += exp(y1[u,t]+y2[v,t]-joint_max)
 
-            gamma_ast_ast = gamma_[u+1,v+1] + log(total2)
+            if joint_max == -INFINITY:
+                gamma_ast_ast = -INFINITY
+            else:
+                gamma_ast_ast = gamma_[u+1,v+1] + joint_max + log(total2)
 
             # storing DP matrices
-            gamma_ast[u,v] = log(exp(gamma_ast_eps) + exp(gamma_ast_ast))
-            gamma_[u,v] = log(exp(gamma_eps) + exp(gamma_ast[u,v]))
+            gamma_ast[u,v] = log_add(gamma_ast_eps, gamma_ast_ast)
+            gamma_[u,v] = log_add(gamma_eps, gamma_ast[u,v])
 
     return(gamma_)
 
+cdef inline double band_get(double [:] x, long [:] lo, long [:] hi, long [:] offsets, Py_ssize_t u, Py_ssize_t v):
+    # cell (u,v) of a band stored row after row, outside cells are log(0)
+    if v < lo[u] or v > hi[u]:
+        return(-INFINITY)
+    return(x[offsets[u] + v - lo[u]])
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def pair_gamma_log_band(double [:,:] y1, double [:,:] y2, long [:] lo, long [:] hi):
+    '''
+    pair_gamma_log restricted to the cells lo[u] <= v <= hi[u] of every row u
+    of the (U+1,V+1) matrix. Returns the cells row after row in one array
+    and the offset of every row in it.
+    '''
+    cdef Py_ssize_t U = y1.shape[0]
+    cdef Py_ssize_t V = y2.shape[0]
+    cdef Py_ssize_t blank = y1.shape[1]-1
+    cdef Py_ssize_t u, v, t, k
+
+    offsets_np = np.zeros(U+2, dtype=np.int_)
+    offsets_np[1:] = np.cumsum(np.asarray(hi) - np.asarray(lo) + 1)
+    cdef long [:] offsets = offsets_np
+    gamma_np = np.full(offsets_np[U+1], -np.inf, dtype=DTYPE)
+    gamma_ast_np = np.full(offsets_np[U+1], -np.inf, dtype=DTYPE)
+    cdef double [:] gamma_ = gamma_np
+    cdef double [:] gamma_ast = gamma_ast_np
+    cdef double gamma_eps, gamma_ast_eps, gamma_ast_ast, joint_max, total
+
+    for u in reversed(range(U+1)):
+        for v in reversed(range(lo[u], hi[u]+1)):
+            k = offsets[u] + v - lo[u]
+            if u == U and v == V:
+                gamma_[k] = LOG_1
+                gamma_ast[k] = LOG_1
+            elif u == U:
+                gamma_[k] = band_get(gamma_, lo, hi, offsets, u, v+1) + y2[v,blank]
+            elif v == V:
+                gamma_[k] = band_get(gamma_, lo, hi, offsets, u+1, v) + y1[u,blank]
+            else:
+                gamma_eps = band_get(gamma_, lo, hi, offsets, u+1, v) + y1[u,blank]
+                gamma_ast_eps = band_get(gamma_ast, lo, hi, offsets, u, v+1) + y2[v,blank]
+
+                joint_max = y1[u,0]+y2[v,0]
+                for t in range(1,blank):
+                    joint_max = max(joint_max, y1[u,t]+y2[v,t])
+                if joint_max == -INFINITY:
+                    gamma_ast_ast = -INFINITY
+                else:
+                    total = 0
+                    for t in range(blank):
+                        total += exp(y1[u,t]+y2[v,t]-joint_max)
+                    gamma_ast_ast = band_get(gamma_, lo, hi, offsets, u+1, v+1) + joint_max + log(total)
+
+                gamma_ast[k] = log_add(gamma_ast_eps, gamma_ast_ast)
+                gamma_[k] = log_add(gamma_eps, gamma_ast[k])
+
+    return(gamma_np, offsets_np)
+
 @cython.boundscheck(False)  # Deactivate bounds checking
 @cython.wraparound(False)   # Deactivate negative indexing.
 def pair_prefix_prob_log_from_vec(double [:] alpha_ast1, double [:] alpha_ast2, double [:,:] gamma):
@@ -2,6 +2,9 @@ import pickle, sys, time
 import numpy as np
 from scipy.special import logsumexp
 
+import poreover.align as align
+from . import decoding_cy
+
 def add_block(b,envelope):
     '''
     Add single block to row-based envelope
@@ -24,65 +27,179 @@ def check_envelope(envelope,U,V):
     return(check_greater and check_overlap and check_length and check_range)
 
 def get_alignment_columns(alignment):
-    # extract column type and read sequence indices
-    x_index=-1
-    y_index=-1
-    alignment_col = []
-    for (x,y) in alignment.T:
-        if (x != '-'):
-            x_index += 1
-        if (y != '-'):
-            y_index += 1
-
-        if (x == '-'):
-            label = 'i'
-        elif (y == '-'):
-            label = 'd'
-        else:
-            label = 'm'
-        alignment_col.append((label, x_index, y_index))
+    '''
+    Column type (align.ALIGN_MATCH/ALIGN_DELETION/ALIGN_INSERTION) and index
+    of the last base of each read at every column of a byte coded alignment
+    (as from align.alignment_from_ops), as rows of an (N,3) array
+    '''
+    aligned = (alignment != align.GAP_CODE)
+    alignment_col = np.empty((alignment.shape[1], 3), dtype=np.int64)
+    alignment_col[:,0] = np.where(~aligned[0], align.ALIGN_INSERTION, np.where(~aligned[1], align.ALIGN_DELETION, align.ALIGN_MATCH))
+    alignment_col[:,1:] = np.cumsum(aligned, axis=1).T - 1
+    return(alignment_col)
+
+def get_anchor_columns(anchors, k, length1, length2):
+    '''
+    Alignment columns (as from get_alignment_columns, all of them matches)
+    along a chain of k-mer
+    anchors. Between neighbouring anchors (and towards the ends of the reads)
+    the path is unknown, so the columns follow a straight line through the
+    gap padded on either side by the difference of the gap lengths plus the
+    square root of the gap length
+    '''
+    # corners of the path: start and end of every anchor, trimmed where
+    # neighbouring anchors overlap, so even segments are gaps and odd ones
+    # are anchors
+    corners = [(0, 0)]
+    for (i, j) in anchors:
+        (x, y) = corners[-1]
+        skip = max(x - i, y - j, 0)
+        if skip >= k:
+            continue
+        corners.append((i+skip, j+skip))
+        corners.append((i+k, j+k))
+    corners.append((length1, length2))
+    corners = np.array(corners, dtype=np.int64)
+
+    # columns stepping from each corner to the next, with the index of the
+    # last base of each read in every column
+    delta = np.diff(corners, axis=0)
+    steps = np.max(delta, axis=1)
+    segment = np.repeat(np.arange(len(steps)), steps)
+    t = np.arange(len(segment)) - np.repeat(np.cumsum(steps) - steps, steps) + 1
+    columns = corners[segment] + -(-t[:,None]*delta[segment] // steps[segment][:,None]) - 1
+
+    padding = np.abs(delta[:,0] - delta[:,1]) + np.ceil(np.sqrt(steps)).astype(np.int64)
+    gap = segment % 2 == 0
+    x = columns[gap,0]
+    pad = padding[segment[gap]]
+    y1 = np.maximum(columns[gap,1] - pad, 0)
+    y2 = np.minimum(columns[gap,1] + pad, length2 - 1)
+
+    alignment_col = np.zeros((np.sum(~gap) + 2*len(x), 3), dtype=np.int64)
+    alignment_col[:,1] = np.r_[columns[~gap,0], x, x]
+    alignment_col[:,2] = np.r_[columns[~gap,1], y1, y2]
     return(alignment_col)
 
 def build_envelope(y1, y2, alignment_col, sequence_to_signal1, sequence_to_signal2, padding=150):
     U = len(y1)
     V = len(y2)
 
-    # get [sequence] to [signal range] mapping
-    sequence_to_signal_range1 = []
-    for i,v in enumerate(sequence_to_signal1[:-1]):
-        sequence_to_signal_range1.append([sequence_to_signal1[i],sequence_to_signal1[i+1]])
-    sequence_to_signal_range1.append([sequence_to_signal1[-1],U])
+    # signal range [bounds[i], bounds[i+1]) of every base
+    bounds1 = np.append(sequence_to_signal1, U).astype(np.int64)
+    bounds2 = np.append(sequence_to_signal2, V).astype(np.int64)
 
-    sequence_to_signal_range2 = []
-    for i,v in enumerate(sequence_to_signal2[:-1]):
-        sequence_to_signal_range2.append([sequence_to_signal2[i],sequence_to_signal2[i+1]])
-    sequence_to_signal_range2.append([sequence_to_signal2[-1],V])
+    # every column adds the block of signal of its two bases, so the rows of
+    # one base of read1 span the signal of all bases of read2 it is aligned to
+    seq1 = np.maximum(alignment_col[:,1], 0)
+    seq2 = np.maximum(alignment_col[:,2], 0)
+    base_start = np.full(len(bounds1)-1, V+1, dtype=np.int64)
+    base_end = np.full(len(bounds1)-1, -1, dtype=np.int64)
+    np.minimum.at(base_start, seq1, bounds2[seq2])
+    np.maximum.at(base_end, seq1, bounds2[seq2+1])
+    base_start[base_end < 0] = -1
 
-    # build alignment envelope
-    alignment_envelope = np.zeros(shape=(U,2),dtype=int)-1
-
-    for (i,tup) in enumerate(alignment_col):
-        (label, seq1, seq2) = tup
-        block = (int(sequence_to_signal_range1[max(seq1, 0)][0]), int(sequence_to_signal_range2[max(seq2, 0)][0]),
-                 int(sequence_to_signal_range1[max(seq1, 0)][1]), int(sequence_to_signal_range2[max(seq2, 0)][1])
-                )
-        add_block(block, alignment_envelope)
+    # build alignment envelope, rows before the first base are left empty (-1)
+    # np.intc so the envelope is passed to the C++ decoders without conversion
+    alignment_envelope = np.zeros(shape=(U,2),dtype=np.intc)-1
+    frames = np.diff(bounds1)
+    alignment_envelope[bounds1[0]:,0] = np.repeat(base_start, frames)
+    alignment_envelope[bounds1[0]:,1] = np.repeat(base_end, frames)
 
     # add a little padding to ensure some overlap
-    for i in range(len(alignment_envelope)):
-        alignment_envelope[i,0] = max(0,alignment_envelope[i,0]-padding)
-        alignment_envelope[i,1] = min(V,alignment_envelope[i,1]+padding)
+    alignment_envelope[:,0] = np.maximum(0, alignment_envelope[:,0]-padding)
+    alignment_envelope[:,1] = np.minimum(V, alignment_envelope[:,1]+padding)
 
     # try and fix any problems
-    prev_end = 0
-    for i in range(len(alignment_envelope)):
-        if alignment_envelope[i,0] > alignment_envelope[i,1]:
-            alignment_envelope[i,0] = 0
-        # ensure some overlap
-        if alignment_envelope[i,0] > prev_end:
-            alignment_envelope[i,0] = prev_end
-            prev_end = alignment_envelope[i,1]
+    decoding_cy.envelope_overlap(alignment_envelope)
+
+    return(alignment_envelope)
+
+def pool_frames(y, factor):
+    '''
+    Average the probabilities of every factor consecutive frames of a table of
+    log-probabilities (log-sum-exp of the block minus the log of its size)
+    '''
+    starts = np.arange(0, len(y), factor)
+    pooled = np.logaddexp.reduceat(y, starts, axis=0)
+    return(pooled - np.log(np.diff(np.append(starts, len(y))))[:,None])
 
+def cut_posterior(y1, y2, lo, hi):
+    '''
+    Log-probability that both reads agree before and after the cut (u,v) of
+    the (U+1,V+1) grid, for the cells lo[u] <= v <= hi[u]. Returns the row,
+    column and value of every cell.
+    '''
+    gamma, offsets = decoding_cy.pair_gamma_log_band(y1, y2, lo, hi)
+    # forward probabilities are gamma of the reversed tables in the reversed
+    # band, whose cells are the cells of the band in reverse order
+    alpha, _ = decoding_cy.pair_gamma_log_band(y1[::-1], y2[::-1], len(y2)-hi[::-1], len(y2)-lo[::-1])
+    row = np.repeat(np.arange(len(lo)), hi-lo+1)
+    col = np.arange(len(gamma)) - offsets[row] + lo[row]
+    return(row, col, alpha[::-1] + gamma - gamma[0])
+
+def coarse_envelope(y1, y2, factor=16, threshold=1e-3, padding=0, max_cells=1<<22):
+    '''
+    Envelope from the posterior of the pair alignment, refined from coarse to
+    fine frames. Both tables of CTC log-probabilities (blank last) are pooled
+    by factor frames (more if the grid would exceed max_cells cells) and the
+    pair forward/backward DP is run on the whole grid. Cells where both
+    prefixes and both suffixes agree with probability above threshold are
+    kept. The factor is then halved and the DP rerun on the kept cells only,
+    down to single frames.
+    '''
+    U = len(y1)
+    V = len(y2)
+    y1 = np.asarray(y1, dtype=np.float64)
+    y2 = np.asarray(y2, dtype=np.float64)
+    while factor > 1 and (U/factor)*(V/factor) > max_cells:
+        factor *= 2
+
+    # start and end of the frames of read2 for every frame of read1
+    frame_envelope = np.zeros((U,2), dtype=np.int64)
+    frame_envelope[:,1] = V
+    while True:
+        coarse1 = pool_frames(y1, factor)
+        coarse2 = pool_frames(y2, factor)
+        U_ = len(coarse1)
+        V_ = len(coarse2)
+
+        # cut band on this grid: the frames of each coarse row in the
+        # envelope, made monotone so that it connects (0,0) to (U_,V_)
+        starts = np.arange(0, U, factor)
+        lo = np.minimum.reduceat(frame_envelope[:,0], starts) // factor
+        hi = -(-np.maximum.reduceat(frame_envelope[:,1], starts) // factor)
+        lo = np.minimum.accumulate(np.append(lo, lo[-1])[::-1])[::-1]
+        hi = np.maximum.accumulate(np.append(hi, V_))
+        lo[0] = 0
+        hi = np.maximum(np.maximum(hi, np.append(lo[1:], V_)), lo)
+
+        row, col, posterior = cut_posterior(coarse1, coarse2, lo.astype(np.int_), hi.astype(np.int_))
+
+        # cuts kept in each row, at least the most likely one
+        row_max = np.full(U_+1, -np.inf)
+        np.maximum.at(row_max, row, posterior)
+        kept = (posterior >= np.log(threshold)) | (posterior == row_max[row])
+        cut_start = np.full(U_+1, V_)
+        cut_end = np.zeros(U_+1, dtype=np.int64)
+        np.minimum.at(cut_start, row[kept], col[kept])
+        np.maximum.at(cut_end, row[kept], col[kept])
+
+        # coarse frame u lies between cuts u and u+1, pad by a coarse frame
+        frame_start = np.minimum(cut_start[:-1], cut_start[1:]) - 1
+        frame_end = np.maximum(cut_end[:-1], cut_end[1:]) + 1
+        rows = np.arange(U) // factor
+        frame_envelope[:,0] = np.maximum(0, frame_start[rows]*factor)
+        frame_envelope[:,1] = np.minimum(V, frame_end[rows]*factor)
+        if factor == 1:
+            break
+        factor //= 2
+
+    # np.intc so the envelope is passed to the C++ decoders without conversion
+    alignment_envelope = np.zeros(shape=(U,2), dtype=np.intc)
+    alignment_envelope[:,0] = np.maximum(0, frame_envelope[:,0] - padding)
+    alignment_envelope[:,1] = np.minimum(V, frame_envelope[:,1] + padding)
+    decoding_cy.envelope_overlap(alignment_envelope)
     return(alignment_envelope)
 
 def offset_envelope(full_envelope, subset):
@@ -92,6 +209,25 @@ def offset_envelope(full_envelope, subset):
     subset_envelope[:,1] = subset_envelope[:,1] - v1
     return(subset_envelope)
 
+def split_envelope(full_envelope, tile_size, overlap):
+    '''
+    Split envelope into tiles of tile_size rows that overlap by overlap rows,
+    returns (u1,u2,v1,v2) for each tile with v1:v2 covering its rows
+    '''
+    if overlap >= tile_size:
+        raise ValueError('Tile overlap ({}) must be smaller than the tile size ({})'.format(overlap, tile_size))
+    U = len(full_envelope)
+    step = tile_size - overlap
+    tiles = []
+    u1 = 0
+    while True:
+        u2 = min(u1+tile_size, U)
+        tiles.append((u1, u2, int(np.min(full_envelope[u1:u2,0])), int(np.max(full_envelope[u1:u2,1]))))
+        if u2 == U:
+            break
+        u1 += step
+    return(tiles)
+
 def pad_envelope(envelope, U, V):
     new_envelope = np.concatenate((envelope, [envelope[-1], envelope[-1]]))
     for i,_ in enumerate(new_envelope):
@@ -0,0 +1,87 @@
+'''
+Completion journal for decoding many reads or read pairs.
+
+Every finished item is appended to <out>.journal together with the sizes of
+the output files after its sequences were written. Entries are written and
+fsynced in batches, after the output files themselves, so the journal never
+claims more than the outputs hold. With resume, the outputs are truncated back
+to the sizes of the last entry (dropping anything written after it) and the
+items in the journal are skipped. Without a path nothing is journaled, the
+outputs are only opened and closed.
+'''
+import os
+import time
+
+class journal:
+    def __init__(self, path, outputs, resume=False, batch=16, interval=30):
+        '''
+        outputs are the paths of the output files, which are opened (for
+        appending if resuming) and available as self.files, path is None for
+        no journal
+        '''
+        self.path = path
+        self.batch = batch
+        self.interval = interval
+        self.completed = set()
+        sizes = [0]*len(outputs)
+
+        if resume and path is not None and os.path.exists(path):
+            # a line cut short by a crash was never synced, drop it
+            with open(path, 'rb+') as f:
+                data = f.read()
+                end = data.rfind(b'\n') + 1
+                f.truncate(end)
+            for line in data[:end].decode().splitlines():
+                (line_sizes, key) = line.split('\t', 1)
+                sizes = [int(s) for s in line_sizes.split()]
+                self.completed.add(key)
+
+        self.resumed = resume and len(self.completed) > 0
+        self.files = []
+        for (output, size) in zip(outputs, sizes):
+            if resume and os.path.exists(output):
+                with open(output, 'r+') as f:
+                    f.truncate(size)
+                self.files.append(open(output, 'a'))
+            else:
+                self.files.append(open(output, 'w'))
+        self.f = None if path is None else open(path, 'a' if resume else 'w')
+        self.pending = []
+        self.last_sync = time.time()
+
+    def __contains__(self, key):
+        return(key in self.completed)
+
+    def __len__(self):
+        return(len(self.completed))
+
+    def record(self, key):
+        '''
+        Mark key as finished, after its output has been written to self.files
+        '''
+        self.completed.add(key)
+        if self.f is None:
+            return
+        sizes = ' '.join(str(f.tell()) for f in self.files)
+        self.pending.append('{}\t{}\n'.format(sizes, key))
+        if len(self.pending) >= self.batch or time.time() - self.last_sync > self.interval:
+            self.sync()
+
+    def sync(self):
+        if self.f is None:
+            return
+        for f in self.files:
+            f.flush()
+            os.fsync(f.fileno())
+        self.f.write(''.join(self.pending))
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.pending = []
+        self.last_sync = time.time()
+
+    def close(self):
+        self.sync()
+        for f in self.files:
+            f.close()
+        if self.f is not None:
+            self.f.close()
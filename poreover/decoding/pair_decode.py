@@ -26,17 +26,22 @@ The method of segentation is determined by the --method flag.
 '''
 import numpy as np
 from multiprocessing import Pool, get_logger
+from multiprocessing.pool import ThreadPool
 import argparse, random, sys, glob, os, re
 from scipy.special import logsumexp
 #from Bio import pairwise2
 import logging
 import copy
+import functools
+import heapq
+import threading
 import progressbar
 from itertools import starmap
 
 from . import decode
 from . import decoding_cpp
 from . import envelope
+from . import journal
 from . import prefix_search
 import poreover.align as align
 
@@ -51,40 +56,22 @@ def fasta_format(name, seq, width=60):
 
 def get_anchors(alignment, matches, indels):
     # find alignment 'anchors' from contiguous stretches of matches or indels
-    state_start = 0
-    state_counter = 1
-    prev_state = 'START'
-    anchor_ranges = []
-    anchor_type = []
-
-    for i,(a1,a2) in enumerate(alignment.T):
-        # options are match/insertion/deletion/mismatch
-        if a1 == a2:
-            state = 'mat'
-        elif a1 == '-':
-            state = 'ins'
-        elif a2 == '-':
-            state = 'del'
-        else:
-            state = 'mis'
-
-        if prev_state == state and state != 'mis':
-            state_counter += 1
-        else:
-            if prev_state == 'ins' and state_counter >= indels:
-                anchor_ranges.append((state_start,i))
-                anchor_type.append(prev_state)
-            if prev_state == 'del' and state_counter >= indels:
-                anchor_ranges.append((state_start,i))
-                anchor_type.append(prev_state)
-            if prev_state == 'mat' and state_counter >= matches:
-                anchor_ranges.append((state_start,i))
-                anchor_type.append(prev_state)
-
-            prev_state = state
-            state_counter = 1
-            state_start = i
-
+    # in a byte coded alignment, a stretch still open at the end is not used
+    MAT, INS, DEL, MIS = range(4)
+    state = np.where(alignment[0] == alignment[1], MAT,
+            np.where(alignment[0] == align.GAP_CODE, INS,
+            np.where(alignment[1] == align.GAP_CODE, DEL, MIS)))
+
+    # every mismatch is a stretch of its own
+    starts = np.flatnonzero(np.r_[True, (state[1:] != state[:-1]) | (state[1:] == MIS)])
+    ends = np.r_[starts[1:], len(state)]
+    starts, ends = starts[:-1], ends[:-1]
+    lengths = ends - starts
+    stretch = state[starts]
+    keep = ((stretch == MAT) & (lengths >= matches)) | (((stretch == INS) | (stretch == DEL)) & (lengths >= indels))
+
+    anchor_ranges = [(int(a), int(b)) for (a, b) in zip(starts[keep], ends[keep])]
+    anchor_type = [['mat', 'ins', 'del'][t] for t in stretch[keep]]
     return(anchor_ranges, anchor_type)
 
 def argmax_path(forward):
@@ -110,39 +97,47 @@ def viterbi_path(forward):
     forward_indices[seq_i:] = sig_max
     return(forward_indices)
 
+def orientation(basecall1, basecall2, k=15, w=10):
+    # minimizers of read1 shared with read2 and with its reverse complement
+    return(align.shared_minimizers(basecall1, basecall2, k, w), align.shared_minimizers(basecall1, align.reverse_complement(basecall2), k, w))
+
+def reverse_complement_viterbi(model, basecall, path):
+    # reverse complement the model, and its Viterbi basecall and path with it
+    model.reverse_complement()
+    if model.kind == 'flipflop':
+        # a flop state only follows its flip state, the reversed path is not a path
+        return(model.viterbi_decode(return_path=True))
+    else:
+        # the CTC path is the best state of every frame
+        return(align.reverse_complement(basecall), np.array([3,2,1,0,4])[np.asarray(path)[::-1]])
+
 def get_sequence_mapping(path, kind):
-    signal_to_sequence = []
-    sequence_to_signal = []
-    label_len = 0
-    if kind is 'poreover':
-        for i, p in enumerate(path):
-            if p < 4:
-                sequence_to_signal.append(i)
-                signal_to_sequence.append(label_len)
-                label_len += 1
-    elif kind is 'flipflop':
-        for i, p in enumerate(path):
-            if i == 0:
-                sequence_to_signal.append(i)
-                signal_to_sequence.append(label_len)
-            else:
-                if path[i] != path[i-1]:
-                    label_len += 1
-                    sequence_to_signal.append(i)
-                signal_to_sequence.append(label_len)
-    elif kind is 'bonito':
-        for i, p in enumerate(path):
-            if p == 4 or path[i] == path[i-1]:
-                pass
-            else:
-                sequence_to_signal.append(i)
-                signal_to_sequence.append(label_len)
-                label_len += 1
+    # signal index where every base starts, and (flip-flop) base index of
+    # every signal index
+    path = np.asarray(path)
+    if kind == 'poreover':
+        sequence_to_signal = np.flatnonzero(path < 4)
+        signal_to_sequence = np.arange(len(sequence_to_signal))
+    elif kind == 'flipflop':
+        change = np.r_[False, path[1:] != path[:-1]]
+        sequence_to_signal = np.flatnonzero(change)
+        if len(path) > 0:
+            sequence_to_signal = np.r_[0, sequence_to_signal]
+        signal_to_sequence = np.cumsum(change)
+    elif kind == 'bonito':
+        # first frame is compared with the last one
+        sequence_to_signal = np.flatnonzero((path != 4) & (path != np.roll(path, 1)))
+        signal_to_sequence = np.arange(len(sequence_to_signal))
+    else:
+        sequence_to_signal, signal_to_sequence = np.array([], dtype=int), np.array([], dtype=int)
     return(sequence_to_signal, signal_to_sequence)
 
 class parallel_decoder:
-    def __init__(self, args, kind):
+    def __init__(self, args, kind, columns1=None, columns2=None):
         self.args = args
+        # column maps of the two traces, see transducer.columns
+        self.columns1 = columns1
+        self.columns2 = columns2
         self.kind = {'poreover':'ctc', 'guppy':'ctc_flipflop', 'flappie':'ctc_flipflop', 'bonito':'ctc_merge_repeats'}[self.args.basecaller]
 
     def _beam_search_2d(self, logits1, logits2, b, b_tot, u1, u2, v1, v2):
@@ -151,9 +146,9 @@ class parallel_decoder:
         if size <= 1:
             return(u1,'')
         elif (u2-u1) < 1:
-            return((u1, prefix_search.prefix_search_log_cy(logits2[v1:v2])[0]))
+            return((u1, decoding_cpp.cpp_prefix_search_log(logits2[v1:v2])[0]))
         elif (v2-v1) < 1:
-            return((u1, prefix_search.prefix_search_log_cy(logits1[u1:u2])[0]))
+            return((u1, decoding_cpp.cpp_prefix_search_log(logits1[u1:u2])[0]))
         else:
             seq = decoding_cpp.cpp_beam_search_2d(
             logits1[u1:u2],
@@ -166,17 +161,17 @@ class parallel_decoder:
         return(decoding_cpp.cpp_beam_search_2d(
         y1_subset,
         y2_subset,
-        subset_envelope.tolist(),
+        subset_envelope,
         beam_width_=self.args.beam_width,
-        model_=self.kind))
+        model_=self.kind,
+        columns1_=self.columns1,
+        columns2_=self.columns2))
 
     def _prefix_search_1d(self, y):
         # Perform 1d basecalling and get signal-sequence mapping
-        (prefix, forward) = prefix_search.prefix_search_log_cy(y, return_forward=True)
-        try:
-            forward_indices = viterbi_path(forward)
-        except:
-            logger.warning('WARNING: Best label is blank! y.shape:{} forward.shape:{} prefix:{}'.format(y.shape, forward.shape, prefix))
+        (prefix, forward_indices) = decoding_cpp.cpp_prefix_search_log(y, return_path=True)
+        if len(prefix) == 0:
+            logger.warning('WARNING: Best label is blank! y.shape:{}'.format(y.shape))
             return('',[]) # in case of gap being most probable
 
         assert(len(prefix) == len(forward_indices))
@@ -192,9 +187,9 @@ class parallel_decoder:
         if size <= 1:
             return(u1,'')
         elif (u2-u1) < 1:
-            return((u1, prefix_search.prefix_search_log_cy(logits2[v1:v2])[0]))
+            return((u1, decoding_cpp.cpp_prefix_search_log(logits2[v1:v2])[0]))
         elif (v2-v1) < 1:
-            return((u1, prefix_search.prefix_search_log_cy(logits1[u1:u2])[0]))
+            return((u1, decoding_cpp.cpp_prefix_search_log(logits1[u1:u2])[0]))
         elif size*8 > MEM_LIMIT:
             logger.error('ERROR: Box too large to basecall {}-{}:{}-{} (size: {} elements)'.format(u1,u2,v1,v2,size))
             return(u1,'')
@@ -209,8 +204,10 @@ class parallel_decoder:
         return(decoding_cpp.cpp_pair_prefix_search_log(
         y1_subset,
         y2_subset,
-        subset_envelope.tolist(),
-        "ACGT"))
+        subset_envelope,
+        "ACGT",
+        columns1_=self.columns1,
+        columns2_=self.columns2))
 
     def get_function(self):
         if self.args.algorithm == 'beam':
@@ -225,6 +222,111 @@ class parallel_decoder:
             else:
                 return(self._prefix_search_2d)
 
+def read_pair_list(path):
+    # lazily yield the two reads on every non-empty line of a pair list
+    with open(path, 'r') as read_pairs:
+        for line in read_pairs:
+            if line.strip():
+                yield(line.split())
+
+# arguments shared by all pairs of a list, set once in every worker
+_pair_args = None
+
+def pair_cost(length1, length2, padding=5):
+    # decoding scales with the frames of a read times the envelope width,
+    # which has to take up at least the difference in trace lengths
+    return(max(length1, length2) * (2*padding + 1 + abs(length1 - length2)))
+
+def makespan(costs, workers):
+    # finish time of the last worker when jobs go to the first free worker
+    loads = [0]*workers
+    for cost in costs:
+        heapq.heapreplace(loads, loads[0] + cost)
+    return(max(loads))
+
+def _init_pair_worker(args):
+    global _pair_args
+    _pair_args = args
+
+def _decode_pair(task):
+    (i, in_pair) = task
+    args = copy.copy(_pair_args)
+    setattr(args, 'in', in_pair)
+    return((i, in_pair, pair_decode_helper(args)))
+
+class pair_writer:
+    '''
+    Writes decoded pairs as they complete, or in input order through a reorder
+    buffer. A slot of the bounded queue is freed for every pair written, so at
+    most max_pending pairs are queued, decoding or waiting to be written.
+    Written pairs are journaled with args.journal or resume, with resume the
+    pairs in the journal are skipped and the outputs appended to.
+    '''
+    def __init__(self, args, max_pending, ordered=False, resume=False):
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.ordered = ordered
+        self.buffer = {}
+        self.next_pair = 0
+        self.counter = 0
+        self.pbar = progressbar.ProgressBar(max_value=progressbar.UnknownLength)
+        journal_path = args.out+'.journal' if getattr(args, 'journal', False) or resume else None
+        self.journal = journal.journal(journal_path, [args.out+'.1d.fasta', args.out+'.2d.fasta', args.out+'.log'], resume)
+        (self.out_1d_f, self.out_2d_f, self.log_f) = self.journal.files
+        if not self.journal.resumed:
+            print('# PoreOver pair-decode', file=self.log_f)
+            print('# '+str(vars(args)), file=self.log_f)
+            print('# '+'\t'.join(map(str,["read1", "read2", "length1", "length2", "sequence_identity", "estimated_identity"])), file=self.log_f)
+
+    def __contains__(self, in_pair):
+        return(' '.join(in_pair) in self.journal)
+
+    def done(self, result):
+        (i, in_pair, x) = result
+        if not self.ordered:
+            self.write(in_pair, x)
+            return
+        self.buffer[i] = (in_pair, x)
+        while self.next_pair in self.buffer:
+            self.write(*self.buffer.pop(self.next_pair))
+            self.next_pair += 1
+
+    def failed(self, i, in_pair, exception):
+        get_logger().error("ERROR: Decoding {} failed ({})".format(' '.join(in_pair), repr(exception)))
+        self.done((i, in_pair, None))
+
+    def write(self, in_pair, x):
+        self.slots.release()
+        if x is None:
+            return
+        self.counter += 1
+        self.pbar.update(self.counter)
+        if len(x) == 3:
+            print(x[0], file=self.out_1d_f)
+            print(x[1], file=self.out_2d_f)
+            print('\t'.join(map(str,[x[2][k] for k in ["read1", "read2", "length1", "length2", "sequence_identity", "estimated_identity"]])), file=self.log_f)
+        elif len(x) == 2:
+            print(x[0], file=self.out_2d_f)
+            print('\t'.join(map(str,[x[1][k] for k in ["read1", "read2"]])), file=self.log_f)
+        self.journal.record(' '.join(in_pair))
+
+    def close(self):
+        self.pbar.finish()
+        self.journal.close()
+
+def longest_first(pairs, args):
+    '''
+    Sort pairs by decreasing cost estimated from their trace lengths and
+    log the estimated makespan
+    '''
+    pairs = list(pairs)
+    lengths = [[decode.trace_length(os.path.join(args.dir, p), args.basecaller) for p in in_pair] for in_pair in pairs]
+    costs = np.array([pair_cost(*l, args.padding) for l in lengths], dtype=float)
+    order = np.argsort(-costs, kind='stable')
+    if len(pairs) > 0:
+        estimate = makespan(costs[order], args.threads)
+        get_logger().info(u"\u25B8"+" scheduling {} pairs longest first, estimated makespan {:.0%} of input order ({:.0%} of a single worker)".format(len(pairs), estimate/makespan(costs, args.threads), estimate/np.sum(costs)))
+    return([pairs[j] for j in order])
+
 def pair_decode(args):
 
     # set up logger - should make it global
@@ -248,52 +350,43 @@ def pair_decode(args):
 
     in_path = getattr(args, 'in')
     if len(in_path) == 1:
-        args_list = []
-        with open(in_path[0], 'r') as read_pairs:
-            for n, line in enumerate(read_pairs):
-                args_copy = copy.deepcopy(args)
-                setattr(args_copy, 'in', line.split())
-                #args_copy.out = "pair{}".format(n)
-                args_list.append(args_copy)
-
-        # set up progressbar and manage output
-        class callback_helper:
-            def __init__(self):
-                self.counter = 0
-                self.pbar = progressbar.ProgressBar(max_value=len(args_list))
-                self.out_1d_f = open(args.out+'.1d.fasta','w')
-                self.out_2d_f = open(args.out+'.2d.fasta','w')
-                self.log_f = open(args.out+'.log','w',1)
-                print('# PoreOver pair-decode', file=self.log_f)
-                print('# '+str(vars(args)), file=self.log_f)
-                print('# '+'\t'.join(map(str,["read1", "read2", "length1", "length2", "sequence_identity"])), file=self.log_f)
-            def callback(self, x):
-                self.counter += 1
-                self.pbar.update(self.counter)
-                if len(x) == 3:
-                    print(x[0], file=self.out_1d_f)
-                    print(x[1], file=self.out_2d_f)
-                    print('\t'.join(map(str,[x[2][k] for k in ["read1", "read2", "length1", "length2", "sequence_identity"]])), file=self.log_f)
-                elif len(x) == 2:
-                    print(x[0], file=self.out_2d_f)
-                    print('\t'.join(map(str,[x[1][k] for k in ["read1", "read2"]])), file=self.log_f)
-        callback_helper_ = callback_helper()
+        engine = getattr(args, 'engine', 'processes')
+        max_pending = getattr(args, 'max_pending', 0) or 2*args.threads
+        ordered = getattr(args, 'ordered', False)
+        resume = getattr(args, 'resume', False)
+        schedule = getattr(args, 'schedule', 'input')
+        if schedule == 'longest' and ordered:
+            # pairs waiting in the reorder buffer would hold every slot
+            logger.warning("WARNING: --ordered output dispatches pairs in input order, ignoring --schedule longest")
+            schedule = 'input'
+        writer = pair_writer(args, max_pending, ordered, resume)
 
         bullet_point = u'\u25B8'+" "
-        logger.info(bullet_point + "found {} read pairs in {}".format(len(args_list), in_path[0]))
-        logger.info(bullet_point + "writing sequences to {0}.1d.fasta and {0}.2d.fasta".format(args.out))
+        logger.info(bullet_point + "reading read pairs from {}".format(in_path[0]))
+        if resume:
+            logger.info(bullet_point + "resuming, skipping {} pairs already decoded".format(len(writer.journal)))
+        logger.info(bullet_point + "writing sequences to {0}.1d.fasta and {0}.2d.fasta{1}".format(args.out, " in input order" if ordered else ""))
         logger.info(bullet_point + "pair alignment statistics saved to {}.log".format(args.out))
-        logger.info(bullet_point + "starting {} decoding processes...".format(args.threads))
-
-        with Pool(processes=args.threads) as pool:
-            #basecalls = pool.map(pair_decode_helper, args_list) #works but no logging
-            for i, arg in enumerate(args_list):
-                pool.apply_async(pair_decode_helper, (args_list[i],), callback=callback_helper_.callback)
+        logger.info(bullet_point + "starting {} decoding {}...".format(args.threads, engine))
+
+        # threads share the process memory, the C++ decoders run without the GIL
+        # workers get args once, each task only carries the paths of its pair
+        pool_type = ThreadPool if engine == 'threads' else Pool
+        with pool_type(processes=args.threads, initializer=_init_pair_worker, initargs=(args,)) as pool:
+            remaining = (in_pair for in_pair in read_pair_list(in_path[0]) if in_pair not in writer)
+            if schedule == 'longest':
+                remaining = longest_first(remaining, args)
+            for i, in_pair in enumerate(remaining):
+                # blocks while max_pending pairs are queued or being decoded
+                writer.slots.acquire()
+                pool.apply_async(_decode_pair, ((i, in_pair),), callback=writer.done, error_callback=functools.partial(writer.failed, i, in_pair))
             pool.close()
             pool.join()
+        writer.close()
 
     else:
-        seqs_1d, seq_2d, summary = pair_decode_helper(args)
+        # no 1D sequences are returned for envelopes built without them
+        *_, seq_2d, summary = pair_decode_helper(args)
         print(summary, file=sys.stderr)
         with open(args.out+'.fasta', 'w') as out_fasta:
             print(seq_2d, file=out_fasta)
@@ -301,23 +394,40 @@ def pair_decode(args):
 def pair_decode_helper(args):
     #logger = getattr(args, 'logger') # should set it globally but just testing for now
     logger = get_logger() # get multiprocessing logger
+    decoding_cpp.cpp_set_log_mode(getattr(args, 'logaddexp', 'exact'))
     in_path = getattr(args, 'in')
     if len(in_path) != 2:
         logger.error("ERROR: Exactly two reads are required")
 
     logger.debug('Read1:{} Read2:{}'.format(in_path[0], in_path[1]))
-    model1 = decode.model_from_trace(os.path.join(args.dir, in_path[0]), args.basecaller)
-    model2 = decode.model_from_trace(os.path.join(args.dir, in_path[1]), args.basecaller)
+    precision = getattr(args, 'precision', 'float64')
+    model1 = decode.model_from_trace(os.path.join(args.dir, in_path[0]), args.basecaller, precision)
+    model2 = decode.model_from_trace(os.path.join(args.dir, in_path[1]), args.basecaller, precision)
     U = model1.t_max
     V = model2.t_max
 
-    if args.reverse_complement:
-        model2.reverse_complement()
-
     assert(model1.kind == model2.kind)
 
+    # Viterbi basecalls and paths, kept for --single viterbi
+    viterbi_calls = None
+    if getattr(args, 'auto_orientation', False):
+        # compare quick 1D calls of read1 with both strands of read2
+        basecall1, viterbi_path1 = model1.viterbi_decode(return_path=True)
+        basecall2, viterbi_path2 = model2.viterbi_decode(return_path=True)
+        forward_hits, reverse_hits = orientation(basecall1, basecall2, args.minimizer_k, args.minimizer_w)
+        logger.debug('\t Shared minimizers with read2 {} forward and {} reverse complemented'.format(forward_hits, reverse_hits))
+        if reverse_hits > forward_hits:
+            basecall2, viterbi_path2 = reverse_complement_viterbi(model2, basecall2, viterbi_path2)
+        viterbi_calls = (basecall1, viterbi_path1, basecall2, viterbi_path2)
+        if max(forward_hits, reverse_hits) == 0:
+            logger.warning("WARNING: Reads {} and {} share no minimizers on either strand".format(in_path[0], in_path[1]))
+    elif args.reverse_complement:
+        model2.reverse_complement()
+    coarse_envelope = getattr(args, 'coarse_envelope', False)
+    assert not (coarse_envelope and model1.kind == 'flipflop'), '--coarse_envelope needs a CTC model with a blank'
+
     # get appropriate helper function for multiprocessing
-    decoding_fn = parallel_decoder(args, model1.kind).get_function()
+    decoding_fn = parallel_decoder(args, model1.kind, model1.columns, model2.columns).get_function()
     pair_decode_summary = {'read1':in_path[0], 'read2':in_path[1]}
 
     if args.method == 'split':
@@ -340,20 +450,22 @@ def pair_decode_helper(args):
         joined_basecalls = ''.join([b[1] for b in basecalls])
 
     else:
-        if not args.diagonal_envelope:
+        # the diagonal and coarse envelopes do not need 1D basecalls
+        if not (args.diagonal_envelope or coarse_envelope):
             logger.debug('\t Performing 1D basecalling...')
 
-            if args.single == 'viterbi':
+            if args.single == 'viterbi' and viterbi_calls is not None:
+                basecall1, viterbi_path1, basecall2, viterbi_path2 = viterbi_calls
+            elif args.single == 'viterbi':
                 basecall1, viterbi_path1 = model1.viterbi_decode(return_path=True)
                 basecall2, viterbi_path2 = model2.viterbi_decode(return_path=True)
             elif args.single == 'beam':
-                print("Basecalling 1")
-                basecall1 = decoding_cpp.cpp_beam_search(model1.log_prob)
-                print("Resquiggling 1")
-                viterbi_path1 = decoding_cpp.cpp_viterbi_acceptor(model1.log_prob, basecall1, band_size=1000)
-                print("Basecalling 2")
-                basecall2 = decoding_cpp.cpp_beam_search(model2.log_prob)
-                viterbi_path2 = decoding_cpp.cpp_viterbi_acceptor(model2.log_prob, basecall2, band_size=1000)
+                # beam search basecalls, then the frames of their bases
+                model_type = decode.model_type[model1.kind]
+                basecall1 = decoding_cpp.cpp_beam_search(model1.trace, model_=model_type, columns_=model1.columns)
+                viterbi_path1 = decoding_cpp.cpp_viterbi_acceptor(model1.trace, basecall1, model_=model_type, columns_=model1.columns)
+                basecall2 = decoding_cpp.cpp_beam_search(model2.trace, model_=model_type, columns_=model2.columns)
+                viterbi_path2 = decoding_cpp.cpp_viterbi_acceptor(model2.trace, basecall2, model_=model_type, columns_=model2.columns)
 
             sequence_to_signal1, _ = get_sequence_mapping(viterbi_path1, model1.kind)
             assert(len(sequence_to_signal1) == len(basecall1))
@@ -361,27 +473,42 @@ def pair_decode_helper(args):
             sequence_to_signal2, _ = get_sequence_mapping(viterbi_path2, model2.kind)
             assert(len(sequence_to_signal2) == len(basecall2))
 
-            logger.debug('\t Aligning basecalled sequences (Read1 is {} bp and Read2 is {} bp)...'.format(len(basecall1),len(basecall2)))
-            #alignment = pairwise2.align.globalms(, , 2, -1, -.5, -.1)
-            alignment = align.global_pair(basecall1, basecall2)
-            alignment = np.array([list(s) for s in alignment[:2]])
-            sequence_identity = np.sum(alignment[0] == alignment[1]) / len(alignment[0])
-            logger.debug('\t Read sequence identity: {}'.format(sequence_identity))
-
-            pair_decode_summary = {'read1':in_path[0], 'read2':in_path[1], 'length1':len(basecall1), 'length2':len(basecall2), 'sequence_identity':sequence_identity}
-
+            anchoring = getattr(args, 'anchoring', 'alignment')
+            if anchoring == 'minimizer' and args.method == 'envelope' and not args.skip_matches:
+                # chained minimizer seeds stand in for the alignment
+                logger.debug('\t Chaining minimizers of basecalled sequences (Read1 is {} bp and Read2 is {} bp)...'.format(len(basecall1),len(basecall2)))
+                anchors = align.chain_minimizers(basecall1, basecall2, k=args.minimizer_k, w=args.minimizer_w)
+                if len(anchors) == 0:
+                    logger.warning("WARNING: No minimizer anchors found, falling back to a straight line between the reads")
+                # the fraction of minimizers shared by the reads is about identity**k
+                sketch_size = max(len(align.minimizers(basecall1, args.minimizer_k, args.minimizer_w)[0]), 1)
+                estimated_identity = (len(anchors) / sketch_size) ** (1 / args.minimizer_k)
+                sequence_identity = np.nan
+                logger.debug('\t Estimated read sequence identity from shared minimizers: {}'.format(estimated_identity))
+                alignment = None
+                alignment_to_sequence = None
+            else:
+                logger.debug('\t Aligning basecalled sequences (Read1 is {} bp and Read2 is {} bp)...'.format(len(basecall1),len(basecall2)))
+                #alignment = pairwise2.align.globalms(, , 2, -1, -.5, -.1)
+                if getattr(args, 'aligner', 'full') == 'banded':
+                    alignment_ops, _ = align.banded_pair(basecall1, basecall2)
+                    alignment = align.alignment_from_ops(basecall1, basecall2, alignment_ops)
+                else:
+                    alignment = align.global_pair(basecall1, basecall2)
+                    alignment = np.array([align.encode(''.join(s)) for s in alignment[:2]])
+                sequence_identity = np.sum(alignment[0] == alignment[1]) / len(alignment[0])
+                estimated_identity = np.nan
+                logger.debug('\t Read sequence identity: {}'.format(sequence_identity))
+
+            pair_decode_summary = {'read1':in_path[0], 'read2':in_path[1], 'length1':len(basecall1), 'length2':len(basecall2), 'sequence_identity':sequence_identity, 'estimated_identity':estimated_identity}
+
+            # nan with minimizer anchoring, the estimate is too rough to warn on
             if sequence_identity < 0.5:
-                logger.warning("WARNING: Pairwise sequence identity is very low ({}%). Did you mean to take the --reverse-complement of one of the reads?".format(sequence_identity))
-
-            # get alignment_to_sequence mapping
-            alignment_to_sequence = np.zeros(shape=alignment.shape,dtype=int)
-            for i,col in enumerate(alignment.T):
-                # no boundary case for first element but it will wrap around to the last (which is zero)
-                for s in range(2):
-                    if col[s] == '-':
-                        alignment_to_sequence[s,i] = alignment_to_sequence[s,i-1]
-                    else:
-                        alignment_to_sequence[s,i] = alignment_to_sequence[s,i-1] + 1
+                logger.warning("WARNING: Pairwise sequence identity is very low ({}%). Did you mean to take the --reverse_complement of one of the reads or use --auto_orientation?".format(sequence_identity))
+
+            if alignment is not None:
+                # number of bases of each read up to every alignment column
+                alignment_to_sequence = np.cumsum(alignment != align.GAP_CODE, axis=1)
 
     if args.skip_matches or args.method == 'align':
 
@@ -394,11 +521,11 @@ def pair_decode_helper(args):
 
             # get anchor sequences
             if anchor_type[i] == 'mat':
-                basecall_anchors.append((sequence_to_signal1[alignment_to_sequence[0,curr_start]], ''.join(alignment[0,curr_start:curr_end])))
+                basecall_anchors.append((sequence_to_signal1[alignment_to_sequence[0,curr_start]], alignment[0,curr_start:curr_end].tobytes().decode()))
             elif anchor_type[i] == 'ins':
-                basecall_anchors.append((sequence_to_signal1[alignment_to_sequence[0,curr_start]], ''.join(alignment[1,curr_start:curr_end])))
+                basecall_anchors.append((sequence_to_signal1[alignment_to_sequence[0,curr_start]], alignment[1,curr_start:curr_end].tobytes().decode()))
             elif anchor_type[i] == 'del':
-                basecall_anchors.append((sequence_to_signal1[alignment_to_sequence[0,curr_start]], ''.join(alignment[0,curr_start:curr_end])))
+                basecall_anchors.append((sequence_to_signal1[alignment_to_sequence[0,curr_start]], alignment[0,curr_start:curr_end].tobytes().decode()))
 
             if i > 0:
                 basecall_boxes.append((
@@ -463,34 +590,58 @@ def pair_decode_helper(args):
                 'alignment':alignment
                 },pfile)
 
-        # prepare data for passing to C++
-        y1 = model1.log_prob
-        y2 = model2.log_prob
+        # prepare data for passing to C++, the column maps are applied there
+        y1 = model1.trace
+        y2 = model2.trace
 
         # Build envelope
-        if args.diagonal_envelope:
-            alignment_envelope = np.array([(max(int(u/U*V)-args.diagonal_width,0),min(int(u/U*V)+args.diagonal_width,V)) for u in range(U)])
+        if coarse_envelope:
+            logger.debug('\t Building envelope from the pair posterior on frames pooled by {}...'.format(args.coarse_factor))
+            alignment_envelope = envelope.coarse_envelope(model1.log_prob, model2.log_prob, factor=args.coarse_factor, threshold=args.coarse_threshold, padding=args.padding)
+        elif args.diagonal_envelope:
+            alignment_envelope = np.array([(max(int(u/U*V)-args.diagonal_width,0),min(int(u/U*V)+args.diagonal_width,V)) for u in range(U)], dtype=np.intc)
+        elif alignment is None:
+            alignment_col = envelope.get_anchor_columns(anchors, args.minimizer_k, len(basecall1), len(basecall2))
+            alignment_envelope = envelope.build_envelope(y1,y2,alignment_col, sequence_to_signal1, sequence_to_signal2, padding=args.padding)
         else:
             alignment_col = envelope.get_alignment_columns(alignment)
             alignment_envelope = envelope.build_envelope(y1,y2,alignment_col, sequence_to_signal1, sequence_to_signal2, padding=args.padding)
 
+        # segments of one pair are decoded in threads, the C++ decoders
+        # release the GIL so they run concurrently
+        pair_threads = getattr(args, 'pair_threads', 1)
+        tile_size = getattr(args, 'tile_size', 0)
+
         logger.debug('\t Starting consensus basecalling...')
-        if not args.skip_matches:
+        if not args.skip_matches and (tile_size <= 0 or tile_size >= U):
             joined_basecalls = decoding_fn(y1, y2, alignment_envelope)
+        elif not args.skip_matches:
+            # overlapping tiles along the envelope, joined on their overlaps
+            tiles = envelope.split_envelope(alignment_envelope, tile_size, args.tile_overlap)
+            logger.debug('\t Decoding {} overlapping tiles...'.format(len(tiles)))
+            def decode_tile(tile):
+                (u1, u2, v1, v2) = tile
+                return(decoding_fn(y1[u1:u2], y2[v1:v2], alignment_envelope[u1:u2] - np.intc(v1)))
+            with ThreadPool(processes=pair_threads, initializer=decoding_cpp.cpp_set_log_mode, initargs=(getattr(args, 'logaddexp', 'exact'),)) as pool:
+                basecalls = pool.map(decode_tile, tiles)
+
+            # tiles are joined on the rows of read1 they share
+            joined_basecalls = decode.join_chunks(basecalls, [tile[:2] for tile in tiles])
         else:
-            basecalls = []
-            for i, b in enumerate(basecall_boxes):
+            def decode_box(b):
                 alignment_envelope_ = alignment_envelope[b[0]:b[1]]
                 y1_ = y1[b[0]:b[1]]
                 y2_ = y2[alignment_envelope_[0,0]:alignment_envelope_[-1,1]]
                 alignment_envelope_ -= alignment_envelope_[0,0]
-                basecalls.append((b[0], decoding_fn(y1_, y2_, alignment_envelope_)))
+                return((b[0], decoding_fn(y1_, y2_, alignment_envelope_)))
+            with ThreadPool(processes=pair_threads, initializer=decoding_cpp.cpp_set_log_mode, initargs=(getattr(args, 'logaddexp', 'exact'),)) as pool:
+                basecalls = pool.map(decode_box, basecall_boxes)
 
             # sort each segment by its first signal index
             joined_basecalls = ''.join([i[1] for i in sorted(basecalls + basecall_anchors)])
 
     # return formatted strings but do output in main pair_decode function
-    if args.diagonal_envelope:
+    if args.diagonal_envelope or coarse_envelope:
         # no 1D decoding to return if using a simple diagonal band
         return (fasta_format('consensus_{};{};{}'.format(args.method,in_path[0],in_path[1]), joined_basecalls), pair_decode_summary)
     else:
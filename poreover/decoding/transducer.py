@@ -1,5 +1,6 @@
 import numpy as np
-from itertools import groupby
+import copy
+from . import decoding_cpp
 
 def remove_repeated(s):
     out = ''
@@ -10,19 +11,58 @@ def remove_repeated(s):
 
 class transducer:
     '''
-    Class for building CTC-style automata from table of log-probabilities
+    Class for building CTC-style automata from table of log-probabilities,
+    stored as float64 unless dtype=np.float32 is given
+
+    The table is kept as trace together with an optional column map, so that
+    reordering the alphabet or taking the reverse complement does not copy it.
+    log_prob is the table with the column map applied. The C++ decoders take
+    trace and columns directly.
     '''
-    def __init__(self, log_prob, kind, alphabet):
-        self.log_prob = log_prob.astype(np.float64)
+    def __init__(self, log_prob, kind, alphabet, dtype=np.float64, columns=None):
+        self.trace = log_prob.astype(dtype, copy=False)
+        self.columns = None if columns is None else np.asarray(columns, dtype=np.intp)
         self.t_max = len(log_prob)
         self.alphabet = alphabet
         self.num_states = len(alphabet)
         self.kind = kind
-        assert(self.num_states == len(self.log_prob[0]))
-        self.transition = np.ones((self.t_max, self.num_states))
+        assert(self.num_states == (self.trace.shape[1] if self.columns is None else len(self.columns)))
+        # log transition probabilities from state i (row) to state j (column)
+        self.transition = np.zeros((self.num_states, self.num_states))
+
+    @property
+    def log_prob(self):
+        if self.columns is None:
+            return(self.trace)
+        return(self.trace[:, self.columns])
+
+    @log_prob.setter
+    def log_prob(self, log_prob):
+        self.trace = log_prob
+        self.columns = None
 
     def __getitem__(self, i):
-        return(self.log_prob.__getitem__(i))
+        if self.columns is None or isinstance(i, tuple):
+            return(self.log_prob.__getitem__(i))
+        return(self.trace[i][..., self.columns])
+
+    def permute(self, columns, reverse=False):
+        '''
+        Reorder the columns of log_prob (and reverse it in time) as a view
+        '''
+        columns = np.asarray(columns, dtype=np.intp)
+        self.columns = columns if self.columns is None else self.columns[columns]
+        if reverse:
+            self.trace = self.trace[::-1]
+
+    def chunk(self, start, end):
+        '''
+        Transducer of frames start to end, sharing the trace as a view
+        '''
+        chunk = copy.copy(self)
+        chunk.trace = self.trace[start:end]
+        chunk.t_max = len(chunk.trace)
+        return(chunk)
 
     def argmax_decode(self, return_path=False):
         greedy_path = np.argmax(self.log_prob, axis=1)
@@ -33,17 +73,20 @@ class transducer:
             return(greedy_string)
 
     def viterbi_decode(self, return_path=False):
+        # reference implementation for any transition matrix, the subclasses
+        # decode their topology with decoding_cpp.cpp_viterbi
         v = np.zeros((self.t_max, self.num_states))-np.inf
         ptr = np.zeros_like(v).astype(int)
 
         # fill out DP matrix
+        log_prob = self.log_prob
         for t in range(self.t_max):
             if t==0:
-                v[t] = self.log_prob[0]
+                v[t] = log_prob[0]
             else:
                 prev = self.transition.T + v[t-1]
                 ptr[t] = np.argmax(prev, axis=1)
-                v[t] = self.log_prob[t] + np.max(prev, axis=1)
+                v[t] = log_prob[t] + np.max(prev, axis=1)
 
         # path traceback
         viterbi_path = np.zeros(self.t_max, dtype=int)
@@ -62,36 +105,33 @@ class transducer:
         return('transducer(kind=%s, alphabet=%s, t_max=%s)' % (self.kind, self.alphabet, self.t_max))
 
 class poreover(transducer):
-    def __init__(self, log_prob, alphabet="ACGT"):
-        super().__init__(log_prob, 'poreover', np.array(list(alphabet)+['']))
+    def __init__(self, log_prob, alphabet="ACGT", dtype=np.float64, columns=None):
+        super().__init__(log_prob, 'poreover', np.array(list(alphabet)+['']), dtype, columns)
 
     def reverse_complement(self):
         # (A,C,G,T,-)/(0,1,2,3,4) => (T,G,C,A,-)/(3,2,1,0,4)
-        self.log_prob = self.log_prob[::-1,[3,2,1,0,4]]
+        self.permute([3,2,1,0,4], reverse=True)
 
     def viterbi_decode(self, return_path=False):
-        return(self.argmax_decode(return_path))
+        sequence, path = decoding_cpp.cpp_viterbi(self.trace, ''.join(self.alphabet), 'ctc', self.columns)
+        return((sequence, path) if return_path else sequence)
 
 class bonito(transducer):
-    def __init__(self, log_prob, alphabet="ACGT"):
-        super().__init__(log_prob, 'bonito', np.array(list(alphabet)+['']))
+    def __init__(self, log_prob, alphabet="ACGT", dtype=np.float64, columns=None):
+        super().__init__(log_prob, 'bonito', np.array(list(alphabet)+['']), dtype, columns)
 
     def reverse_complement(self):
         # (A,C,G,T,-)/(0,1,2,3,4) => (T,G,C,A,-)/(3,2,1,0,4)
-        self.log_prob = self.log_prob[::-1,[3,2,1,0,4]]
+        self.permute([3,2,1,0,4], reverse=True)
 
     def viterbi_decode(self, return_path=False):
-        argmax_string, argmax_path = self.argmax_decode(return_path=True)
-        viterbi_string = ''.join(np.take(self.alphabet, np.array([g[0] for g in groupby(argmax_path)])))
-        if return_path == True:
-            return(viterbi_string, argmax_path)
-        else:
-            return(viterbi_string)
+        sequence, path = decoding_cpp.cpp_viterbi(self.trace, ''.join(self.alphabet), 'ctc_merge_repeats', self.columns)
+        return((sequence, path) if return_path else sequence)
 
 class flipflop(transducer):
-    def __init__(self, log_prob):
-        super().__init__(log_prob, 'flipflop', np.array(['A','C','G','T','a','c','g','t']))
-        self.transition = np.array([
+    def __init__(self, log_prob, dtype=np.float64, columns=None):
+        super().__init__(log_prob, 'flipflop', np.array(['A','C','G','T','a','c','g','t']), dtype, columns)
+        allowed = np.array([
             [1,1,1,1,1,0,0,0],
             [1,1,1,1,0,1,0,0],
             [1,1,1,1,0,0,1,0],
@@ -101,9 +141,14 @@ class flipflop(transducer):
             [1,1,1,1,0,0,1,0],
             [1,1,1,1,0,0,0,1]
         ])
+        self.transition = np.where(allowed, 0, -np.inf)
     def reverse_complement(self):
         # (A,C,G,T,a,c,g,t)/(0,1,2,3,4,5,6,7) => (T,G,C,A,t,g,c,a)/(3,2,1,0,4)
-        self.log_prob = self.log_prob[::-1,[3,2,1,0,7,6,5,4]]
+        self.permute([3,2,1,0,7,6,5,4], reverse=True)
+
+    def viterbi_decode(self, return_path=False):
+        sequence, path = decoding_cpp.cpp_viterbi(self.trace, 'ACGT', 'ctc_flipflop', self.columns)
+        return((sequence, path) if return_path else sequence)
 
 if __name__ == '__main__':
     y = np.random.random((20,5))
@@ -9,8 +9,8 @@ if sys.platform == 'darwin':
     extra_link_args = ['-std=c++11','-stdlib=libc++']
     extra_compile_args = ['-std=c++11','-stdlib=libc++']
 else:
-    extra_link_args = ['-std=c++11']
-    extra_compile_args = ['-std=c++11']
+    extra_link_args = ['-std=c++11', '-pthread']
+    extra_compile_args = ['-std=c++11', '-pthread']
 
 ext_modules = [
 Extension("poreover.decoding.decoding_cpp", sources=["poreover/decoding/decoding_cpp.pyx"], include_dirs=[np.get_include()], language='c++',extra_link_args=extra_link_args, extra_compile_args=extra_compile_args),
@@ -0,0 +1,92 @@
+import unittest
+import numpy as np
+import poreover.align as align
+import poreover.decoding.envelope as envelope
+
+def random_pair(rng, n, p):
+    # sequence and a copy with substitutions, insertions and deletions
+    s1 = ''.join(rng.choice(list('ACGT'), n))
+    s2 = ''
+    for c in s1:
+        r = rng.random()
+        if r < p/3:
+            continue
+        elif r < 2*p/3:
+            s2 += rng.choice(list('ACGT')) + c
+        elif r < p:
+            s2 += rng.choice(list('ACGT'))
+        else:
+            s2 += c
+    return(s1, s2)
+
+class banded_test(unittest.TestCase):
+    def test_score(self):
+        rng = np.random.RandomState(0)
+        for n in [0, 1, 50, 400]:
+            for p in [0.05, 0.3]:
+                s1, s2 = random_pair(rng, n, p)
+                ops, score = align.banded_pair(s1, s2)
+                self.assertEqual(score, align.global_pair(s1, s2)[2][-1,-1])
+                alignment = align.alignment_from_ops(s1, s2, ops)
+                self.assertEqual(alignment[0].tobytes().decode().replace('-',''), s1)
+                self.assertEqual(alignment[1].tobytes().decode().replace('-',''), s2)
+
+    def test_widen(self):
+        # a 300 base insertion only fits in a band wider than the initial one
+        rng = np.random.RandomState(1)
+        s1 = ''.join(rng.choice(list('ACGT'), 1000))
+        s2 = s1[:500] + ''.join(rng.choice(list('ACGT'), 300)) + s1[500:]
+        ops, score = align.banded_pair(s1, s2, band=8)
+        self.assertEqual(score, align.global_pair(s1, s2)[2][-1,-1])
+
+    def test_long_indel(self):
+        # a noisy pair with a long insertion, the best path in the initial
+        # band runs through mismatches without touching its edge
+        for seed, insertion in [(0, 600), (2, 900), (3, 900)]:
+            rng = np.random.RandomState(seed)
+            s1, s2 = random_pair(rng, 3000, 0.15)
+            s2 = s2[:1000] + ''.join(rng.choice(list('ACGT'), insertion)) + s2[1000:]
+            for a, b in [(s1, s2), (s2, s1)]:
+                ops, score = align.banded_pair(a, b)
+                self.assertEqual(score, align.global_pair(a, b)[2][-1,-1])
+
+    def test_cigar(self):
+        ops, score = align.banded_pair('ACGTACGT', 'ACGTCCACGT')
+        self.assertEqual(align.cigar(ops), '4M2I4M')
+        self.assertEqual(score, 8*2 - 2)
+
+class minimizer_test(unittest.TestCase):
+    def test_minimizers(self):
+        rng = np.random.RandomState(2)
+        s1 = ''.join(rng.choice(list('ACGT'), 1000))
+        positions, hashes = align.minimizers(s1, k=11, w=5)
+        # every window of 5 k-mers contains a minimizer
+        self.assertTrue(np.all(np.diff(positions) <= 5))
+        self.assertTrue(np.all(positions <= len(s1) - 11))
+        # k-mers with other characters are skipped
+        positions, hashes = align.minimizers('N'*20 + s1[:30], k=11, w=5)
+        self.assertTrue(np.all(positions >= 20))
+
+    def test_chain(self):
+        rng = np.random.RandomState(3)
+        s1, s2 = random_pair(rng, 5000, 0.1)
+        anchors = align.chain_minimizers(s1, s2, k=11, w=5)
+        self.assertGreater(len(anchors), 100)
+        self.assertTrue(np.all(np.diff(anchors, axis=0) > 0))
+        for (i, j) in anchors:
+            self.assertEqual(s1[i:i+11], s2[j:j+11])
+
+    def test_anchor_columns(self):
+        # anchors cover their k-mers, gaps are padded around a straight line
+        columns = envelope.get_anchor_columns(np.array([[2,2],[20,30]]), 5, 40, 50)
+        cells = set((x, y) for (_, x, y) in columns)
+        for t in range(5):
+            self.assertIn((2+t, 2+t), cells)
+            self.assertIn((20+t, 30+t), cells)
+        self.assertIn((39, 49), cells)
+        # gap from (7,7) to (20,30) is padded by 10+5 bases
+        self.assertIn((13, 3), cells)
+        self.assertTrue(all(0 <= y < 50 for (_, x, y) in columns))
+
+if __name__ == '__main__':
+    unittest.main()
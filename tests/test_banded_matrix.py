@@ -0,0 +1,38 @@
+import unittest
+import numpy as np
+import poreover.decoding as decoding
+
+class banded_matrix(unittest.TestCase):
+    '''
+    Banded gamma matrix stored in one buffer
+    '''
+    def test_view(self):
+        m = decoding.decoding_cy.PyBandedMatrix()
+        m.push_row(0, 2)
+        m.push_row(1, 4)
+        m.set(1, 3, 5.)
+        m.set(1, 9, 1.)
+        self.assertEqual(m.offsets.tolist(), [0, 3, 7])
+        self.assertEqual(m.values[m.offsets[1]:m.offsets[2]].tolist(), [-np.inf, -np.inf, 5., -np.inf])
+        self.assertEqual(m.get(1, 9), -np.inf)
+        view = np.asarray(m)
+        with self.assertRaises(BufferError):
+            m.push_row(0, 1)
+        del view
+        m.push_row(0, 1)
+        self.assertEqual(len(m), 3)
+
+    def test_gamma_envelope(self):
+        rng = np.random.RandomState(0)
+        y1 = np.log(rng.dirichlet(np.ones(5), 30))
+        y2 = np.log(rng.dirichlet(np.ones(5), 25))
+        envelope = np.array([[0, 25]]*31)
+        gamma = decoding.decoding_cy.pair_gamma_log(y1, y2)
+        self.assertAlmostEqual(decoding.decoding_cpp.cpp_pair_gamma_log_envelope(y1, y2, envelope), gamma[0,0])
+        # the prefix search reads gamma from the banded matrix, with an
+        # envelope covering everything it matches the search without one
+        label, _ = decoding.prefix_search.pair_prefix_search_log_cy(y1, y2)
+        self.assertEqual(decoding.decoding_cpp.cpp_pair_prefix_search_log(y1, y2, envelope, 'ACGT').decode(), label)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,7 @@
 import unittest
 import numpy as np
 import os
+from multiprocessing.pool import ThreadPool
 from collections import OrderedDict
 from testing import poreover, poreover_profile, flipflop_profile, joint_profile
 import poreover.decoding as decoding
@@ -101,5 +102,175 @@ class beam_2d_same(unittest.TestCase):
     #    result_2d = decoding.decoding_cpp.cpp_beam_search_2d(self.model.log_prob, self.model.log_prob, envelope_ranges.tolist(), method_="grid")
     #    self.assertTrue(result_1d == result_2d)
 
+class beam_types(unittest.TestCase):
+    '''
+    Beam implementations that keep the top W nodes should agree
+    '''
+    def setUp(self):
+        self.model = decoding.decode.model_from_trace(os.path.abspath(os.path.dirname(__file__))+"/poreover.csv")
+
+    def test_1d(self):
+        y = self.model.log_prob
+        result_sort = decoding.decoding_cpp.cpp_beam_search(y, beam_width_=10, beam_type_="sort")
+        result_hash = decoding.decoding_cpp.cpp_beam_search(y, beam_width_=10, beam_type_="hash")
+        result_set = decoding.decoding_cpp.cpp_beam_search(y, beam_width_=10, beam_type_="set")
+        self.assertTrue(result_sort == result_hash == result_set)
+
+    def test_2d(self):
+        y = self.model.log_prob
+        result_sort = decoding.decoding_cpp.cpp_beam_search_2d(y, y, beam_width_=10, beam_type_="sort")
+        result_hash = decoding.decoding_cpp.cpp_beam_search_2d(y, y, beam_width_=10, beam_type_="hash")
+        self.assertTrue(result_sort == result_hash)
+
+class beam_batch(unittest.TestCase):
+    '''
+    Reads decoded in one batch should match decoding them one at a time
+    '''
+    def test_batch(self):
+        rng = np.random.RandomState(0)
+        reads = [np.log(rng.dirichlet(0.2*np.ones(5), n)) for n in [50, 0, 120, 1, 80]]
+        y = np.concatenate(reads)
+        offsets = np.cumsum([0]+[len(r) for r in reads])
+        expected = [decoding.decoding_cpp.cpp_beam_search(r, beam_width_=10) for r in reads]
+        for threads in [1, 3]:
+            self.assertEqual(decoding.decoding_cpp.cpp_beam_search_batch(y, offsets, beam_width_=10, threads=threads), expected)
+
+    def test_flipflop(self):
+        rng = np.random.RandomState(1)
+        reads = [np.log(rng.dirichlet(0.2*np.ones(8), n)) for n in [60, 30]]
+        offsets = np.cumsum([0]+[len(r) for r in reads])
+        expected = [decoding.decoding_cpp.cpp_beam_search(r, 10, model_="ctc_flipflop") for r in reads]
+        self.assertEqual(decoding.decoding_cpp.cpp_beam_search_batch(np.concatenate(reads), offsets, 10, model_="ctc_flipflop", threads=2), expected)
+
+    def test_offsets(self):
+        y = np.log(np.full((10,5), 0.2))
+        with self.assertRaises(ValueError):
+            decoding.decoding_cpp.cpp_beam_search_batch(y, [0, 11])
+        with self.assertRaises(ValueError):
+            decoding.decoding_cpp.cpp_beam_search_batch(y, [0, 6, 4])
+
+class beam_wavefront(unittest.TestCase):
+    '''
+    Wavefront grid search should not depend on the number of threads
+    '''
+    def setUp(self):
+        self.model = decoding.decode.model_from_trace(os.path.abspath(os.path.dirname(__file__))+"/poreover.csv")
+
+    def test_toy(self):
+        y1 = np.array([[0.8,0.1,0.1],[0.1,0.3,0.6],[0.7,0.2,0.1],[0.1,0.1,0.8]])
+        y2 = np.array([[0.7,0.2,0.1],[0.2,0.3,0.5],[0.7,0.2,0.1],[0.05,0.05,0.9]])
+        prof1 = poreover_profile(y1,('A','B',''))
+        prof2 = poreover_profile(y2, ('A','B',''))
+        joint_prof = joint_profile(prof1, prof2)
+        for threads in [1, 2]:
+            result = decoding.decoding_cpp.cpp_beam_search_2d(np.log(y1), np.log(y2), alphabet_="AB", method_="wavefront", threads=threads)
+            self.assertEqual(result, joint_prof.top_label()[0])
+
+    def test_threads(self):
+        y = self.model.log_prob
+        result_1d = decoding.decoding_cpp.cpp_beam_search(y, beam_width_=5)
+        for threads in [1, 2, 4]:
+            result_2d = decoding.decoding_cpp.cpp_beam_search_2d(y, y, beam_width_=5, method_="wavefront", threads=threads)
+            self.assertEqual(result_2d, result_1d)
+
+    def test_random_pairs(self):
+        rng = np.random.RandomState(0)
+        for i in range(30):
+            y1 = np.log(rng.dirichlet(0.5*np.ones(5), rng.randint(5, 40)))
+            y2 = np.log(rng.dirichlet(0.5*np.ones(5), rng.randint(5, 40)))
+            result_1 = decoding.decoding_cpp.cpp_beam_search_2d(y1, y2, beam_width_=5, method_="wavefront", threads=1)
+            result_2 = decoding.decoding_cpp.cpp_beam_search_2d(y1, y2, beam_width_=5, method_="wavefront", threads=2)
+            self.assertEqual(result_1, result_2)
+
+class beam_stream(unittest.TestCase):
+    '''
+    Decoding a read in chunks should give the same label as decoding it at once
+    '''
+    def setUp(self):
+        self.model = decoding.decode.model_from_trace(os.path.abspath(os.path.dirname(__file__))+"/poreover.csv")
+
+    def test_chunks(self):
+        y = self.model.log_prob
+        result = decoding.decoding_cpp.cpp_beam_search(y, beam_width_=10)
+        for chunk_size in [1, 7, 50]:
+            stream = decoding.decoding_cpp.BeamSearchStream(beam_width_=10)
+            committed = [stream.push(y[i:i+chunk_size]) for i in range(0, len(y), chunk_size)]
+            self.assertEqual(''.join(committed) + stream.finish(), result)
+
+class beam_log_mode(unittest.TestCase):
+    '''
+    Table-driven logaddexp should not change the decoded label
+    '''
+    def setUp(self):
+        self.model = decoding.decode.model_from_trace(os.path.abspath(os.path.dirname(__file__))+"/poreover.csv")
+
+    def tearDown(self):
+        decoding.decoding_cpp.cpp_set_log_mode("exact")
+
+    def test_fast(self):
+        y = self.model.log_prob
+        result_1d = decoding.decoding_cpp.cpp_beam_search(y, beam_width_=10)
+        result_2d = decoding.decoding_cpp.cpp_beam_search_2d(y, y, beam_width_=10)
+        decoding.decoding_cpp.cpp_set_log_mode("fast")
+        self.assertEqual(decoding.decoding_cpp.cpp_beam_search(y, beam_width_=10), result_1d)
+        self.assertEqual(decoding.decoding_cpp.cpp_beam_search_2d(y, y, beam_width_=10), result_2d)
+
+    def test_thread_local(self):
+        # a thread switching to the fast mode does not change other threads
+        y = self.model.log_prob
+        label = decoding.decoding_cpp.cpp_beam_search(y, beam_width_=10)
+        exact = decoding.decoding_cpp.cpp_forward(y, label)
+        def forward_fast():
+            decoding.decoding_cpp.cpp_set_log_mode("fast")
+            return(decoding.decoding_cpp.cpp_forward(y, label))
+        with ThreadPool(processes=1) as pool:
+            fast = pool.apply(forward_fast)
+        self.assertNotEqual(fast, exact)
+        self.assertAlmostEqual(fast, exact, places=3)
+        self.assertEqual(decoding.decoding_cpp.cpp_forward(y, label), exact)
+
+class beam_float32(unittest.TestCase):
+    '''
+    float32 traces are decoded without conversion and give the same label
+    '''
+    def setUp(self):
+        self.model = decoding.decode.model_from_trace(os.path.abspath(os.path.dirname(__file__))+"/poreover.csv")
+
+    def test_same(self):
+        y = self.model.log_prob
+        y32 = y.astype(np.float32)
+        self.assertEqual(decoding.decoding_cpp.cpp_beam_search(y32, beam_width_=10), decoding.decoding_cpp.cpp_beam_search(y, beam_width_=10))
+        self.assertEqual(decoding.decoding_cpp.cpp_beam_search_2d(y32, y32, beam_width_=10), decoding.decoding_cpp.cpp_beam_search_2d(y, y, beam_width_=10))
+        stream = decoding.decoding_cpp.BeamSearchStream(beam_width_=10)
+        self.assertEqual(stream.push(y32) + stream.finish(), decoding.decoding_cpp.cpp_beam_search(y, beam_width_=10))
+
+    def test_model_precision(self):
+        model = decoding.decode.model_from_trace(os.path.abspath(os.path.dirname(__file__))+"/poreover.csv", precision="float32")
+        self.assertEqual(model.log_prob.dtype, np.float32)
+
+class beam_views(unittest.TestCase):
+    '''
+    Strided views and column maps should decode like the copied array
+    '''
+    def setUp(self):
+        self.model = decoding.decode.model_from_trace(os.path.abspath(os.path.dirname(__file__))+"/poreover.csv")
+
+    def test_reverse_complement(self):
+        y = self.model.log_prob
+        result = decoding.decoding_cpp.cpp_beam_search(np.ascontiguousarray(y[::-1,[3,2,1,0,4]]), beam_width_=10)
+        self.model.reverse_complement()
+        self.assertIs(self.model.trace.base, y)
+        self.assertEqual(decoding.decoding_cpp.cpp_beam_search(self.model.trace, beam_width_=10, columns_=self.model.columns), result)
+        self.assertEqual(decoding.decoding_cpp.cpp_beam_search(self.model.log_prob, beam_width_=10), result)
+
+    def test_2d_envelope(self):
+        y = self.model.log_prob
+        t_max = len(y)
+        y_t = np.asfortranarray(y)
+        envelope_ranges = np.array([(i,i+1) for i in range(t_max)], dtype=np.intc)
+        result = decoding.decoding_cpp.cpp_beam_search_2d(y, y, envelope_ranges.tolist())
+        self.assertEqual(decoding.decoding_cpp.cpp_beam_search_2d(y_t, y_t, envelope_ranges), result)
+        self.assertEqual(decoding.decoding_cpp.cpp_beam_search_2d(y_t, y_t, np.asfortranarray(envelope_ranges)), result)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+import argparse
+import os
+import tempfile
+import numpy as np
+import poreover.decoding as decoding
+
+class engine_test(unittest.TestCase):
+    '''
+    Choosing the decode engine from the reads
+    '''
+    def files(self, tmp, reads, length):
+        paths = []
+        for i in range(reads):
+            paths.append(os.path.join(tmp, '{}.npy'.format(i)))
+            np.save(paths[-1], np.zeros((1, length, 5)))
+        return(paths)
+
+    def test_auto(self):
+        args = argparse.Namespace(algorithm='beam', basecaller='poreover', chunk_size=0)
+        with tempfile.TemporaryDirectory() as tmp:
+            short = self.files(tmp, decoding.decode.BATCH_MIN_READS, 100)
+            self.assertEqual(decoding.decode.choose_engine(short, args), 'batch')
+            self.assertEqual(decoding.decode.choose_engine(short[:-1], args), 'processes')
+            args.algorithm = 'prefix'
+            self.assertEqual(decoding.decode.choose_engine(short, args), 'processes')
+        args.algorithm = 'viterbi'
+        with tempfile.TemporaryDirectory() as tmp:
+            long = self.files(tmp, decoding.decode.BATCH_MIN_READS, decoding.decode.BATCH_MAX_FRAMES+1)
+            self.assertEqual(decoding.decode.choose_engine(long, args), 'processes')
+
+class chunks_test(unittest.TestCase):
+    '''
+    Decoding overlapping chunks of a single read and joining them
+    '''
+    def test_split(self):
+        self.assertEqual(decoding.decode.split_chunks(50, 20, 5), [(0,20),(15,35),(30,50)])
+        self.assertEqual(decoding.decode.split_chunks(50, 0, 5), [(0,50)])
+        self.assertEqual(decoding.decode.split_chunks(50, 60, 5), [(0,50)])
+        with self.assertRaises(ValueError):
+            decoding.decode.split_chunks(50, 20, 20)
+
+    def test_join(self):
+        # one base per frame
+        seq = 'ACGTTGCAAGCTAGCTTACGATCGGATCCATGCATTAGCA'
+        chunks = decoding.decode.split_chunks(len(seq), 20, 5)
+        self.assertEqual(decoding.decode.join_chunks([seq[s:e] for s,e in chunks], chunks), seq)
+
+    def test_chunk(self):
+        model = decoding.transducer.poreover(np.log(np.random.RandomState(0).dirichlet(np.ones(5), 50)))
+        chunk = model.chunk(10, 30)
+        self.assertEqual(chunk.t_max, 20)
+        self.assertTrue(np.shares_memory(chunk.trace, model.trace))
+        self.assertEqual(chunk.viterbi_decode(), decoding.transducer.poreover(model.log_prob[10:30]).viterbi_decode())
+
+if __name__ == '__main__':
+    unittest.main()
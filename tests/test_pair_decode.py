@@ -0,0 +1,157 @@
+import unittest
+import argparse
+import os
+import tempfile
+import numpy as np
+import poreover.align as align
+import poreover.decoding as decoding
+
+class pair_writer_test(unittest.TestCase):
+    '''
+    Writing the pairs of a list as they finish or in input order
+    '''
+    def write(self, ordered):
+        with tempfile.TemporaryDirectory() as tmp:
+            args = argparse.Namespace(out=os.path.join(tmp, 'out'))
+            writer = decoding.pair_decode.pair_writer(args, 3, ordered)
+            for i in range(3):
+                writer.slots.acquire()
+            for i in [2, 0, 1]:
+                summary = {'read1':'a{}'.format(i), 'read2':'b{}'.format(i)}
+                writer.done((i, ['a{}'.format(i), 'b{}'.format(i)], ('>{}'.format(i), summary)))
+            writer.close()
+            # every slot was freed
+            for i in range(3):
+                self.assertTrue(writer.slots.acquire(blocking=False))
+            with open(args.out+'.2d.fasta') as f:
+                return([l.strip() for l in f])
+
+    def test_ordered(self):
+        self.assertEqual(self.write(ordered=True), ['>0', '>1', '>2'])
+        self.assertEqual(self.write(ordered=False), ['>2', '>0', '>1'])
+
+class journal_test(unittest.TestCase):
+    '''
+    Resuming from the completion journal of an interrupted run
+    '''
+    def test_resume(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'out')
+            done = decoding.journal.journal(path+'.journal', [path+'.fasta'], batch=2)
+            for read in ['r1', 'r2', 'r3']:
+                print('>'+read, file=done.files[0])
+                done.record(read)
+            # interrupted before r3 was synced, with an unfinished record
+            print('>r4', file=done.files[0])
+            done.files[0].flush()
+            done.f.write('0 garbage')
+            done.f.flush()
+
+            done = decoding.journal.journal(path+'.journal', [path+'.fasta'], resume=True)
+            self.assertEqual(len(done), 2)
+            self.assertIn('r2', done)
+            self.assertNotIn('r3', done)
+            print('>r3', file=done.files[0])
+            done.record('r3')
+            done.close()
+            with open(path+'.fasta') as f:
+                self.assertEqual(f.read().split(), ['>r1', '>r2', '>r3'])
+
+    def test_no_journal(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'out')
+            done = decoding.journal.journal(None, [path+'.fasta'], batch=1)
+            print('>r1', file=done.files[0])
+            done.record('r1')
+            done.close()
+            self.assertIn('r1', done)
+            self.assertEqual(os.listdir(tmp), ['out.fasta'])
+
+class orientation_test(unittest.TestCase):
+    '''
+    Detecting the strand of the second read from minimizer sketches
+    '''
+    def test_orientation(self):
+        np.random.seed(0)
+        seq1 = ''.join(np.random.choice(list('ACGT'), 2000))
+        seq2 = ''.join(b if np.random.random() > 0.05 else np.random.choice(list('ACGT')) for b in seq1)
+        forward, reverse = decoding.pair_decode.orientation(seq1, seq2, 11, 5)
+        self.assertGreater(forward, reverse)
+        forward, reverse = decoding.pair_decode.orientation(seq1, align.reverse_complement(seq2), 11, 5)
+        self.assertGreater(reverse, forward)
+
+    def test_reverse_complement_viterbi(self):
+        # flipping the basecall and path of the read matches decoding it again
+        rng = np.random.RandomState(0)
+        for model in [decoding.transducer.poreover(np.log(rng.dirichlet(np.ones(5), 200))),
+                      decoding.transducer.bonito(np.log(rng.dirichlet(np.ones(5), 200))),
+                      decoding.transducer.flipflop(np.log(rng.dirichlet(np.ones(8), 200)))]:
+            basecall, path = model.viterbi_decode(return_path=True)
+            basecall, path = decoding.pair_decode.reverse_complement_viterbi(model, basecall, path)
+            expected_basecall, expected_path = model.viterbi_decode(return_path=True)
+            self.assertEqual(basecall, expected_basecall)
+            self.assertTrue(np.all(path == expected_path))
+
+class schedule_test(unittest.TestCase):
+    '''
+    Longest-first scheduling from trace lengths
+    '''
+    def test_trace_length(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            np.save(os.path.join(tmp, 'a.npy'), np.zeros((3, 100, 5)))
+            self.assertEqual(decoding.decode.trace_length(os.path.join(tmp, 'a.npy')), 300)
+
+    def test_longest_first(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, length in [('a', 10), ('b', 1000), ('c', 100)]:
+                np.save(os.path.join(tmp, name+'.npy'), np.zeros((length, 5)))
+            args = argparse.Namespace(dir=tmp, basecaller='poreover', padding=5, threads=2)
+            pairs = [['a.npy', 'a.npy'], ['c.npy', 'b.npy'], ['b.npy', 'b.npy']]
+            self.assertEqual(decoding.pair_decode.longest_first(pairs, args), [['c.npy', 'b.npy'], ['b.npy', 'b.npy'], ['a.npy', 'a.npy']])
+
+    def test_makespan(self):
+        self.assertEqual(decoding.pair_decode.makespan([1, 1, 4], 2), 5)
+        self.assertEqual(decoding.pair_decode.makespan([4, 1, 1], 2), 4)
+
+class tiles_test(unittest.TestCase):
+    '''
+    Decoding overlapping tiles of the envelope and joining them
+    '''
+    def test_join(self):
+        seq = 'ACGTTGCAAGCTAGCTTACGATCG'
+        self.assertEqual(decoding.decode.join_overlapping(seq[:16], seq[10:], 6, 6), seq)
+        self.assertEqual(decoding.decode.join_overlapping(seq[:16], seq[10:], 0, 0), seq[:16]+seq[10:])
+
+    def test_split(self):
+        full_envelope = np.array([(max(u-3,0), min(u+3,50)) for u in range(50)], dtype=np.intc)
+        tiles = decoding.envelope.split_envelope(full_envelope, 20, 5)
+        self.assertEqual([t[:2] for t in tiles], [(0,20),(15,35),(30,50)])
+        self.assertEqual(tiles[1][2:], (12,37))
+
+class coarse_envelope_test(unittest.TestCase):
+    '''
+    Envelope refined from the pair posterior on pooled frames
+    '''
+    def test_gamma_band(self):
+        # full band is the whole gamma matrix
+        rng = np.random.RandomState(0)
+        y1 = np.log(rng.dirichlet(np.ones(5), 30))
+        y2 = np.log(rng.dirichlet(np.ones(5), 25))
+        gamma = decoding.decoding_cy.pair_gamma_log(y1, y2)
+        lo = np.zeros(31, dtype=np.int_)
+        hi = np.full(31, 25, dtype=np.int_)
+        gamma_band, offsets = decoding.decoding_cy.pair_gamma_log_band(y1, y2, lo, hi)
+        self.assertTrue(np.allclose(gamma_band.reshape(31, 26), gamma))
+
+    def test_same(self):
+        # two reads of the same (toy) signal align along the diagonal
+        rng = np.random.RandomState(1)
+        y = np.log(rng.dirichlet(0.1*np.ones(5), 400))
+        envelope = decoding.envelope.coarse_envelope(y, y, factor=8)
+        u = np.arange(400)
+        self.assertTrue(np.all((envelope[:,0] <= u) & (u < envelope[:,1])))
+        self.assertLess(np.mean(envelope[:,1] - envelope[:,0]), 50)
+        self.assertEqual(decoding.decoding_cpp.cpp_beam_search_2d(y, y, envelope, beam_width_=5), decoding.decoding_cpp.cpp_beam_search_2d(y, y, beam_width_=5))
+
+if __name__ == '__main__':
+    unittest.main()
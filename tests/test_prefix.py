@@ -7,6 +7,7 @@ import numpy as np
 from collections import OrderedDict
 from testing import poreover, poreover_profile, joint_profile
 import poreover.decoding.prefix_search as prefix_search
+import poreover.decoding as decoding
 
 class TestForwardAlgorithm(unittest.TestCase):
 
@@ -82,6 +83,26 @@ class TestDecoding(unittest.TestCase):
         y = np.array([[0.7,0.2,0.1],[0.2,0.3,0.5]])
         self.assertTrue(helper(y))
 
+    def test_cpp_prefix_search_log(self):
+        toy_alphabet = OrderedDict([('A',0),('B',1)])
+        for y in [np.array([[0.1,0.6,0.3],[0.4,0.2,0.4],[0.4,0.3,0.3],[0.2,0.8,0]]),
+                  np.array([[0.7,0.2,0.1],[0.2,0.3,0.5],[0.7,0.2,0.1],[0.05,0.05,0.9]]),
+                  np.array([[0.7,0.2,0.1],[0.2,0.3,0.5]])]:
+            top_label = poreover_profile(y,('A','B','')).top_label()
+            label, label_prob = decoding.decoding_cpp.cpp_prefix_search_log(np.log(y), alphabet_='AB')
+            self.assertEqual(label, top_label[0])
+            self.assertTrue(np.isclose(label_prob, np.log(top_label[1])))
+
+    def test_cpp_forward_path(self):
+        # same walk as pair_decode.viterbi_path over the full forward matrix
+        rng = np.random.RandomState(0)
+        for t in [5, 30, 80]:
+            y = np.log(rng.dirichlet(0.3*np.ones(5), t))
+            label, path = decoding.decoding_cpp.cpp_prefix_search_log(y, return_path=True)
+            self.assertEqual(label, prefix_search.prefix_search_log(y)[0])
+            forward = prefix_search.forward([prefix_search.DNA_alphabet[c] for c in label], y)[1:].T
+            self.assertEqual(path.tolist(), decoding.pair_decode.viterbi_path(forward).tolist())
+
 class TestPairDecoding(unittest.TestCase):
 
     '''
@@ -12,6 +12,38 @@ class test_viterbi_decode(unittest.TestCase):
         prof = poreover_profile(y,('A','B',''))
         self.assertTrue(model.viterbi_decode() == prof.viterbi_decode())
 
+    def test_flipflop(self):
+        # native kernel against the reference loop with log transitions
+        rng = np.random.RandomState(0)
+        model = decoding.transducer.flipflop(np.log(rng.dirichlet(0.3*np.ones(8), 200)))
+        for reverse_complement in [False, True]:
+            if reverse_complement:
+                model.reverse_complement()
+            sequence, path = model.viterbi_decode(return_path=True)
+            reference_sequence, reference_path = decoding.transducer.transducer.viterbi_decode(model, return_path=True)
+            self.assertEqual(sequence, reference_sequence)
+            self.assertTrue(np.all(path == reference_path))
+            # flop states are only entered from the same base
+            flop = np.flatnonzero(path[1:] >= 4) + 1
+            self.assertTrue(np.all(path[flop-1] % 4 == path[flop] % 4))
+
+    def test_bonito(self):
+        y = np.log(np.array([[0.1,0.1,0.1,0.1,0.6],[0.7,0.1,0.1,0.05,0.05],[0.7,0.1,0.1,0.05,0.05],[0.1,0.1,0.1,0.1,0.6],[0.7,0.1,0.1,0.05,0.05]]))
+        self.assertEqual(decoding.transducer.bonito(y, columns=[0,1,2,3,4]).viterbi_decode(), 'AA')
+        self.assertEqual(decoding.transducer.poreover(y).viterbi_decode(), 'AAA')
+
+    def test_batch(self):
+        rng = np.random.RandomState(1)
+        traces = [np.log(rng.dirichlet(0.3*np.ones(8), n)) for n in [50, 0, 120]]
+        offsets = np.cumsum([0]+[len(y) for y in traces])
+        sequences, path = decoding.decoding_cpp.cpp_viterbi_batch(np.concatenate(traces), offsets, model_='ctc_flipflop')
+        for i, y in enumerate(traces):
+            sequence, read_path = decoding.decoding_cpp.cpp_viterbi(y, model_='ctc_flipflop')
+            self.assertEqual(sequences[i], sequence)
+            self.assertTrue(np.all(path[offsets[i]:offsets[i+1]] == read_path))
+        with self.assertRaises(ValueError):
+            decoding.decoding_cpp.cpp_viterbi_batch(np.concatenate(traces), [0, 200])
+
 class test_viterbi_acceptor(unittest.TestCase):
     def test_cpp_with_best_path(self):
         '''
@@ -22,6 +54,45 @@ class test_viterbi_acceptor(unittest.TestCase):
         acceptor_path = decoding.decoding_cpp.cpp_viterbi_acceptor(transducer.log_prob.astype(np.float64), viterbi_seq)
         self.assertTrue(np.all(viterbi_path == acceptor_path))
 
+    def test_cpp_models(self):
+        '''
+        Acceptor path of the Viterbi sequence is the Viterbi path for every topology
+        '''
+        rng = np.random.RandomState(0)
+        for model, columns in [('ctc', 5), ('ctc_merge_repeats', 5), ('ctc_flipflop', 8)]:
+            y = np.log(rng.dirichlet(0.3*np.ones(columns), 300))
+            viterbi_seq, viterbi_path = decoding.decoding_cpp.cpp_viterbi(y, model_=model)
+            for band_size in [0, 20]:
+                acceptor_path = decoding.decoding_cpp.cpp_viterbi_acceptor(y, viterbi_seq, band_size=band_size, model_=model)
+                self.assertEqual(acceptor_path.dtype, np.int32)
+                self.assertTrue(np.all(viterbi_path == acceptor_path))
+
+    def test_cpp_no_path(self):
+        y = np.log(np.full((3,5), 0.2))
+        with self.assertRaises(ValueError):
+            decoding.decoding_cpp.cpp_viterbi_acceptor(y, 'ACGT')
+        with self.assertRaises(ValueError):
+            decoding.decoding_cpp.cpp_viterbi_acceptor(y, 'AN')
+
+    def test_cpp_uneven_rate(self):
+        # a long blank stall at one end puts the path far off the diagonal, the
+        # banded result should still be the best path
+        rng = np.random.RandomState(0)
+        seq = rng.randint(0, 4, 60)
+        for stall in ['leading', 'trailing']:
+            y = rng.dirichlet(np.ones(5), 600)
+            start = 300 if stall == 'leading' else 0
+            y[:,4] += 2
+            for i, base in enumerate(seq):
+                y[start+5*i+rng.randint(5), base] += 4
+            y = np.log(y / y.sum(axis=1, keepdims=True))
+            label = ''.join('ACGT'[b] for b in seq)
+            full_path = decoding.decoding_cpp.cpp_viterbi_acceptor(y, label, band_size=len(y))
+            full_score = y[np.arange(len(y)), full_path].sum()
+            for band_size in [0, 4, 16]:
+                acceptor_path = decoding.decoding_cpp.cpp_viterbi_acceptor(y, label, band_size=band_size)
+                self.assertAlmostEqual(y[np.arange(len(y)), acceptor_path].sum(), full_score)
+
     def test_cy_with_best_path(self):
         '''
         Best path of Viterbi-decoded sequence should be global best (Viterbi) path